@@ -0,0 +1,21 @@
+import contextlib
+import os
+from typing import IO, Iterator
+
+
+@contextlib.contextmanager
+def open_atomic(path: str, mode: str = 'w', encoding: str | None = 'utf-8') -> Iterator[IO]:
+    """
+    A file to write in place of path, which replaces it once the block is done. It is written next to the target and
+    renamed, so a crash never leaves a truncated file behind, and a failed write leaves the old one as it was
+    """
+
+    tmp_path = f'{path}.tmp'
+    try:
+        with open(tmp_path, mode, encoding=None if 'b' in mode else encoding) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,237 @@
+import asyncio
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Iterable
+
+from atomic_file import open_atomic
+from cache_store import CacheEntry, CacheStore
+from metrics import Metrics
+from token_counter import estimate_cost
+
+logger = logging.getLogger(__name__)
+
+BATCH_STATE_PATH = 'chat_history/cache/batch.json'
+BATCH_INPUT_DIR = 'chat_history/cache/batches'
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+COMPLETION_WINDOW = '24h'
+
+# Limits of a single batch: requests and input file size, the latter with some room for error
+BATCH_MAX_REQUESTS = 50_000
+BATCH_MAX_BYTES = 190 * 1024 * 1024
+
+# Batch requests are billed at half the price of synchronous ones
+BATCH_DISCOUNT = 0.5
+
+POLL_INTERVAL = 60
+
+FINISHED_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+
+@dataclass
+class BatchRequest:
+    # The cache key of the summary, so results are matched back to the cache by custom_id
+    custom_id: str
+    model: str
+    temperature: float | None
+    prompt: str
+    inputs: dict
+
+    def to_line(self) -> bytes:
+        body = {'model': self.model, 'messages': [{'role': 'user', 'content': self.prompt}]}
+        if self.temperature is not None:
+            body['temperature'] = self.temperature
+        line = {'custom_id': self.custom_id, 'method': 'POST', 'url': BATCH_ENDPOINT, 'body': body}
+        return json.dumps(line, ensure_ascii=False).encode('utf-8') + b'\n'
+
+
+@dataclass
+class BatchState:
+    """
+    Batches submitted and not yet collected, with the cache inputs of every request in them
+    """
+
+    batch_ids: list[str] = field(default_factory=list)
+    requests: dict[str, dict] = field(default_factory=dict)
+
+
+def load_batch_state(path: str = BATCH_STATE_PATH) -> BatchState | None:
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'r', encoding='utf-8') as f:
+        return BatchState(**json.load(f))
+
+
+def save_batch_state(state: BatchState, path: str = BATCH_STATE_PATH):
+    with open_atomic(path) as f:
+        json.dump(asdict(state), f, ensure_ascii=False)
+
+
+def write_batch_inputs(requests: Iterable[BatchRequest], input_dir: str = BATCH_INPUT_DIR) -> list[tuple[str, dict]]:
+    """
+    Writes the requests to as many JSONL files as the batch limits require, one line at a time.
+    Returns the path of every file with the model and cache inputs of the requests in it
+    """
+
+    os.makedirs(input_dir, exist_ok=True)
+    files = []
+    seen = set()
+    f = None
+    size = 0
+
+    try:
+        for request in requests:
+            # Identical chunks share a cache key, and custom ids must be unique within a batch
+            if request.custom_id in seen:
+                continue
+            seen.add(request.custom_id)
+
+            line = request.to_line()
+            if f is None or len(files[-1][1]) >= BATCH_MAX_REQUESTS or size + len(line) > BATCH_MAX_BYTES:
+                if f is not None:
+                    f.close()
+                files.append((os.path.join(input_dir, f'batch_input_{len(files) + 1}.jsonl'), {}))
+                f = open(files[-1][0], 'wb')
+                size = 0
+
+            f.write(line)
+            size += len(line)
+            files[-1][1][request.custom_id] = {'model': request.model, 'inputs': request.inputs}
+    finally:
+        if f is not None:
+            f.close()
+
+    return files
+
+
+def parse_result_line(line: str) -> tuple[str, dict | None]:
+    """
+    custom_id and the chat completion of a line of a batch output file, None for a failed request
+    """
+
+    result = json.loads(line)
+    response = result.get('response') or {}
+    if result.get('error') or response.get('status_code') != 200:
+        return result['custom_id'], None
+    return result['custom_id'], response['body']
+
+
+class BatchRunner:
+    """
+    Runs chat completions through the OpenAI Batch API and puts the results into the summary cache.
+    Submitted batches are recorded in a state file until their results are collected, so a restarted run
+    waits for them instead of paying for the same requests again
+    """
+
+    def __init__(self, client, cache: CacheStore, state_path: str = BATCH_STATE_PATH,
+                 input_dir: str = BATCH_INPUT_DIR, poll_interval: float = POLL_INTERVAL, metrics: Metrics | None = None):
+        self.client = client
+        self.cache = cache
+        # Every collected result is recorded as a call, with its tokens and discounted cost
+        self.metrics = metrics or Metrics()
+        self.state_path = state_path
+        self.input_dir = input_dir
+        self.poll_interval = poll_interval
+
+    async def submit(self, requests: Iterable[BatchRequest]) -> BatchState | None:
+        files = write_batch_inputs(requests, self.input_dir)
+        if not files:
+            return None
+
+        state = BatchState()
+        for path, requests_inputs in files:
+            with open(path, 'rb') as f:
+                input_file = await self.client.files.create(file=(os.path.basename(path), f.read()), purpose='batch')
+            batch = await self.client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                                     completion_window=COMPLETION_WINDOW)
+            state.batch_ids.append(batch.id)
+            state.requests.update(requests_inputs)
+            # Saved after every batch, a crash in between loses none of those already submitted
+            save_batch_state(state, self.state_path)
+            logger.info(f'Submitted batch {batch.id} from {path}')
+            os.remove(path)
+
+        logger.info(f'{len(state.requests)} requests submitted in {len(files)} batches')
+        return state
+
+    async def wait(self, batch_id: str):
+        while True:
+            batch = await self.client.batches.retrieve(batch_id)
+            counts = batch.request_counts
+            progress = f', {counts.completed + counts.failed}/{counts.total} requests done' if counts else ''
+            logger.info(f'Batch {batch_id} is {batch.status}{progress}')
+            if batch.status in FINISHED_STATUSES:
+                return batch
+            await asyncio.sleep(self.poll_interval)
+
+    async def collect(self, batch, requests_inputs: dict) -> int:
+        # Expired and cancelled batches still have the output of the requests completed in time
+        if not batch.output_file_id:
+            return 0
+
+        output = await self.client.files.content(batch.output_file_id)
+        collected = 0
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            custom_id, completion = parse_result_line(line)
+            request = requests_inputs.get(custom_id)
+            if request is None:
+                continue
+            if completion is None:
+                self.metrics.record_call('batch', request['model'], 0.0, 0, error='BatchRequestFailed')
+                continue
+
+            usage = completion.get('usage') or {}
+            prompt_tokens = usage.get('prompt_tokens')
+            completion_tokens = usage.get('completion_tokens')
+            cost = estimate_cost(request['model'], prompt_tokens, completion_tokens) if usage else None
+            self.cache.put(custom_id, CacheEntry(
+                summary=completion['choices'][0]['message']['content'],
+                kind='chunk',
+                model=request['model'],
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                cost=cost * BATCH_DISCOUNT if cost is not None else None,
+                inputs={**request['inputs'], 'batch_id': batch.id},
+            ))
+            # The time of a single request is unknown, the span of the batch pass covers them all
+            self.metrics.record_call('batch', request['model'], 0.0, 0, prompt_tokens, completion_tokens,
+                                     cost_scale=BATCH_DISCOUNT)
+            collected += 1
+
+        return collected
+
+    async def finish(self, state: BatchState) -> int:
+        collected = 0
+        for batch_id in state.batch_ids:
+            batch = await self.wait(batch_id)
+            collected += await self.collect(batch, state.requests)
+
+        failed = len(state.requests) - collected
+        logger.info(f'Batch results collected: {collected} summaries cached, {failed} requests failed')
+        os.remove(self.state_path)
+        return collected
+
+    async def resume(self) -> set[str]:
+        """
+        Collects the batches of an interrupted run and returns the custom ids they covered
+        """
+
+        state = load_batch_state(self.state_path)
+        if state is None:
+            return set()
+
+        logger.info(f'Resuming {len(state.batch_ids)} batches submitted by a previous run')
+        await self.finish(state)
+        return set(state.requests)
+
+    async def run(self, requests: Iterable[BatchRequest]) -> int:
+        state = await self.submit(requests)
+        if state is None:
+            logger.info('Nothing to submit, every request is cached')
+            return 0
+        return await self.finish(state)
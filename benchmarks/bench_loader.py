@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.synthetic_export import write_export  # noqa: E402
+
+# eager and streaming compare the loaders, pydantic and compact the footprint of holding every parsed message,
+# snapshot maps the compact store from a snapshot built beforehand
+MODES = ['eager', 'streaming', 'pydantic', 'compact', 'snapshot']
+
+
+def get_peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def measure(mode: str, file_path: str) -> dict:
+    from historizer import iter_chat_history, load_chat_history
+    from message_store import MessageStore
+    from snapshot import load_snapshot
+
+    baseline_rss = get_peak_rss_mb()
+    started = time.perf_counter()
+
+    if mode == 'eager':
+        messages = len(asyncio.run(load_chat_history(file_path)).messages)
+    elif mode == 'streaming':
+        messages = sum(1 for _ in iter_chat_history(file_path))
+    elif mode == 'pydantic':
+        messages = len(list(iter_chat_history(file_path)))
+    elif mode == 'compact':
+        messages = len(MessageStore.from_export(file_path))
+    else:
+        # Renders every row, a mapped store only reads the pages it touches
+        store = load_snapshot(file_path).store
+        messages = sum(1 for _ in store)
+
+    return {
+        'mode': mode,
+        'messages': messages,
+        'seconds': round(time.perf_counter() - started, 2),
+        'peak_rss_mb': round(get_peak_rss_mb(), 1),
+        'import_rss_mb': round(baseline_rss, 1),
+    }
+
+
+def run_in_subprocess(mode: str, file_path: str) -> dict:
+    # Every loader gets a fresh process, otherwise the peak RSS of one would hide the other
+    output = subprocess.run(
+        [sys.executable, __file__, '--measure', mode, file_path],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(messages: int, file_path: str | None):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if file_path is None:
+            file_path = os.path.join(tmp_dir, 'result.json')
+            print(f'Generating a synthetic export with {messages} messages')
+            write_export(file_path, messages)
+
+        from snapshot import load_or_build_snapshot
+        snapshot_path = os.path.join(tmp_dir, 'result.snapshot')
+        load_or_build_snapshot(file_path, snapshot_path)
+
+        size_mb = os.path.getsize(file_path) / 1024 / 1024
+        print(f'Export size: {size_mb:.1f} MB')
+        print(f'{"mode":<10} {"messages":>10} {"seconds":>8} {"peak RSS, MB":>13}')
+
+        for mode in MODES:
+            result = run_in_subprocess(mode, snapshot_path if mode == 'snapshot' else file_path)
+            print(f'{result["mode"]:<10} {result["messages"]:>10} {result["seconds"]:>8} {result["peak_rss_mb"]:>13}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare peak memory of the export loaders and in-memory message representations')
+    parser.add_argument('-n', '--messages', type=int, default=2_000_000, help='Number of messages in the synthetic export')
+    parser.add_argument('-f', '--file', type=str, help='Use an existing export instead of a synthetic one')
+    parser.add_argument('--measure', nargs=2, metavar=('MODE', 'PATH'), help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.measure:
+        mode, path = args.measure
+        print(json.dumps(measure(mode, path)))
+    else:
+        main(args.messages, args.file)
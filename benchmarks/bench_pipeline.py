@@ -0,0 +1,220 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.synthetic_export import write_export  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = ROOT / 'benchmarks' / 'results'
+
+DEFAULT_SIZES = [10_000, 100_000]
+
+# Stages timed one after another over the whole export, then the whole pipeline as the historizer runs it,
+# with loading, chunking and summarization overlapping. Messages are rendered while they are packed into chunks,
+# so chunking and rendering are one stage
+STAGES = ['load', 'chunk+render', 'summarize', 'reduce']
+
+
+def get_peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True, capture_output=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_historizer(options: dict):
+    from cache_store import MemoryCacheStore
+    from historizer import CHUNK_MODEL, FINAL_MODEL, GROUP_MODEL, Historizer
+    from llm_backend import FakeBackend
+    from rate_limiter import UNLIMITED, RateLimiter
+
+    # Every run starts with a cold cache, and the fake has no quota to wait for
+    return Historizer(
+        chunk_tokens=options['chunk_tokens'],
+        concurrency=options['concurrency'],
+        compact=options['compact'],
+        cache=MemoryCacheStore(),
+        rate_limiter=RateLimiter({model: UNLIMITED for model in (CHUNK_MODEL, GROUP_MODEL, FINAL_MODEL)}),
+        backend_factory=lambda model: FakeBackend(model, latency=options['latency']),
+    )
+
+
+async def measure_stages(file_path: str, options: dict) -> dict:
+    import historizer as historizer_module
+    from historizer import CHUNK_MODEL, CHUNK_SUMMARY_PROMPT, FINAL_MODEL, GROUP_MODEL, iter_chat_history
+    from message_store import MessageStore
+    from token_counter import get_token_budget
+
+    historizer = make_historizer(options)
+    chunk_tokens = options['chunk_tokens'] or get_token_budget(CHUNK_MODEL, CHUNK_SUMMARY_PROMPT)
+    stages = {}
+    started = time.perf_counter()
+
+    def finish(stage: str, **extra):
+        nonlocal started
+        now = time.perf_counter()
+        stages[stage] = {'seconds': round(now - started, 3), 'peak_rss_mb': round(get_peak_rss_mb(), 1), **extra}
+        started = now
+
+    if options['compact']:
+        historizer.store = MessageStore.from_export(file_path)
+        messages = historizer.store
+    else:
+        messages = list(iter_chat_history(file_path))
+    finish('load')
+
+    rows = historizer.store.iter_rows() if options['compact'] else messages
+    chunks = list(historizer_module.iter_chunks_by_tokens(rows, historizer.render_message, chunk_tokens))
+    for chunk in chunks:
+        historizer.render_chunk(chunk)
+    finish('chunk+render', chunks=len(chunks))
+
+    summaries = await historizer.summarize_chunks(chunks, historizer.make_backend(CHUNK_MODEL))
+    finish('summarize')
+
+    await historizer.summarize_tree(summaries, historizer.make_backend(GROUP_MODEL), historizer.make_backend(FINAL_MODEL))
+    finish('reduce')
+
+    for stage in stages.values():
+        stage['messages_per_second'] = round(len(messages) / stage['seconds']) if stage['seconds'] else None
+    return {'messages': len(messages), 'stages': stages}
+
+
+async def measure_run(file_path: str, options: dict) -> dict:
+    import historizer as historizer_module
+
+    historizer_module.CHAT_HISTORY_PATH = file_path
+    started = time.perf_counter()
+    await make_historizer(options).run()
+    seconds = time.perf_counter() - started
+    return {'seconds': round(seconds, 3), 'peak_rss_mb': round(get_peak_rss_mb(), 1)}
+
+
+def measure(mode: str, file_path: str, options: dict) -> dict:
+    # The historizer logs every chunk, which would be measured too
+    logging.disable(logging.INFO)
+    # The historizer writes its checkpoint and summaries under the working directory
+    os.chdir(os.path.dirname(file_path))
+
+    if mode == 'stages':
+        return asyncio.run(measure_stages(file_path, options))
+    return asyncio.run(measure_run(file_path, options))
+
+
+def run_in_subprocess(mode: str, file_path: str, options: dict) -> dict:
+    # Every measurement gets a fresh process, otherwise the peak RSS of one would hide the other
+    output = subprocess.run(
+        [sys.executable, __file__, '--measure', mode, file_path, json.dumps(options)],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def benchmark_size(messages: int, options: dict) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'result.json')
+        print(f'Generating a synthetic export with {messages} messages')
+        write_export(file_path, messages)
+
+        result = {'messages': messages, 'export_mb': round(os.path.getsize(file_path) / 1024 / 1024, 1)}
+        result.update(run_in_subprocess('stages', file_path, options))
+        run = run_in_subprocess('run', file_path, options)
+        run['messages_per_second'] = round(messages / run['seconds']) if run['seconds'] else None
+        result['run'] = run
+        return result
+
+
+def print_result(result: dict):
+    print(f'{result["messages"]} messages, {result["export_mb"]} MB export')
+    print(f'  {"stage":<12} {"seconds":>9} {"messages/s":>12} {"peak RSS, MB":>13}')
+    for stage, values in [*result['stages'].items(), ('run', result['run'])]:
+        print(f'  {stage:<12} {values["seconds"]:>9.3f} {values["messages_per_second"] or 0:>12,} '
+              f'{values["peak_rss_mb"]:>13}')
+
+
+def compare(baseline_path: str, report: dict):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    print(f'Compared to {baseline.get("commit")} (positive is slower or bigger)')
+    baseline_results = {result['messages']: result for result in baseline['results']}
+    for result in report['results']:
+        old = baseline_results.get(result['messages'])
+        if old is None:
+            continue
+        print(f'{result["messages"]} messages')
+        for stage in [*STAGES, 'run']:
+            new_values = result['run'] if stage == 'run' else result['stages'].get(stage)
+            old_values = old['run'] if stage == 'run' else old['stages'].get(stage)
+            if not new_values or not old_values or not old_values['seconds']:
+                continue
+            time_change = (new_values['seconds'] / old_values['seconds'] - 1) * 100
+            memory_change = (new_values['peak_rss_mb'] / old_values['peak_rss_mb'] - 1) * 100
+            print(f'  {stage:<12} time {time_change:+7.1f}%   peak RSS {memory_change:+7.1f}%')
+
+
+def main(sizes: list[int], options: dict, output: str | None, baseline: str | None):
+    report = {
+        'commit': get_commit(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': options,
+        'results': [],
+    }
+
+    for messages in sizes:
+        report['results'].append(benchmark_size(messages, options))
+        print_result(report['results'][-1])
+
+    if output is None:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        output = str(RESULTS_DIR / f'pipeline_{report["commit"] or "unknown"}.json')
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results saved to {output}')
+
+    if baseline:
+        compare(baseline, report)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the historizer pipeline stage by stage against a local fake model')
+    parser.add_argument('-n', '--messages', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Sizes of the synthetic exports, for example 10000 100000 1000000 5000000')
+    parser.add_argument('-t', '--chunk-tokens', type=int,
+                        help='Token budget per chunk (derived from the chunk model by default)')
+    parser.add_argument('-j', '--concurrency', type=int, default=8, help='Maximum number of fake model requests in flight')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the fake model takes per request')
+    parser.add_argument('--compact', action='store_true', help='Load the export into the compact store')
+    parser.add_argument('-o', '--output', type=str, help='Where to save the results, benchmarks/results by default')
+    parser.add_argument('--compare', type=str, metavar='RESULTS', help='Results of an earlier run to compare with')
+    parser.add_argument('--measure', nargs=3, metavar=('MODE', 'PATH', 'OPTIONS'), help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.measure:
+        mode, path, options_json = args.measure
+        print(json.dumps(measure(mode, path, json.loads(options_json))))
+    else:
+        main(args.messages, {'chunk_tokens': args.chunk_tokens, 'concurrency': args.concurrency,
+                             'latency': args.latency, 'compact': args.compact}, args.output, args.compare)
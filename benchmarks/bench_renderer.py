@@ -0,0 +1,70 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.synthetic_export import write_export  # noqa: E402
+
+
+def load_messages(messages: int) -> list:
+    from historizer import iter_chat_history
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'result.json')
+        write_export(file_path, messages)
+        return list(iter_chat_history(file_path))
+
+
+def measure(render, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        render()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main(messages: int, chunk_size: int, repeat: int):
+    import renderer
+    from historizer import render_message_with_templates
+
+    history = load_messages(messages)
+    by_id = {message.id: message for message in history}
+    chunks = [history[i:i + chunk_size] for i in range(0, len(history), chunk_size)]
+
+    def resolve_reply(message):
+        return by_id.get(getattr(message, 'reply_to_message_id', None))
+
+    def jinja():
+        return ['\n\n'.join(render_message_with_templates(m, resolve_reply(m)) for m in chunk) for chunk in chunks]
+
+    def per_message():
+        return ['\n\n'.join(renderer.render_message(m, resolve_reply(m)) for m in chunk) for chunk in chunks]
+
+    def batch():
+        return [renderer.render_messages(chunk, resolve_reply) for chunk in chunks]
+
+    if not jinja() == per_message() == batch():
+        raise AssertionError('Renderers produced different text')
+
+    print(f'{"renderer":<12} {"seconds":>8} {"messages/s":>12} {"speedup":>8}')
+    baseline = None
+    for name, render in (('jinja', jinja), ('per-message', per_message), ('batch', batch)):
+        seconds = measure(render, repeat)
+        baseline = baseline or seconds
+        print(f'{name:<12} {seconds:>8.3f} {len(history) / seconds:>12,.0f} {baseline / seconds:>7.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the Jinja message templates with the precompiled renderer')
+    parser.add_argument('-n', '--messages', type=int, default=100_000, help='Number of messages in the synthetic export')
+    parser.add_argument('-c', '--chunk-size', type=int, default=1000, help='Messages per rendered chunk')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs per renderer, the best one is reported')
+
+    args = parser.parse_args()
+
+    main(args.messages, args.chunk_size, args.repeat)
@@ -0,0 +1,114 @@
+import argparse
+import json
+import random
+from datetime import datetime, timedelta
+
+SENDERS = [(f'user{i}', f'Участник {i}') for i in range(300)]
+
+WORDS = (
+    'аниме манга стикер срач модератор бан рейд двач хакер обезьяна чат сообщество мем шутка '
+    'anime manga sticker ban raid meme lol kek ok да нет почему потому что вообще'
+).split()
+
+EMOJIS = ['👍', '😂', '❤', '🔥', '🤔', '😭', '🐒']
+
+SERVICE_ACTIONS = ['invite_members', 'remove_members', 'join_group_by_link', 'pin_message', 'edit_group_title']
+
+
+def make_text(rng: random.Random) -> str | list:
+    words = rng.choices(WORDS, k=max(1, int(rng.expovariate(1 / 12))))
+    text = ' '.join(words)
+    # Telegram exports formatted text as a list of plain strings and entity objects
+    if rng.random() < 0.1:
+        return [text, {'type': 'bold', 'text': rng.choice(WORDS)}]
+    return text
+
+
+def make_message(message_id: int, date: datetime, rng: random.Random) -> dict:
+    date_fields = {
+        'id': message_id,
+        'date': date.strftime('%Y-%m-%dT%H:%M:%S'),
+        'date_unixtime': str(int(date.timestamp())),
+    }
+
+    if rng.random() < 0.03:
+        actor_id, actor = rng.choice(SENDERS)
+        return {
+            **date_fields,
+            'type': 'service',
+            'actor': actor,
+            'actor_id': actor_id,
+            'action': rng.choice(SERVICE_ACTIONS),
+            'text': '',
+            'text_entities': [],
+        }
+
+    sender_id, sender = rng.choice(SENDERS)
+    message = {
+        **date_fields,
+        'type': 'message',
+        'from': sender,
+        'from_id': sender_id,
+        'text': '',
+        'text_entities': [],
+    }
+
+    kind = rng.random()
+    if kind < 0.15:
+        message.update({
+            'file': '(File not included. Change data exporting settings to download.)',
+            'media_type': 'sticker',
+            'sticker_emoji': rng.choice(EMOJIS),
+            'width': 512,
+            'height': 512,
+        })
+    elif kind < 0.2:
+        message.update({
+            'photo': '(File not included. Change data exporting settings to download.)',
+            'width': 1280,
+            'height': 960,
+            'text': make_text(rng),
+        })
+    else:
+        message['text'] = make_text(rng)
+
+    if message_id > 1 and rng.random() < 0.3:
+        message['reply_to_message_id'] = max(1, message_id - int(rng.expovariate(1 / 20)) - 1)
+
+    if rng.random() < 0.1:
+        message['reactions'] = [
+            {'type': 'emoji', 'count': rng.randint(1, 5), 'emoji': emoji}
+            for emoji in rng.sample(EMOJIS, rng.randint(1, 3))
+        ]
+
+    return message
+
+
+def write_export(file_path: str, messages: int, seed: int = 0):
+    """
+    Writes a Telegram-like result.json message by message, so exports of any size can be generated
+    """
+
+    rng = random.Random(seed)
+    date = datetime(2018, 1, 1)
+
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write('{\n "name": "Аниме Ячейка",\n "type": "public_supergroup",\n "id": 1234567890,\n "messages": [\n')
+        for message_id in range(1, messages + 1):
+            date += timedelta(seconds=int(rng.expovariate(1 / 60)))
+            if message_id > 1:
+                file.write(',\n')
+            file.write('  ')
+            file.write(json.dumps(make_message(message_id, date, rng), ensure_ascii=False))
+        file.write('\n ]\n}\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic Telegram chat export')
+    parser.add_argument('path', type=str, help='Path of the result.json to write')
+    parser.add_argument('-n', '--messages', type=int, default=100_000, help='Number of messages')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+
+    args = parser.parse_args()
+
+    write_export(args.path, args.messages, args.seed)
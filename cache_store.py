@@ -0,0 +1,215 @@
+import abc
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable
+
+logger = logging.getLogger(__name__)
+
+CACHE_DB_PATH = 'chat_history/cache/summaries.sqlite3'
+
+# Keeps every IN (...) lookup well under SQLite's limit on query parameters
+LOOKUP_BATCH_SIZE = 500
+
+
+def get_digest(text: str) -> str:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def get_cache_key(cache_inputs: dict) -> str:
+    # The key covers everything a summary depends on, so a changed input, prompt or model misses the cache
+    return get_digest(json.dumps(cache_inputs, sort_keys=True))
+
+
+@dataclass
+class CacheEntry:
+    summary: str
+    kind: str = 'chunk'
+    model: str | None = None
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+    cost: float | None = None
+    inputs: dict | None = None
+
+
+class CacheStore(abc.ABC):
+    """
+    Summary cache keyed by content-derived keys. Subclasses only implement the storage,
+    hits and misses are counted here
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @abc.abstractmethod
+    def lookup(self, keys: list[str]) -> dict[str, str]:
+        ...
+
+    @abc.abstractmethod
+    def put(self, key: str, entry: CacheEntry):
+        ...
+
+    @abc.abstractmethod
+    def evict(self, max_bytes: int) -> int:
+        ...
+
+    @abc.abstractmethod
+    def size(self) -> tuple[int, int]:
+        """
+        Number of entries and total size of the summaries in bytes
+        """
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, str]:
+        keys = list(keys)
+        found = self.lookup(keys) if keys else {}
+        self.hits += len(found)
+        self.misses += len(set(keys)) - len(found)
+        return found
+
+    def get(self, key: str) -> str | None:
+        return self.get_many([key]).get(key)
+
+    def stats(self) -> dict:
+        entries, size = self.size()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
+
+
+class MemoryCacheStore(CacheStore):
+    def __init__(self):
+        super().__init__()
+        # Insertion order doubles as the recency order, see lookup
+        self.entries: dict[str, CacheEntry] = {}
+
+    def lookup(self, keys: list[str]) -> dict[str, str]:
+        found = {}
+        for key in keys:
+            if key in self.entries:
+                self.entries[key] = self.entries.pop(key)
+                found[key] = self.entries[key].summary
+        return found
+
+    def put(self, key: str, entry: CacheEntry):
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+
+    def evict(self, max_bytes: int) -> int:
+        evicted = 0
+        size = self.size()[1]
+        for key in list(self.entries):
+            if size <= max_bytes:
+                break
+            size -= len(self.entries.pop(key).summary.encode('utf-8'))
+            evicted += 1
+        return evicted
+
+    def size(self) -> tuple[int, int]:
+        return len(self.entries), sum(len(entry.summary.encode('utf-8')) for entry in self.entries.values())
+
+
+class SQLiteCacheStore(CacheStore):
+    """
+    All summaries in one SQLite file. Every write is a transaction, so a crash never leaves a truncated
+    summary behind, and the file is only created on first use
+    """
+
+    def __init__(self, path: str = CACHE_DB_PATH):
+        super().__init__()
+        self.path = path
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS summaries (
+                    key TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    model TEXT,
+                    prompt_tokens INTEGER,
+                    completion_tokens INTEGER,
+                    cost REAL,
+                    inputs TEXT,
+                    size INTEGER NOT NULL,
+                    created_at TEXT NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            ''')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS summaries_accessed_at ON summaries (accessed_at)')
+        return self._connection
+
+    def lookup(self, keys: list[str]) -> dict[str, str]:
+        found = {}
+        now = time.time()
+
+        with self.connection:
+            for i in range(0, len(keys), LOOKUP_BATCH_SIZE):
+                batch = keys[i:i + LOOKUP_BATCH_SIZE]
+                placeholders = ', '.join('?' * len(batch))
+                rows = self.connection.execute(
+                    f'SELECT key, summary FROM summaries WHERE key IN ({placeholders})', batch,
+                ).fetchall()
+                found.update(rows)
+                # Recency for the eviction, one statement per batch rather than per hit
+                self.connection.execute(
+                    f'UPDATE summaries SET accessed_at = ? WHERE key IN ({placeholders})', [now, *batch],
+                )
+
+        return found
+
+    def put(self, key: str, entry: CacheEntry):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO summaries (key, summary, kind, model, prompt_tokens, completion_tokens, cost, '
+                'inputs, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    key, entry.summary, entry.kind, entry.model, entry.prompt_tokens, entry.completion_tokens,
+                    entry.cost, json.dumps(entry.inputs, ensure_ascii=False) if entry.inputs is not None else None,
+                    len(entry.summary.encode('utf-8')), datetime.now().isoformat(timespec='seconds'), time.time(),
+                ),
+            )
+
+    def get_entry(self, key: str) -> CacheEntry | None:
+        row = self.connection.execute(
+            'SELECT summary, kind, model, prompt_tokens, completion_tokens, cost, inputs FROM summaries WHERE key = ?',
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        *fields, inputs = row
+        return CacheEntry(*fields, inputs=json.loads(inputs) if inputs is not None else None)
+
+    def evict(self, max_bytes: int) -> int:
+        """
+        Deletes the least recently used summaries until the rest fit into max_bytes
+        """
+
+        with self.connection:
+            # Keeps the newest entries whose running total of sizes is within the budget
+            cursor = self.connection.execute('''
+                DELETE FROM summaries WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, rowid DESC) AS total FROM summaries
+                    ) WHERE total > ?
+                )
+            ''', (max_bytes,))
+
+        if cursor.rowcount:
+            logger.info(f'Evicted {cursor.rowcount} cached summaries to fit into {max_bytes} bytes')
+        return cursor.rowcount
+
+    def size(self) -> tuple[int, int]:
+        entries, size = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM summaries').fetchone()
+        return entries, size
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,52 @@
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, field
+
+from atomic_file import open_atomic
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PATH = 'chat_history/cache/checkpoint.json'
+
+
+@dataclass
+class ChunkRecord:
+    first_id: int
+    last_id: int
+    summary: str
+
+
+@dataclass
+class Checkpoint:
+    """
+    Progress of the historizer over an export: the summaries of the chunks that new messages can no longer
+    change, that is every chunk but the last one
+    """
+
+    chunk_settings: dict
+    chunks: list[ChunkRecord] = field(default_factory=list)
+
+    @property
+    def last_message_id(self) -> int | None:
+        return self.chunks[-1].last_id if self.chunks else None
+
+
+def load_checkpoint(path: str = CHECKPOINT_PATH) -> Checkpoint | None:
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    return Checkpoint(
+        chunk_settings=data['chunk_settings'],
+        chunks=[ChunkRecord(**chunk) for chunk in data['chunks']],
+    )
+
+
+def save_checkpoint(checkpoint: Checkpoint, path: str = CHECKPOINT_PATH):
+    with open_atomic(path) as f:
+        json.dump(asdict(checkpoint), f, ensure_ascii=False)
+
+    logger.info(f'Checkpoint saved: {len(checkpoint.chunks)} chunks up to message {checkpoint.last_message_id}')
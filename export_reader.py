@@ -0,0 +1,112 @@
+import json
+import re
+from typing import Iterator
+
+BUFFER_SIZE = 1 << 20
+
+WHITESPACE_REGEX = re.compile(r'[ \t\n\r]*')
+
+
+class ExportReader:
+    """
+    Incremental reader of a Telegram export (result.json) that decodes one element
+    of the "messages" array at a time, so only a small window of the file is held in memory
+    """
+
+    def __init__(self, file, buffer_size: int = BUFFER_SIZE):
+        self.file = file
+        self.buffer_size = buffer_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+
+        block = self.file.read(self.buffer_size)
+        if not block:
+            self.eof = True
+            return False
+
+        # Drop the consumed part before appending, so the buffer stays about one block long
+        self.buffer = self.buffer[self.pos:] + block
+        self.pos = 0
+        return True
+
+    def skip_whitespace(self):
+        while True:
+            self.pos = WHITESPACE_REGEX.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self.fill():
+                return
+
+    def peek(self) -> str:
+        self.skip_whitespace()
+        if self.pos >= len(self.buffer):
+            raise ValueError('Unexpected end of the export file')
+        return self.buffer[self.pos]
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f'Expected {char!r} at offset {self.pos} of the buffer, got {self.buffer[self.pos]!r}')
+        self.pos += 1
+
+    def decode_value(self):
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+
+            # A number at the very end of the buffer may continue in the next block
+            if end == len(self.buffer) and self.fill():
+                continue
+
+            self.pos = end
+            return value
+
+    def iter_array(self) -> Iterator:
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+
+        while True:
+            yield self.decode_value()
+
+            if self.peek() == ',':
+                self.pos += 1
+                continue
+
+            self.expect(']')
+            return
+
+    def iter_messages(self) -> Iterator[dict]:
+        self.expect('{')
+        if self.peek() == '}':
+            return
+
+        while True:
+            key = self.decode_value()
+            self.expect(':')
+
+            if key == 'messages':
+                yield from self.iter_array()
+            else:
+                self.decode_value()
+
+            if self.peek() == ',':
+                self.pos += 1
+                continue
+
+            self.expect('}')
+            return
+
+
+def iter_raw_messages(file_path: str, buffer_size: int = BUFFER_SIZE) -> Iterator[dict]:
+    with open(file_path, 'r', encoding='utf-8') as file:
+        yield from ExportReader(file, buffer_size).iter_messages()
@@ -1,17 +1,32 @@
+import argparse
 import asyncio
-import hashlib
+import itertools
 import logging
 import os
 import pathlib
+import time
+from dataclasses import dataclass
 from datetime import datetime
+from typing import Callable, Iterable, Iterator
 
 from dotenv import load_dotenv
 from jinja2 import Template
-from langchain.schema import HumanMessage
-from langchain_community.chat_models import ChatOpenAI
 from openai import RateLimitError
 
-from models import ChatHistory, UserMessage, ServiceMessage
+from batch_api import POLL_INTERVAL, BatchRequest, BatchRunner
+from cache_store import (LOOKUP_BATCH_SIZE, CacheEntry, CacheStore, MemoryCacheStore, SQLiteCacheStore, get_cache_key,
+                         get_digest)
+from checkpoint import Checkpoint, ChunkRecord, load_checkpoint, save_checkpoint
+from export_reader import iter_raw_messages
+from llm_backend import Completion, FakeBackend, LLMBackend, OpenAIBackend
+from metrics import METRICS_PATH, Metrics
+from message_store import CompactServiceMessage, CompactUserMessage, MessageStore
+from models import ChatHistory, UserMessage, ServiceMessage, parse_message
+from rate_limiter import UNLIMITED, RateLimiter, is_too_large_error
+import renderer
+from reply_index import DEFAULT_MAX_ENTRIES, ReplyContext, ReplyIndex
+from snapshot import load_or_build_snapshot
+from token_counter import count_tokens, estimate_cost, get_token_budget, truncate_by_tokens
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,10 +38,22 @@ API_HASH = os.getenv('API_HASH')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
 
+CHUNK_MODEL = 'gpt-4.1-nano'
+GROUP_MODEL = 'gpt-4.1-mini'
+FINAL_MODEL = 'gpt-4.1'
+
+CHAT_HISTORY_PATH = 'chat_history/result.json'
 CACHE_DIR = 'chat_history/cache'
 SUMMARY_DIR = 'chat_history/summaries'
 TODAY = datetime.now().strftime('%Y-%m-%d')
 
+# strftime formats of the calendar periods a chunk may not span
+PERIOD_FORMATS = {
+    'day': '%Y-%m-%d',
+    'week': '%G-%V',
+    'month': '%Y-%m',
+}
+
 
 CHUNK_SUMMARY_PROMPT = (
     'Ты — опытный летописец, создающий историю сообщества «Аниме Ячейка».\n'
@@ -130,6 +157,43 @@ SERVICE MESSAGE:
 ''')
 
 
+def render_message_with_templates(message: UserMessage | ServiceMessage,
+                                  reply_to: UserMessage | ServiceMessage | None = None) -> str:
+    """
+    Reference rendering through the Jinja templates, renderer.render_message builds the same text faster
+    """
+
+    if isinstance(message, UserMessage):
+        return USER_MESSAGE_TEMPLATE.render(
+            from_=message.from_,
+            datetime=message.date.strftime("%Y-%m-%d %H:%M:%S"),
+            text=message.text,
+            reply_to=reply_to,
+            reactions=message.reactions,
+            sticker_emoji=message.sticker_emoji,
+            photo=message.photo,
+        )
+    elif isinstance(message, ServiceMessage):
+        return SERVICE_MESSAGE_TEMPLATE.render(
+            datetime=message.date.strftime("%Y-%m-%d %H:%M:%S"),
+            action=message.action,
+            actor=message.actor,
+        )
+    else:
+        raise ValueError(f'Unknown message type: {type(message)}')
+
+
+def get_prompt_version(prompt: str) -> str:
+    # The date of the run is part of the group and final prompts, but must not invalidate every summary daily
+    return get_digest(prompt.replace(TODAY, ''))[:12]
+
+
+# Any edit of a prompt changes its version and so the cache keys of every summary made with it
+CHUNK_PROMPT_VERSION = get_prompt_version(CHUNK_SUMMARY_PROMPT)
+GROUP_PROMPT_VERSION = get_prompt_version(GROUP_SUMMARY_PROMPT)
+FINAL_PROMPT_VERSION = get_prompt_version(FINAL_SUMMARY_PROMPT)
+
+
 def ensure_dirs_exist():
     pathlib.Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
     pathlib.Path(SUMMARY_DIR).mkdir(parents=True, exist_ok=True)
@@ -143,6 +207,20 @@ async def load_chat_history(file_path: str) -> ChatHistory:
     return chat_history
 
 
+def iter_chat_history(file_path: str) -> Iterator[UserMessage | ServiceMessage]:
+    """
+    Yields messages one by one while the export is being parsed, unlike load_chat_history
+    which holds the raw text and every parsed message in memory at once
+    """
+
+    logger.info(f'Streaming chat history from {file_path}')
+    count = 0
+    for message_data in iter_raw_messages(file_path):
+        yield parse_message(message_data)
+        count += 1
+    logger.info(f'Chat history streamed: {count} messages')
+
+
 async def split_chat_history(chat_history: list, chunk_size: int = 10000) -> list:
     logger.info(f'Splitting chat history into chunks of size {chunk_size}')
     chunks = [chat_history[i:i + chunk_size] for i in range(0, len(chat_history), chunk_size)]
@@ -150,104 +228,254 @@ async def split_chat_history(chat_history: list, chunk_size: int = 10000) -> lis
     return chunks
 
 
-class Historizer:
-    chunk_size: int
-    messages_dict = {}
-
-    def __init__(self, chunk_size: int = 10000):
-        self.chunk_size = chunk_size
-        ensure_dirs_exist()
+class RenderedChunk(list):
+    """
+    Messages of a chunk along with the texts they were rendered to while packing, so the prompt of the chunk
+    is joined from them instead of rendering every message again
+    """
+
+    def __init__(self, messages: Iterable = (), texts: list[str] | None = None):
+        super().__init__(messages)
+        self.texts = texts if texts is not None else []
+
+
+def iter_chunks_by_tokens(messages: Iterable, render: Callable[[UserMessage | ServiceMessage], str],
+                          max_tokens: int, max_messages: int | None = None,
+                          period: str | None = None) -> Iterator[RenderedChunk]:
+    """
+    Greedily packs rendered messages into chunks of at most max_tokens tokens.
+    Boundaries depend only on the messages and the tokenizer, so they are stable between runs.
+    A message that alone exceeds the budget gets a chunk of its own.
+    With a period ('day', 'week' or 'month') a chunk never spans two calendar periods
+    """
+
+    period_format = PERIOD_FORMATS[period] if period else None
+    chunk = RenderedChunk()
+    chunk_tokens = 0
+    chunk_period = None
+
+    for message in messages:
+        text = render(message)
+        # +1 for the blank line that separates rendered messages in the prompt
+        message_tokens = count_tokens(text) + 1
+        message_period = message.date.strftime(period_format) if period_format else None
+
+        if chunk and (chunk_tokens + message_tokens > max_tokens or len(chunk) == max_messages
+                      or message_period != chunk_period):
+            yield chunk
+            chunk = RenderedChunk()
+            chunk_tokens = 0
+
+        chunk.append(message)
+        chunk.texts.append(text)
+        chunk_tokens += message_tokens
+        chunk_period = message_period
+
+    if chunk:
+        yield chunk
+
+
+async def split_chat_history_by_tokens(chat_history: Iterable, render: Callable[[UserMessage | ServiceMessage], str],
+                                       max_tokens: int, max_messages: int | None = None, period: str | None = None) -> list:
+    logger.info(f'Splitting chat history into chunks of up to {max_tokens} tokens')
+    chunks = list(iter_chunks_by_tokens(chat_history, render, max_tokens, max_messages, period))
+    logger.info(f'Chat history split into {len(chunks)} chunks')
+    return chunks
 
-    def render_message(self, message: UserMessage | ServiceMessage) -> str:
-        self.messages_dict[message.id] = message
-
-        if isinstance(message, UserMessage):
-            reply_to = self.messages_dict.get(message.reply_to_message_id, None) if message.reply_to_message_id else None
-            return USER_MESSAGE_TEMPLATE.render(
-                from_=message.from_,
-                datetime=message.date.strftime("%Y-%m-%d %H:%M:%S"),
-                text=message.text,
-                reply_to=reply_to,
-                reactions=message.reactions,
-                sticker_emoji=message.sticker_emoji,
-                photo=message.photo,
-            )
-        elif isinstance(message, ServiceMessage):
-            return SERVICE_MESSAGE_TEMPLATE.render(
-                datetime=message.date.strftime("%Y-%m-%d %H:%M:%S"),
-                action=message.action,
-                actor=message.actor,
-            )
-        else:
-            raise ValueError(f'Unknown message type: {type(message)}')
 
-    def get_chunk_hash(self, chunk: list) -> str:
-        # Use first and last messages to identify a chunk
-        first_msg = chunk[0]
-        last_msg = chunk[-1]
-        chunk_id = f"{first_msg.id}_{last_msg.id}_{len(chunk)}"
-        return hashlib.md5(chunk_id.encode()).hexdigest()
+@dataclass
+class PreparedChunk:
+    chunk: list
+    documents: str
+    chunk_hash: str
+    inputs: dict
 
-    def get_cache_path(self, chunk_hash: str) -> str:
-        return os.path.join(CACHE_DIR, f"chunk_{chunk_hash}.txt")
 
-    def is_cached(self, chunk_hash: str) -> bool:
-        cache_path = self.get_cache_path(chunk_hash)
-        return os.path.exists(cache_path)
+class Historizer:
+    chunk_size: int | None
+    chunk_tokens: int | None
+    concurrency: int
+    period: str | None
+    group_size: int
+    incremental: bool
+
+    def __init__(self, chunk_size: int | None = None, chunk_tokens: int | None = None, concurrency: int = 8,
+                 rate_limiter: RateLimiter | None = None, period: str | None = None, group_size: int = 70,
+                 incremental: bool = False, cache: CacheStore | None = None, cache_max_mb: float | None = None,
+                 group_concurrency: int | None = None, reply_index_size: int = DEFAULT_MAX_ENTRIES,
+                 reply_id_window: int | None = None, compact: bool = False, snapshot: bool = False,
+                 batch: bool = False, batch_poll_interval: float = POLL_INTERVAL,
+                 backend_factory: Callable[[str], LLMBackend] | None = None, metrics: Metrics | None = None):
+        # chunk_size caps the number of messages per chunk, chunk_tokens overrides the budget derived from the chunk model
+        self.chunk_size = chunk_size
+        self.chunk_tokens = chunk_tokens
+        self.concurrency = concurrency
+        # period keeps chunks within calendar periods, see iter_chunks_by_tokens
+        self.period = period
+        # Caps the fan-in of the reduce tree, see summarize_tree
+        self.group_size = group_size
+        # An incremental run resumes from the checkpoint of the previous run and only summarizes the new tail
+        self.incremental = incremental
+        self.cache = cache or SQLiteCacheStore()
+        # The cache is trimmed to this size at the end of every run, least recently used summaries first
+        self.cache_max_mb = cache_max_mb
+        # Reply context is kept for at most reply_index_size messages, or those within reply_id_window of the newest
+        self.reply_index_size = reply_index_size
+        self.reply_id_window = reply_id_window
+        self.replies = ReplyIndex(reply_index_size, reply_id_window)
+        # A compact run loads the export into a MessageStore, which also serves the reply context
+        self.compact = compact
+        # The store is mapped from a binary snapshot of the export, built by the first run, see snapshot.py
+        self.snapshot = snapshot
+        self.store: MessageStore | None = None
+        # Uncached chunks go through the Batch API before the live pass, which only gets the requests the batch failed
+        self.batch = batch
+        self.batch_poll_interval = batch_poll_interval
+        # Bounds the number of chat model requests in flight at once
+        self.llm_semaphore = asyncio.Semaphore(concurrency)
+        # Group summaries are bigger and go to another model, so they get a limit of their own
+        self.group_concurrency = group_concurrency or concurrency
+        self.group_semaphore = asyncio.Semaphore(self.group_concurrency)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        # Makes the backend of a model name, OpenAI's by default
+        self.backend_factory = backend_factory
+        # Disabled unless it is given a metrics file or a progress bar to report to
+        self.metrics = metrics or Metrics()
+        ensure_dirs_exist()
 
-    def load_from_cache(self, chunk_hash: str) -> str:
-        cache_path = self.get_cache_path(chunk_hash)
-        if not os.path.exists(cache_path):
-            raise FileNotFoundError(f"Cache file not found: {cache_path}")
+    def make_backend(self, model: str) -> LLMBackend:
+        if self.backend_factory is not None:
+            return self.backend_factory(model)
+        return OpenAIBackend(model, api_key=OPENAI_API_KEY)
 
-        with open(cache_path, 'r', encoding='utf-8') as f:
-            data = f.read()
+    def resolve_reply(self, message) -> ReplyContext | CompactUserMessage | CompactServiceMessage | None:
+        reply_to_message_id = getattr(message, 'reply_to_message_id', None)
 
-        return data
+        if self.store is not None:
+            # The store holds the whole export, any message can be looked up by id
+            return self.store.get(reply_to_message_id) if reply_to_message_id else None
 
-    def save_to_cache(self, chunk_hash: str, summary: str):
-        cache_path = self.get_cache_path(chunk_hash)
+        # Every rendered message is remembered as the possible reply context of the later ones
+        self.replies.add(message)
+        return self.replies.get(reply_to_message_id) if reply_to_message_id else None
 
-        with open(cache_path, 'w', encoding='utf-8') as f:
-            f.write(summary)
+    def render_message(self, message: UserMessage | ServiceMessage) -> str:
+        with self.metrics.timer('render'):
+            return renderer.render_message(message, self.resolve_reply(message))
+
+    def render_chunk(self, chunk: list) -> str:
+        with self.metrics.timer('render'):
+            if isinstance(chunk, RenderedChunk) and len(chunk.texts) == len(chunk):
+                # Rendered while packing, resolving the replies again would also add the messages to the index twice
+                return renderer.MESSAGE_SEPARATOR.join(chunk.texts)
+            return renderer.render_messages(chunk, self.resolve_reply)
+
+    def get_cache_inputs(self, documents: str, chat_model: LLMBackend, prompt_version: str = CHUNK_PROMPT_VERSION) -> dict:
+        return {
+            'content_digest': get_digest(documents),
+            'prompt_version': prompt_version,
+            'model': chat_model.cache_model,
+            'temperature': getattr(chat_model, 'temperature', None),
+        }
+
+    def get_chunk_hash(self, cache_inputs: dict) -> str:
+        return get_cache_key(cache_inputs)
+
+    async def invoke_chat_model(self, chat_model: LLMBackend, content: str, stage: str = 'chunk') -> Completion:
+        attempts = 0
+
+        async def call() -> Completion:
+            nonlocal attempts
+            attempts += 1
+            return await chat_model.complete(content)
+
+        started = time.perf_counter()
+        try:
+            completion = await self.rate_limiter.run(chat_model.model_name, call, chat_model.count_tokens(content))
+        except Exception as e:
+            self.metrics.record_call(stage, chat_model.model_name, time.perf_counter() - started, attempts - 1,
+                                     error=type(e).__name__)
+            raise
+
+        # Backends that do not report usage get it counted here
+        if completion.prompt_tokens is None or completion.completion_tokens is None:
+            completion.prompt_tokens = chat_model.count_tokens(content)
+            completion.completion_tokens = chat_model.count_tokens(completion.text)
+        self.metrics.record_call(stage, chat_model.model_name, time.perf_counter() - started, attempts - 1,
+                                 completion.prompt_tokens, completion.completion_tokens)
+        return completion
+
+    def prepare_chunk(self, chunk: list, chat_model) -> PreparedChunk:
+        documents = self.render_chunk(chunk)
+        cache_inputs = self.get_cache_inputs(documents, chat_model)
+        return PreparedChunk(
+            chunk=chunk,
+            documents=documents,
+            chunk_hash=self.get_chunk_hash(cache_inputs),
+            inputs={**cache_inputs, 'first_id': chunk[0].id, 'last_id': chunk[-1].id, 'messages': len(chunk)},
+        )
+
+    def save_to_cache(self, chunk_hash: str, summary: str, model: str, inputs: dict,
+                      completion: Completion | None = None, kind: str = 'chunk'):
+        # The completion is absent for a combined summary of a split chunk, its halves are cached with their own costs
+        prompt_tokens = completion.prompt_tokens if completion is not None else None
+        completion_tokens = completion.completion_tokens if completion is not None else None
+        self.cache.put(chunk_hash, CacheEntry(
+            summary=summary,
+            kind=kind,
+            model=model,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cost=estimate_cost(model, prompt_tokens, completion_tokens) if completion is not None else None,
+            inputs=inputs,
+        ))
 
     async def summarize_chunk(self, chunk: list, chat_model) -> str:
-        chunk_hash = self.get_chunk_hash(chunk)
+        prepared = self.prepare_chunk(chunk, chat_model)
 
-        if self.is_cached(chunk_hash):
-            logger.info(f'Using cached summary for chunk with hash {chunk_hash}')
-            return self.load_from_cache(chunk_hash)
+        summary = self.cache.get(prepared.chunk_hash)
+        if summary is not None:
+            logger.info(f'Using cached summary for chunk with hash {prepared.chunk_hash}')
+            return summary
 
-        logger.info(f'Summarizing chunk of size {len(chunk)} with hash {chunk_hash}')
+        return await self.summarize_prepared_chunk(prepared, chat_model)
 
-        try:
-            messages_content = [self.render_message(msg) for msg in chunk]
-            content = CHUNK_SUMMARY_PROMPT.format(documents='\n\n'.join(messages_content))
-            messages = [HumanMessage(content=content)]
-            response = await chat_model.ainvoke(messages)
-            summary = response.content
+    async def summarize_prepared_chunk(self, prepared: PreparedChunk, chat_model) -> str:
+        chunk = prepared.chunk
+        chunk_hash = prepared.chunk_hash
 
-            self.save_to_cache(chunk_hash, summary)
+        try:
+            # The slot is released before the except branch, so both halves of a split chunk can take their own slots
+            async with self.llm_semaphore:
+                logger.info(f'Summarizing chunk of size {len(chunk)} with hash {chunk_hash}')
+                content = CHUNK_SUMMARY_PROMPT.format(documents=prepared.documents)
+                completion = await self.invoke_chat_model(chat_model, content)
+                summary = completion.text
+
+            self.save_to_cache(chunk_hash, summary, chat_model.model_name, prepared.inputs, completion)
             logger.info('Chunk summarized successfully and cached')
 
         except RateLimitError as e:
-            error_message = str(e).lower()
-
-            if 'too large' in error_message:
+            if is_too_large_error(e):
                 logger.warning(f'Chunk too large for context window, splitting in half: {e}')
 
                 middle = len(chunk) // 2
                 first_half = chunk[:middle]
                 second_half = chunk[middle:]
+                if isinstance(chunk, RenderedChunk):
+                    first_half = RenderedChunk(first_half, chunk.texts[:middle])
+                    second_half = RenderedChunk(second_half, chunk.texts[middle:])
 
                 logger.info(f'Splitting chunk of size {len(chunk)} into two chunks of sizes {len(first_half)} and {len(second_half)}')
 
-                first_summary = await self.summarize_chunk(first_half, chat_model)
-                second_summary = await self.summarize_chunk(second_half, chat_model)
+                first_summary, second_summary = await asyncio.gather(
+                    self.summarize_chunk(first_half, chat_model),
+                    self.summarize_chunk(second_half, chat_model),
+                )
 
                 summary = f"{first_summary}\n\n{second_summary}"
 
-                self.save_to_cache(chunk_hash, summary)
+                self.save_to_cache(chunk_hash, summary, chat_model.model_name, prepared.inputs)
 
                 logger.info('Split chunks summarized successfully and combined result cached')
             else:
@@ -256,13 +484,80 @@ class Historizer:
 
         return summary
 
+    async def summarize_chunks(self, chunks: Iterable[list], chat_model) -> list:
+        """
+        Chunks may come from a lazy iterable: only a window of about twice the concurrency is pulled
+        ahead of the chunks being summarized, so the export is never held in memory as a whole.
+        The chunks pulled at once are looked up in the cache with a single query
+        """
+
+        logger.info(f'Summarizing chunks with concurrency {self.concurrency}')
+
+        # Results are stored by chunk index, which keeps them in chronological order regardless of completion order
+        summaries = []
+        pending = set()
+        window = 2 * self.concurrency
+        chunks = iter(chunks)
+
+        async def summarize(i: int, prepared: PreparedChunk):
+            summaries[i] = await self.summarize_prepared_chunk(prepared, chat_model)
+            self.metrics.record_summary('chunk', cached=False, index=i, messages=len(prepared.chunk))
+            logger.info(f'Chunk {i + 1} summarized')
+
+        try:
+            while True:
+                batch = []
+                for chunk in itertools.islice(chunks, window - len(pending)):
+                    batch.append(self.prepare_chunk(chunk, chat_model))
+                    # Parsing and rendering a chunk is synchronous, the requests in flight and the rate limiter's
+                    # timers get the loop back between chunks. Not a thread: the reply index and the store are
+                    # SQLite connections bound to this one
+                    await asyncio.sleep(0)
+                if not batch:
+                    break
+
+                cached = self.cache.get_many(prepared.chunk_hash for prepared in batch)
+                for prepared in batch:
+                    summaries.append(cached.get(prepared.chunk_hash))
+                    if prepared.chunk_hash in cached:
+                        logger.info(f'Using cached summary for chunk {len(summaries)} with hash {prepared.chunk_hash}')
+                        self.metrics.record_summary('chunk', cached=True, index=len(summaries) - 1,
+                                                    messages=len(prepared.chunk))
+                    else:
+                        pending.add(asyncio.create_task(summarize(len(summaries) - 1, prepared)))
+
+                if len(pending) >= window:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        task.result()
+
+            await asyncio.gather(*pending)
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            raise
+
+        logger.info(f'{len(summaries)} chunks summarized, cache stats: {self.cache.stats()}')
+        return summaries
+
+    def get_reduce_key(self, summaries: list[str], prompt_version: str, chat_model) -> tuple[str, dict]:
+        cache_inputs = self.get_cache_inputs('\n\n'.join(summaries), chat_model, prompt_version)
+        return get_cache_key(cache_inputs), {**cache_inputs, 'summaries': len(summaries)}
+
     async def summarize_final(self, summarized_chunks: list, chat_model) -> str:
         logger.info('Summarizing final history from summarized chunks')
-        summaries_content = '\n\n'.join(summarized_chunks)
-        content = FINAL_SUMMARY_PROMPT.format(summaries=summaries_content)
-        messages = [HumanMessage(content=content)]
-        response = await chat_model.ainvoke(messages)
-        final_summary = response.content
+        final_key, final_inputs = self.get_reduce_key(summarized_chunks, FINAL_PROMPT_VERSION, chat_model)
+
+        final_summary = self.cache.get(final_key)
+        self.metrics.record_summary('final', cached=final_summary is not None)
+        if final_summary is not None:
+            logger.info(f'Using cached final summary with hash {final_key}')
+        else:
+            summaries_content = '\n\n'.join(summarized_chunks)
+            content = FINAL_SUMMARY_PROMPT.format(summaries=summaries_content)
+            completion = await self.invoke_chat_model(chat_model, content, stage='final')
+            final_summary = completion.text
+            self.save_to_cache(final_key, final_summary, chat_model.model_name, final_inputs, completion, kind='final')
 
         final_summary_path = os.path.join(SUMMARY_DIR, "final_summary.txt")
         with open(final_summary_path, 'w', encoding='utf-8') as f:
@@ -271,63 +566,302 @@ class Historizer:
         logger.info(f'Final summary created and saved to {final_summary_path}')
         return final_summary
 
-    async def summarize_final_in_groups(self, summarized_chunks: list, group_chat_model, final_chat_model, group_size=100) -> str:
-        logger.info('Summarizing final history from summarized chunks in groups')
+    async def summarize_groups(self, groups: list[list[str]], group_chat_model, level: int = 1) -> list[str]:
+        """
+        Groups are summarized concurrently and cached under a key derived from their member summaries,
+        so only the changed ones are summarized again
+        """
 
-        groups = [summarized_chunks[i:i + group_size] for i in range(0, len(summarized_chunks), group_size)]
+        group_keys = [self.get_reduce_key(group, GROUP_PROMPT_VERSION, group_chat_model) for group in groups]
+        cached = self.cache.get_many(key for key, _ in group_keys)
 
-        logger.info(f'Split {len(summarized_chunks)} chunks into {len(groups)} groups')
+        to_summarize = len(groups) - len(cached)
+        logger.info(f'Level {level}: {len(groups)} groups, {len(cached)} cached, {to_summarize} to summarize '
+                    f'with concurrency {self.group_concurrency}')
+
+        started = time.perf_counter()
+        summarized = 0
+
+        async def summarize(i: int, group: list[str]) -> str:
+            nonlocal summarized
+            group_key, group_inputs = group_keys[i]
 
-        group_summaries = []
-        for i, group in enumerate(groups):
-            logger.info(f'Summarizing group {i + 1}/{len(groups)}')
-            group_summaries_content = '\n\n'.join(group)
-            group_content = GROUP_SUMMARY_PROMPT.format(summaries=group_summaries_content)
-            group_messages = [HumanMessage(content=group_content)]
+            if group_key in cached:
+                logger.info(f'Using cached summary for group {i + 1}/{len(groups)} of level {level}')
+                self.metrics.record_summary('group', cached=True, level=level, index=i)
+                return cached[group_key]
 
-            group_response = await group_chat_model.ainvoke(group_messages)
-            group_summary = group_response.content
-            group_summaries.append(group_summary)
+            async with self.group_semaphore:
+                logger.info(f'Summarizing group {i + 1}/{len(groups)} of level {level}')
+                group_summaries_content = '\n\n'.join(group)
+                group_content = GROUP_SUMMARY_PROMPT.format(summaries=group_summaries_content)
+                completion = await self.invoke_chat_model(group_chat_model, group_content, stage='group')
+                group_summary = completion.text
 
-            group_summary_path = os.path.join(SUMMARY_DIR, f"group_summary_{i + 1}.txt")
+            self.save_to_cache(group_key, group_summary, group_chat_model.model_name, group_inputs, completion,
+                               kind='group')
+            self.metrics.record_summary('group', cached=False, level=level, index=i)
+
+            group_summary_path = os.path.join(SUMMARY_DIR, f"group_summary_{level}_{i + 1}.txt")
             with open(group_summary_path, 'w', encoding='utf-8') as f:
                 f.write(group_summary)
 
-        final_summaries_content = '\n\n'.join(group_summaries)
-        final_content = FINAL_SUMMARY_PROMPT.format(summaries=final_summaries_content)
-        final_messages = [HumanMessage(content=final_content)]
+            summarized += 1
+            logger.info(f'Level {level}: {summarized}/{to_summarize} groups summarized '
+                        f'in {time.perf_counter() - started:.1f}s, group {i + 1} done')
+            return group_summary
 
-        final_response = await final_chat_model.ainvoke(final_messages)
-        final_summary = final_response.content
+        # gather keeps the results in the order of the groups, whatever order they complete in
+        return list(await asyncio.gather(*(summarize(i, group) for i, group in enumerate(groups))))
 
-        final_summary_path = os.path.join(SUMMARY_DIR, "final_summary.txt")
-        with open(final_summary_path, 'w', encoding='utf-8') as f:
-            f.write(final_summary)
+    async def summarize_final_in_groups(self, summarized_chunks: list, group_chat_model, final_chat_model, group_size=100) -> str:
+        logger.info('Summarizing final history from summarized chunks in groups')
 
-        logger.info(f'Final summary created and saved to {final_summary_path}')
-        return final_summary
+        groups = [summarized_chunks[i:i + group_size] for i in range(0, len(summarized_chunks), group_size)]
+        logger.info(f'Split {len(summarized_chunks)} chunks into {len(groups)} groups')
 
-    async def run(self):
-        chat_history = await load_chat_history('chat_history/result.json')
-        chat_history_chunks = await split_chat_history(chat_history.messages, chunk_size=self.chunk_size)
+        group_summaries = await self.summarize_groups(groups, group_chat_model)
+        return await self.summarize_final(group_summaries, final_chat_model)
+
+    async def summarize_tree(self, summaries: list[str], group_chat_model, final_chat_model,
+                             group_tokens: int | None = None, final_tokens: int | None = None) -> str:
+        """
+        Reduces the summaries level by level until they fit into a single request to the final model.
+        The fan-in of every level is as many summaries as fit the group model's budget, at most group_size.
+        Short histories go to the final model directly, without a group level
+        """
+
+        group_tokens = group_tokens or get_token_budget(group_chat_model.model_name, GROUP_SUMMARY_PROMPT,
+                                                        group_chat_model.context_tokens)
+        final_tokens = final_tokens or get_token_budget(final_chat_model.model_name, FINAL_SUMMARY_PROMPT,
+                                                        final_chat_model.context_tokens)
+
+        level = 0
+        while len(summaries) > 1 and count_tokens('\n\n'.join(summaries)) > final_tokens:
+            level += 1
+            # Greedy packing keeps the leading groups stable when summaries are appended, so they stay cached
+            groups = list(iter_chunks_by_tokens(summaries, str, group_tokens, self.group_size))
+
+            if len(groups) == len(summaries):
+                # As the summarizer merges: summaries cut to half the budget (with their separator) fit at least in pairs,
+                # so every level shrinks and no group is over the context of the model
+                logger.warning(f'Summaries of level {level} do not fit the group budget of {group_tokens} tokens '
+                               f'in pairs, truncating them to half of it')
+                summaries = [truncate_by_tokens(summary, group_tokens // 2 - 1) for summary in summaries]
+                groups = list(iter_chunks_by_tokens(summaries, str, group_tokens, max(2, self.group_size)))
+
+            logger.info(f'Reducing {len(summaries)} summaries into {len(groups)} groups at level {level}')
+            with self.metrics.span('level', level=level, groups=len(groups)):
+                summaries = await self.summarize_groups(groups, group_chat_model, level)
+
+        return await self.summarize_final(summaries, final_chat_model)
+
+    def get_chunk_settings(self, chunk_tokens: int, chat_model) -> dict:
+        return {
+            'chunk_tokens': chunk_tokens,
+            'chunk_size': self.chunk_size,
+            'period': self.period,
+            'prompt_version': CHUNK_PROMPT_VERSION,
+            'model': chat_model.cache_model,
+            'temperature': getattr(chat_model, 'temperature', None),
+        }
+
+    def load_resumable_checkpoint(self, chunk_settings: dict) -> Checkpoint | None:
+        checkpoint = load_checkpoint()
+
+        if checkpoint is None:
+            logger.info('No checkpoint found, processing the whole export')
+            return None
+
+        if checkpoint.chunk_settings != chunk_settings:
+            # Chunk boundaries or summaries would differ from the ones in the checkpoint
+            logger.info('Chunk settings changed since the checkpoint, processing the whole export')
+            return None
+
+        logger.info(f'Resuming after message {checkpoint.last_message_id}: '
+                    f'{len(checkpoint.chunks)} chunks are already summarized')
+        return checkpoint
+
+    def skip_processed(self, messages: Iterable, last_message_id: int) -> Iterator[UserMessage | ServiceMessage]:
+        for message in messages:
+            if message.id <= last_message_id:
+                # Not rendered again, but still needed as the reply context of the new messages
+                self.replies.add(message)
+                continue
+            yield message
+
+    def iter_new_chunks(self, chunk_tokens: int, last_message_id: int | None = None) -> Iterator[list]:
+        """
+        Chunks of the messages after last_message_id, every call starts over from the beginning of the export
+        """
+
+        self.replies.close()
+        self.replies = ReplyIndex(self.reply_index_size, self.reply_id_window)
+
+        if self.store is not None:
+            chat_history = self.store.iter_rows(self.store.rows_after(last_message_id) if last_message_id else 0)
+        else:
+            chat_history = iter_chat_history(CHAT_HISTORY_PATH)
+            if last_message_id is not None:
+                chat_history = self.skip_processed(chat_history, last_message_id)
+
+        # Parsing, rendering and packing interleave, the timers tell them apart
+        chunks = iter_chunks_by_tokens(self.metrics.timed('load', chat_history), self.render_message, chunk_tokens,
+                                       self.chunk_size, self.period)
+        return self.metrics.timed('split', chunks)
+
+    async def summarize_chunks_in_batch(self, chunks: Iterable[list], chat_model) -> int:
+        """
+        Sends every chunk missing from the cache to the Batch API and caches the summaries that come back.
+        Batches submitted by an interrupted run are collected first and their chunks are not submitted again
+        """
+
+        client = chat_model.batch_client
+        if client is None:
+            raise ValueError(f'The backend of {chat_model.model_name} does not support the Batch API')
+        runner = BatchRunner(client, self.cache, poll_interval=self.batch_poll_interval, metrics=self.metrics)
+        resumed = await runner.resume()
+
+        def iter_requests() -> Iterator[BatchRequest]:
+            chunks_iter = iter(chunks)
+            # Chunks are looked up in the cache as many at once as a single query takes
+            while prepared_chunks := [self.prepare_chunk(chunk, chat_model)
+                                      for chunk in itertools.islice(chunks_iter, LOOKUP_BATCH_SIZE)]:
+                cached = self.cache.get_many(prepared.chunk_hash for prepared in prepared_chunks)
+                for prepared in prepared_chunks:
+                    if prepared.chunk_hash in cached or prepared.chunk_hash in resumed:
+                        continue
+                    yield BatchRequest(
+                        custom_id=prepared.chunk_hash,
+                        model=chat_model.model_name,
+                        temperature=getattr(chat_model, 'temperature', None),
+                        prompt=CHUNK_SUMMARY_PROMPT.format(documents=prepared.documents),
+                        inputs=prepared.inputs,
+                    )
+
+        return await runner.run(iter_requests())
 
-        chunks_chat_model = ChatOpenAI(model='gpt-4.1-nano', temperature=0.3, api_key=OPENAI_API_KEY)
-        groups_chat_model = ChatOpenAI(model='gpt-4.1-mini', temperature=0.3, api_key=OPENAI_API_KEY)
-        final_chat_model = ChatOpenAI(model='gpt-4.1', temperature=0.3, api_key=OPENAI_API_KEY)
+    async def run(self):
+        try:
+            return await self.summarize_history()
+        finally:
+            # A failed run keeps the totals of what it did and spent
+            self.replies.close()
+            self.metrics.close()
+
+    async def summarize_history(self):
+        chunks_chat_model = self.make_backend(CHUNK_MODEL)
+        groups_chat_model = self.make_backend(GROUP_MODEL)
+        final_chat_model = self.make_backend(FINAL_MODEL)
         logger.info('Chat models initialized')
 
-        summarized_chunks = []
-        for i, chunk in enumerate(chat_history_chunks):
-            logger.info(f'Summarizing chunk {i + 1}/{len(chat_history_chunks)}')
-            chunk_summary = await self.summarize_chunk(chunk, chunks_chat_model)
-            summarized_chunks.append(chunk_summary)
+        if self.batch and chunks_chat_model.batch_client is None:
+            # Checked before any work, a stand-in backend must never lead to paid batches
+            raise ValueError(f'The backend of {CHUNK_MODEL} does not support the Batch API')
+
+        chunk_tokens = self.chunk_tokens or get_token_budget(CHUNK_MODEL, CHUNK_SUMMARY_PROMPT,
+                                                             chunks_chat_model.context_tokens)
+
+        chunk_settings = self.get_chunk_settings(chunk_tokens, chunks_chat_model)
+        checkpoint = self.load_resumable_checkpoint(chunk_settings) if self.incremental else None
+        done_chunks = checkpoint.chunks if checkpoint else []
+        last_message_id = done_chunks[-1].last_id if done_chunks else None
+
+        with self.metrics.timer('load'):
+            if self.snapshot:
+                self.store = load_or_build_snapshot(CHAT_HISTORY_PATH)
+            elif self.compact:
+                self.store = MessageStore.from_export(CHAT_HISTORY_PATH)
+
+        if self.batch:
+            with self.metrics.span('batch') as span:
+                span['summaries'] = await self.summarize_chunks_in_batch(
+                    self.iter_new_chunks(chunk_tokens, last_message_id), chunks_chat_model)
+
+        # Chunks are produced lazily while the export is being parsed
+        chunk_bounds = []
+        chat_history_chunks = self.iter_new_chunks(chunk_tokens, last_message_id)
+
+        def track_bounds(chunks: Iterable[list]) -> Iterator[list]:
+            for chunk in chunks:
+                chunk_bounds.append((chunk[0].id, chunk[-1].id))
+                yield chunk
+
+        with self.metrics.span('chunks') as span:
+            new_summaries = await self.summarize_chunks(track_bounds(chat_history_chunks), chunks_chat_model)
+            span['summaries'] = len(new_summaries)
+        summarized_chunks = [chunk.summary for chunk in done_chunks] + new_summaries
+
+        # The last chunk stays open: the next export may append messages to it
+        chunks = done_chunks + [ChunkRecord(first_id, last_id, summary)
+                                for (first_id, last_id), summary in zip(chunk_bounds, new_summaries)][:-1]
+        save_checkpoint(Checkpoint(chunk_settings, chunks))
+
+        # Groups are cached by content, so only the ones that take in new chunks are summarized again
+        with self.metrics.span('reduce', summaries=len(summarized_chunks)):
+            final_summary = await self.summarize_tree(summarized_chunks, groups_chat_model, final_chat_model)
+
+        if self.cache_max_mb is not None:
+            self.cache.evict(int(self.cache_max_mb * 1024 * 1024))
 
-        final_summary = await self.summarize_final_in_groups(summarized_chunks, groups_chat_model, final_chat_model, 70)
+        if self.store is None:
+            logger.info(f'Reply index: {len(self.replies)} messages in memory, '
+                        f'{self.replies.spill_hits} replies resolved from the spill table')
 
         logger.info('All processing completed successfully')
         return final_summary
 
 
 if __name__ == '__main__':
-    historizer = Historizer(chunk_size=6000)
+    parser = argparse.ArgumentParser(description='Telegram chat history historizer')
+    parser.add_argument('-c', '--chunk-size', type=int, help='Maximum number of messages per chunk')
+    parser.add_argument('-t', '--chunk-tokens', type=int,
+                        help='Token budget per chunk (derived from the chunk model by default)')
+    parser.add_argument('-j', '--concurrency', type=int, default=8, help='Maximum number of chat model requests in flight')
+    parser.add_argument('-p', '--period', choices=list(PERIOD_FORMATS), help='Never let a chunk span two calendar periods')
+    parser.add_argument('--group-concurrency', type=int, help='Maximum number of group summary requests in flight '
+                                                              '(same as --concurrency by default)')
+    parser.add_argument('-g', '--group-size', type=int, default=70, help='Maximum number of summaries per group summary')
+    parser.add_argument('--incremental', action='store_true', help='Only summarize messages added since the previous run')
+    parser.add_argument('--reply-index-size', type=int, default=DEFAULT_MAX_ENTRIES,
+                        help='Messages kept in memory as reply context, older ones are spilled to disk')
+    parser.add_argument('--reply-id-window', type=int,
+                        help='Keep reply context in memory only for messages within this many ids of the newest one')
+    parser.add_argument('--compact', action='store_true',
+                        help='Load the export into a compact columnar store instead of parsing it into Pydantic models')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='Map the compact store from a binary snapshot of the export, rebuilt when the export changes')
+    parser.add_argument('--batch', action='store_true',
+                        help='Summarize uncached chunks through the OpenAI Batch API at half the price, '
+                             'waiting for the batches to complete')
+    parser.add_argument('--batch-poll-interval', type=float, default=POLL_INTERVAL,
+                        help='Seconds between batch status checks')
+    parser.add_argument('--cache-max-mb', type=float, help='Evict least recently used cached summaries above this size')
+    parser.add_argument('--fake-llm', action='store_true',
+                        help='Summarize with a local stand-in instead of the OpenAI API, to measure the pipeline alone')
+    parser.add_argument('--fake-latency', type=float, default=0.5, help='Seconds per request of the local stand-in')
+    parser.add_argument('--metrics', nargs='?', const=METRICS_PATH,
+                        help=f'Write timings, token counts, cache hits and costs as JSON lines (to {METRICS_PATH} '
+                             f'by default)')
+    parser.add_argument('--progress', action='store_true', help='Show progress bars of the summaries')
+
+    args = parser.parse_args()
+    if args.batch and args.fake_llm:
+        parser.error('--batch submits paid requests to the OpenAI Batch API and can not be used with --fake-llm')
+
+    backend_factory = cache = rate_limiter = None
+    if args.fake_llm:
+        backend_factory = lambda model: FakeBackend(model, latency=args.fake_latency)  # noqa: E731
+        # Fake summaries are not worth keeping, and there is no API quota to stay within
+        cache = MemoryCacheStore()
+        rate_limiter = RateLimiter({model: UNLIMITED for model in (CHUNK_MODEL, GROUP_MODEL, FINAL_MODEL)})
+
+    historizer = Historizer(chunk_size=args.chunk_size, chunk_tokens=args.chunk_tokens, concurrency=args.concurrency,
+                            period=args.period, group_size=args.group_size, incremental=args.incremental,
+                            cache_max_mb=args.cache_max_mb, group_concurrency=args.group_concurrency,
+                            reply_index_size=args.reply_index_size, reply_id_window=args.reply_id_window,
+                            compact=args.compact, snapshot=args.snapshot, batch=args.batch,
+                            batch_poll_interval=args.batch_poll_interval, backend_factory=backend_factory,
+                            cache=cache, rate_limiter=rate_limiter,
+                            metrics=Metrics(args.metrics, args.progress))
     asyncio.run(historizer.run())
@@ -0,0 +1,199 @@
+import abc
+import asyncio
+import hashlib
+import logging
+import random
+from dataclasses import dataclass
+from typing import AsyncIterator
+
+import httpx
+from openai import AsyncOpenAI, RateLimitError
+
+from token_counter import DEFAULT_CONTEXT_TOKENS, MODEL_CONTEXT_TOKENS, count_tokens
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEMPERATURE = 0.3
+
+# The openai client's own default
+BATCH_CLIENT_RETRIES = 2
+
+
+@dataclass
+class Completion:
+    text: str
+    # As reported by the API, None when a backend can not tell
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+
+
+class LLMBackend(abc.ABC):
+    """
+    A chat model behind the historizer and the summarizer. Failures are raised as openai errors, RateLimitError
+    included, so rate limiting, retries and splitting of too large chunks work the same with every backend
+    """
+
+    def __init__(self, model_name: str, temperature: float | None = DEFAULT_TEMPERATURE):
+        self.model_name = model_name
+        self.temperature = temperature
+
+    @abc.abstractmethod
+    async def complete(self, prompt: str, system_prompt: str | None = None) -> Completion:
+        ...
+
+    async def stream(self, prompt: str, system_prompt: str | None = None) -> AsyncIterator[str]:
+        """
+        The answer in pieces as they are generated. Backends without streaming give it in one piece
+        """
+
+        yield (await self.complete(prompt, system_prompt)).text
+
+    async def warm_up(self):
+        """
+        Opens what the first request needs, such as a connection, while the caller is busy with something else
+        """
+
+    def count_tokens(self, text: str) -> int:
+        return count_tokens(text)
+
+    @property
+    def context_tokens(self) -> int:
+        return MODEL_CONTEXT_TOKENS.get(self.model_name, DEFAULT_CONTEXT_TOKENS)
+
+    @property
+    def cache_model(self) -> str:
+        """
+        The model as recorded in cache keys and checkpoints, backends answering differently for the same model
+        name must not share it
+        """
+
+        return self.model_name
+
+    @property
+    def batch_client(self) -> AsyncOpenAI | None:
+        """
+        Client of the OpenAI Batch API for the requests of this model, None for backends that can not take batches
+        """
+
+        return None
+
+
+def make_messages(prompt: str, system_prompt: str | None = None) -> list[dict]:
+    messages = [{'role': 'system', 'content': system_prompt}] if system_prompt else []
+    messages.append({'role': 'user', 'content': prompt})
+    return messages
+
+
+class OpenAIBackend(LLMBackend):
+    def __init__(self, model_name: str, temperature: float | None = DEFAULT_TEMPERATURE, api_key: str | None = None,
+                 client: AsyncOpenAI | None = None):
+        super().__init__(model_name, temperature)
+        # Retries are left to the rate limiter, which shares backoff between concurrent calls
+        self.client = client or AsyncOpenAI(api_key=api_key, max_retries=0)
+
+    @property
+    def batch_client(self) -> AsyncOpenAI:
+        # Uploads and status checks do not go through the rate limiter, the client retries them itself
+        return self.client.with_options(max_retries=BATCH_CLIENT_RETRIES)
+
+    async def complete(self, prompt: str, system_prompt: str | None = None) -> Completion:
+        response = await self.client.chat.completions.create(
+            model=self.model_name,
+            messages=make_messages(prompt, system_prompt),
+            temperature=self.temperature,
+        )
+        usage = response.usage
+        return Completion(
+            text=response.choices[0].message.content,
+            prompt_tokens=usage.prompt_tokens if usage else None,
+            completion_tokens=usage.completion_tokens if usage else None,
+        )
+
+    async def stream(self, prompt: str, system_prompt: str | None = None) -> AsyncIterator[str]:
+        response = await self.client.chat.completions.create(
+            model=self.model_name,
+            messages=make_messages(prompt, system_prompt),
+            temperature=self.temperature,
+            stream=True,
+        )
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def warm_up(self):
+        # Any cheap request leaves a TLS connection to the API in the client's pool, ready for the completion
+        try:
+            await self.client.models.retrieve(self.model_name)
+        except Exception as e:
+            logger.debug(f'Warming up the connection to the API failed: {e}')
+
+
+def make_rate_limit_error(message: str, retry_after: float | None = None) -> RateLimitError:
+    headers = {'retry-after-ms': str(int(retry_after * 1000))} if retry_after is not None else {}
+    response = httpx.Response(429, headers=headers, request=httpx.Request('POST', 'http://localhost/v1/chat/completions'))
+    return RateLimitError(message, response=response, body=None)
+
+
+class FakeBackend(LLMBackend):
+    """
+    Local stand-in that answers without the network, for tests and benchmarks. The answer only depends
+    on the prompt, so it is the same on every run. Latency, rate limit errors (a share of the calls, with
+    a retry-after hint) and too large errors (prompts over too_large_tokens) are injected as configured
+    """
+
+    def __init__(self, model_name: str = 'fake-model', temperature: float | None = DEFAULT_TEMPERATURE,
+                 latency: float = 0.0, rate_limit_share: float = 0.0, retry_after: float = 0.01,
+                 too_large_tokens: int | None = None, summary_words: int = 20, context_tokens: int | None = None,
+                 seed: int = 0):
+        super().__init__(model_name, temperature)
+        self.latency = latency
+        self.rate_limit_share = rate_limit_share
+        self.retry_after = retry_after
+        self.too_large_tokens = too_large_tokens
+        self.summary_words = summary_words
+        self._context_tokens = context_tokens
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.rate_limited = 0
+        self.too_large = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def context_tokens(self) -> int:
+        return self._context_tokens or super().context_tokens
+
+    @property
+    def cache_model(self) -> str:
+        return f'fake/{self.model_name}'
+
+    def answer(self, prompt: str) -> str:
+        digest = hashlib.blake2b(prompt.encode('utf-8'), digest_size=8).hexdigest()
+        return f'Summary {digest} of {len(prompt)} characters: ' + ' '.join(['event'] * self.summary_words)
+
+    async def complete(self, prompt: str, system_prompt: str | None = None) -> Completion:
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+
+            if self.too_large_tokens is not None and self.count_tokens(prompt) > self.too_large_tokens:
+                self.too_large += 1
+                raise make_rate_limit_error(f'Request too large for {self.model_name}')
+            if self.random.random() < self.rate_limit_share:
+                self.rate_limited += 1
+                raise make_rate_limit_error(f'Rate limit reached for {self.model_name}', self.retry_after)
+
+            text = self.answer(prompt)
+            prompt_tokens = self.count_tokens(system_prompt + prompt if system_prompt else prompt)
+            return Completion(text, prompt_tokens, self.count_tokens(text))
+        finally:
+            self.in_flight -= 1
+
+    async def stream(self, prompt: str, system_prompt: str | None = None) -> AsyncIterator[str]:
+        # The latency goes before the first piece, the rest follow word by word
+        text = (await self.complete(prompt, system_prompt)).text
+        for i, word in enumerate(text.split(' ')):
+            await asyncio.sleep(0)
+            yield word if i == 0 else ' ' + word
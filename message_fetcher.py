@@ -0,0 +1,368 @@
+import asyncio
+import logging
+import math
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import AsyncIterator
+
+from telethon.errors import FloodWaitError
+
+from sender_cache import Sender, SenderCache
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_CACHE_PATH = 'chat_history/cache/telegram_messages.sqlite3'
+# Bumped when the tables change, a cache of another version is dropped and fetched again
+MESSAGE_CACHE_VERSION = 3
+# Fetched ranges older than this count as not fetched, so edits made since reach the summaries without --refetch
+FETCHED_RANGE_TTL = 15 * 60
+
+# Messages per window. A window is one iter_messages walk, which Telethon pages through 100 messages per request.
+# Windows are split in id space, widened by how sparse the ids of the chat or thread are, see get_window_ids
+WINDOW_MESSAGES = 1000
+# Windows fetched at once. History requests of a single account get FloodWait errors soon past a few in flight
+FETCH_CONCURRENCY = 4
+# A longer wait fails the fetch instead of hanging it, the windows fetched so far are kept for the next run
+MAX_FLOOD_WAIT = 300
+
+
+@dataclass
+class FetchedMessage:
+    id: int
+    date: datetime
+    text: str
+    reply_to_id: int | None
+    # Names are kept apart, in the sender cache
+    sender_id: int | None
+
+    @classmethod
+    def from_telethon(cls, message) -> 'FetchedMessage':
+        return cls(
+            id=message.id,
+            date=message.date,
+            text=message.text or '',
+            reply_to_id=message.reply_to.reply_to_msg_id if message.reply_to else None,
+            sender_id=message.sender_id,
+        )
+
+
+def subtract_ranges(first_id: int, last_id: int, covered: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """
+    Parts of first_id..last_id not covered by the sorted inclusive ranges
+    """
+
+    missing = []
+    start = first_id
+    for covered_first, covered_last in covered:
+        if covered_first > start:
+            missing.append((start, min(covered_first - 1, last_id)))
+        start = max(start, covered_last + 1)
+        if start > last_id:
+            break
+    if start <= last_id:
+        missing.append((start, last_id))
+    return missing
+
+
+def split_into_windows(ranges: list[tuple[int, int]], window_ids: int = WINDOW_MESSAGES) -> list[tuple[int, int]]:
+    return [(start, min(start + window_ids - 1, last_id))
+            for first_id, last_id in ranges
+            for start in range(first_id, last_id + 1, window_ids)]
+
+
+class MessageCache:
+    """
+    Fetched messages of every chat and thread in one SQLite file, along with the id ranges already fetched, so ids
+    missing from a fetched range (deleted, or in another thread) are not asked for again. A window fetched again
+    replaces what the cache had for its ids, so edits and deletions are picked up by fetching with refresh, or on
+    their own once the range is older than ttl seconds
+    """
+
+    def __init__(self, path: str = MESSAGE_CACHE_PATH, ttl: float = FETCHED_RANGE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            if self._connection.execute('PRAGMA user_version').fetchone()[0] != MESSAGE_CACHE_VERSION:
+                with self._connection:
+                    self._connection.execute('DROP TABLE IF EXISTS messages')
+                    self._connection.execute('DROP TABLE IF EXISTS fetched_ranges')
+                    self._connection.execute(f'PRAGMA user_version = {MESSAGE_CACHE_VERSION}')
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    channel TEXT NOT NULL,
+                    thread INTEGER NOT NULL,
+                    id INTEGER NOT NULL,
+                    date TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    reply_to_id INTEGER,
+                    sender_id INTEGER,
+                    PRIMARY KEY (channel, thread, id)
+                ) WITHOUT ROWID
+            ''')
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS fetched_ranges (
+                    channel TEXT NOT NULL,
+                    thread INTEGER NOT NULL,
+                    first_id INTEGER NOT NULL,
+                    last_id INTEGER NOT NULL,
+                    fetched_at REAL NOT NULL
+                )
+            ''')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS fetched_ranges_chat ON fetched_ranges (channel, thread, first_id)'
+            )
+        return self._connection
+
+    @staticmethod
+    def chat_key(channel: str, thread_id: int | None) -> tuple[str, int]:
+        # Usernames are case-insensitive, and NULL would not be equal to itself in the primary key
+        return channel.lower(), thread_id or 0
+
+    def fetched_ranges(self, channel: str, thread_id: int | None) -> list[tuple[int, int]]:
+        """
+        Id ranges fetched within the last ttl seconds, older ones are fetched again
+        """
+
+        return self.connection.execute(
+            'SELECT first_id, last_id FROM fetched_ranges WHERE channel = ? AND thread = ? AND fetched_at >= ? '
+            'ORDER BY first_id',
+            (*self.chat_key(channel, thread_id), time.time() - self.ttl),
+        ).fetchall()
+
+    def missing_ranges(self, channel: str, thread_id: int | None, first_id: int, last_id: int) -> list[tuple[int, int]]:
+        return subtract_ranges(first_id, last_id, self.fetched_ranges(channel, thread_id))
+
+    def save_window(self, channel: str, thread_id: int | None, first_id: int, last_id: int,
+                    messages: list[FetchedMessage]):
+        """
+        Stores the messages of a fetched window and marks its ids as fetched, in one transaction, so an interrupted
+        fetch resumes from the windows that were saved
+        """
+
+        key = self.chat_key(channel, thread_id)
+        now = time.time()
+        fresh_since = now - self.ttl
+        with self.connection:
+            # Messages deleted upstream since the window was last fetched must not be served from the cache
+            self.connection.execute('DELETE FROM messages WHERE channel = ? AND thread = ? AND id BETWEEN ? AND ?',
+                                    (*key, first_id, last_id))
+            self.connection.executemany(
+                'INSERT INTO messages (channel, thread, id, date, text, reply_to_id, sender_id) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(*key, message.id, message.date.isoformat(), message.text, message.reply_to_id, message.sender_id)
+                 for message in messages],
+            )
+
+            # Stale ranges the window overlaps keep their ids outside of it, as old as they were
+            stale = self.connection.execute(
+                'SELECT first_id, last_id, fetched_at FROM fetched_ranges '
+                'WHERE channel = ? AND thread = ? AND first_id <= ? AND last_id >= ? AND fetched_at < ?',
+                (*key, last_id, first_id, fresh_since),
+            ).fetchall()
+            self.connection.execute(
+                'DELETE FROM fetched_ranges '
+                'WHERE channel = ? AND thread = ? AND first_id <= ? AND last_id >= ? AND fetched_at < ?',
+                (*key, last_id, first_id, fresh_since),
+            )
+            self.connection.executemany(
+                'INSERT INTO fetched_ranges (channel, thread, first_id, last_id, fetched_at) VALUES (?, ?, ?, ?, ?)',
+                [(*key, *part, fetched_at) for stale_first, stale_last, fetched_at in stale
+                 for part in ((stale_first, first_id - 1), (last_id + 1, stale_last)) if part[0] <= part[1]],
+            )
+
+            # Merged with the fresh ranges it overlaps or touches, so the table stays a handful of rows per chat.
+            # The merged range expires with its oldest part
+            touching = self.connection.execute(
+                'SELECT first_id, last_id, fetched_at FROM fetched_ranges '
+                'WHERE channel = ? AND thread = ? AND first_id <= ? AND last_id >= ? AND fetched_at >= ?',
+                (*key, last_id + 1, first_id - 1, fresh_since),
+            ).fetchall()
+            self.connection.execute(
+                'DELETE FROM fetched_ranges '
+                'WHERE channel = ? AND thread = ? AND first_id <= ? AND last_id >= ? AND fetched_at >= ?',
+                (*key, last_id + 1, first_id - 1, fresh_since),
+            )
+            first_id = min([first_id, *(row[0] for row in touching)])
+            last_id = max([last_id, *(row[1] for row in touching)])
+            fetched_at = min([now, *(row[2] for row in touching)])
+            self.connection.execute(
+                'INSERT INTO fetched_ranges (channel, thread, first_id, last_id, fetched_at) VALUES (?, ?, ?, ?, ?)',
+                (*key, first_id, last_id, fetched_at),
+            )
+
+    def get_messages(self, channel: str, thread_id: int | None, first_id: int, last_id: int) -> list[FetchedMessage]:
+        rows = self.connection.execute(
+            'SELECT id, date, text, reply_to_id, sender_id FROM messages '
+            'WHERE channel = ? AND thread = ? AND id BETWEEN ? AND ? ORDER BY id',
+            (*self.chat_key(channel, thread_id), first_id, last_id),
+        ).fetchall()
+        return [FetchedMessage(id_, datetime.fromisoformat(date), *fields) for id_, date, *fields in rows]
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class FetchGate:
+    """
+    Windows in flight and the end of the latest FloodWait of one account. Fetchers of the same client share it,
+    so concurrent fetches of several chats stay within FETCH_CONCURRENCY windows and all pause on a FloodWait
+    """
+
+    def __init__(self, concurrency: int = FETCH_CONCURRENCY):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.resume_at = 0.0
+
+    def hold(self, seconds: float):
+        self.resume_at = max(self.resume_at, asyncio.get_running_loop().time() + seconds)
+
+    async def wait(self):
+        delay = self.resume_at - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class MessageFetcher:
+    """
+    Fetches the messages of a chat or a thread by id windows, several at once, through the message cache: only
+    the ids not fetched by an earlier run are asked for. A FloodWait pauses every window, not only the one that
+    got it, since the limit is per account: fetchers of one client should share a FetchGate. Senders that come
+    with the messages go to the sender cache, so resolving them afterwards costs no requests
+    """
+
+    def __init__(self, client, cache: MessageCache, channel: str, thread_id: int | None = None,
+                 window_messages: int = WINDOW_MESSAGES, concurrency: int = FETCH_CONCURRENCY,
+                 max_flood_wait: float = MAX_FLOOD_WAIT, sender_cache: SenderCache | None = None,
+                 gate: FetchGate | None = None):
+        self.client = client
+        self.cache = cache
+        self.sender_cache = sender_cache
+        self.channel = channel
+        self.thread_id = thread_id
+        self.window_messages = window_messages
+        # A gate of its own unless the client is shared with other fetchers
+        self.gate = gate or FetchGate(concurrency)
+        self.max_flood_wait = max_flood_wait
+        self.requests = 0
+
+    async def get_latest(self) -> tuple[int | None, int]:
+        """
+        Id of the latest message of the chat or thread, and how many messages it has
+        """
+
+        latest = await self.client.get_messages(self.channel, limit=1, reply_to=self.thread_id)
+        return (latest[0].id if latest else None), latest.total
+
+    def get_window_ids(self, last_id: int | None, total: int) -> int:
+        """
+        Ids per window for about window_messages messages in each. The ids of a thread are those of the whole group,
+        a few hundred replies may be spread over hundreds of thousands of ids, and would take as many walks
+        """
+
+        # Replies of a thread come after its first message
+        first_id = self.thread_id or 0
+        if not total or last_id is None or last_id <= first_id:
+            return self.window_messages
+        density = min(1.0, total / (last_id - first_id))
+        return math.ceil(self.window_messages / density)
+
+    async def fetch_window(self, first_id: int, last_id: int) -> list[FetchedMessage]:
+        messages = []
+        senders = {}
+        # Exclusive, moved past every message received, so a window retried after a FloodWait goes on where it stopped
+        min_id = first_id - 1
+
+        async with self.gate.semaphore:
+            while True:
+                await self.gate.wait()
+                try:
+                    self.requests += 1
+                    async for message in self.client.iter_messages(self.channel, reply_to=self.thread_id, min_id=min_id,
+                                                                   max_id=last_id + 1, reverse=True):
+                        messages.append(FetchedMessage.from_telethon(message))
+                        if message.sender is not None and message.sender_id not in senders:
+                            senders[message.sender_id] = Sender.from_entity(message.sender)
+                        min_id = message.id
+                    break
+                except FloodWaitError as e:
+                    if e.seconds > self.max_flood_wait:
+                        raise
+                    logger.warning(f'Telegram asked to wait {e.seconds}s while fetching messages {first_id}-{last_id}')
+                    self.gate.hold(e.seconds)
+
+        self.cache.save_window(self.channel, self.thread_id, first_id, last_id, messages)
+        if self.sender_cache is not None:
+            self.sender_cache.put_many(senders.values())
+        logger.info(f'Fetched {len(messages)} messages with ids {first_id}-{last_id}')
+        return messages
+
+    async def iter_batches(self, min_id: int, max_id: int | None = None,
+                           refresh: bool = False) -> AsyncIterator[list[FetchedMessage]]:
+        """
+        Messages between min_id and max_id in id order, in batches: a batch is a fetched window or a range
+        of cached ids. Every window is fetched from the start, a batch is given out as soon as the ones before it
+        are, so the consumer works on the first windows while the later ones are still fetched. The bounds are
+        exclusive, as in iter_messages, and without max_id the range goes up to the latest message
+        """
+
+        latest = await self.get_latest() if max_id is None else None
+        first_id = min_id + 1
+        last_id = max_id - 1 if max_id is not None else latest[0]
+        if last_id is None or last_id < first_id:
+            return
+
+        if refresh:
+            missing = [(first_id, last_id)]
+        else:
+            missing = self.cache.missing_ranges(self.channel, self.thread_id, first_id, last_id)
+        window_ids = self.window_messages
+        if sum(last - first + 1 for first, last in missing) > window_ids:
+            # Worth a request only when the ids would be split into several windows
+            window_ids = self.get_window_ids(*(latest or await self.get_latest()))
+        windows = split_into_windows(missing, window_ids)
+        if windows:
+            logger.info(f'Fetching {sum(last - first + 1 for first, last in missing)} message ids '
+                        f'in {len(windows)} windows')
+        tasks = {window: asyncio.create_task(self.fetch_window(*window)) for window in windows}
+
+        # The windows and the cached ranges between them, in order
+        segments = []
+        start = first_id
+        for window_first, window_last in windows:
+            if window_first > start:
+                segments.append((start, window_first - 1))
+            segments.append((window_first, window_last))
+            start = window_last + 1
+        if start <= last_id:
+            segments.append((start, last_id))
+
+        try:
+            for segment in segments:
+                if segment in tasks:
+                    batch = await tasks[segment]
+                else:
+                    batch = self.cache.get_messages(self.channel, self.thread_id, *segment)
+                if batch:
+                    yield batch
+        finally:
+            # A consumer that stops early, or a window that failed, leaves the rest unneeded
+            for task in tasks.values():
+                task.cancel()
+
+    async def fetch(self, min_id: int, max_id: int | None = None, refresh: bool = False) -> list[FetchedMessage]:
+        """
+        All the messages of iter_batches at once
+        """
+
+        return [message async for batch in self.iter_batches(min_id, max_id, refresh) for message in batch]
@@ -0,0 +1,228 @@
+import bisect
+import logging
+import sys
+from array import array
+from datetime import datetime, timedelta
+from typing import Iterator, NamedTuple
+
+from export_reader import iter_raw_messages
+from models import flatten_text
+
+logger = logging.getLogger(__name__)
+
+# Export dates are naive local times, they are stored as seconds since this point, as if they were UTC
+EPOCH = datetime(1970, 1, 1)
+
+NO_VALUE = -1
+
+
+class CompactReaction(NamedTuple):
+    emoji: str | None
+    count: int
+
+
+class CompactUserMessage:
+    """
+    The fields of a UserMessage that summarization reads, renderer.py accepts it in place of one
+    """
+
+    __slots__ = ('id', 'date', 'text', 'from_', 'sticker_emoji', 'photo', 'reply_to_message_id', 'reactions')
+    type = 'message'
+
+    def __init__(self, id: int, date: datetime, text: str, from_: str | None, sticker_emoji: str | None, photo: bool,
+                 reply_to_message_id: int | None, reactions: tuple[CompactReaction, ...] | None):
+        self.id = id
+        self.date = date
+        self.text = text
+        self.from_ = from_
+        self.sticker_emoji = sticker_emoji
+        self.photo = photo
+        self.reply_to_message_id = reply_to_message_id
+        self.reactions = reactions
+
+
+class CompactServiceMessage:
+    __slots__ = ('id', 'date', 'text', 'action', 'actor')
+    type = 'service'
+
+    def __init__(self, id: int, date: datetime, text, action: str, actor: str | None):
+        self.id = id
+        self.date = date
+        self.text = text
+        self.action = action
+        self.actor = actor
+
+
+class StringPool:
+    """
+    Interns the few distinct sender names, actions and emojis, so a row only keeps an int per field
+    """
+
+    def __init__(self):
+        self.strings: list[str] = []
+        self.indexes: dict[str, int] = {}
+
+    def add(self, value: str | None) -> int:
+        if value is None:
+            return NO_VALUE
+        index = self.indexes.get(value)
+        if index is None:
+            index = self.indexes[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+    def get(self, index: int) -> str | None:
+        return None if index == NO_VALUE else self.strings[index]
+
+    def intern(self, value: str) -> str:
+        return self.strings[self.add(value)]
+
+
+class MessageStore:
+    """
+    Column-oriented in-memory copy of an export: only the fields used for summarization, in typed arrays.
+    Rows are materialized as Compact*Message records on access. Exports are sorted by id and date,
+    so id lookups and date ranges are binary searches, with a dict fallback for unsorted ids
+    """
+
+    def __init__(self):
+        self.ids = array('q')
+        self.dates = array('q')
+        self.is_service = bytearray()
+        self.senders = array('i')
+        self.stickers = array('i')
+        self.photos = bytearray()
+        self.reply_to = array('q')
+        self.texts: list = []
+        # Sparse, only a small share of messages has reactions
+        self.reactions: dict[int, tuple[CompactReaction, ...]] = {}
+        self.pool = StringPool()
+        self.ids_sorted = True
+        self.dates_sorted = True
+        self.rows_by_id: dict[int, int] | None = None
+
+    @classmethod
+    def from_export(cls, file_path: str) -> 'MessageStore':
+        logger.info(f'Loading chat history from {file_path} into a compact store')
+        store = cls()
+        for message_data in iter_raw_messages(file_path):
+            store.append(message_data)
+        logger.info(f'Chat history loaded: {len(store)} messages, about {store.memory_usage() / 1024 / 1024:.1f} MB')
+        return store
+
+    def append(self, message_data: dict):
+        message_id = message_data['id']
+        date = int((datetime.fromisoformat(message_data['date']) - EPOCH).total_seconds())
+
+        if self.ids and message_id <= self.ids[-1]:
+            self.ids_sorted = False
+        if self.dates and date < self.dates[-1]:
+            self.dates_sorted = False
+        self.rows_by_id = None
+
+        row = len(self.ids)
+        self.ids.append(message_id)
+        self.dates.append(date)
+
+        if message_data.get('type') == 'service':
+            self.is_service.append(1)
+            # Actors go to the sender column and actions to the sticker one, a row only ever has one of each
+            self.senders.append(self.pool.add(message_data.get('actor')))
+            self.stickers.append(self.pool.add(message_data['action']))
+            self.photos.append(0)
+            self.reply_to.append(0)
+            self.texts.append(message_data.get('text', ''))
+            return
+
+        self.is_service.append(0)
+        self.senders.append(self.pool.add(message_data.get('from')))
+        self.stickers.append(self.pool.add(message_data.get('sticker_emoji')))
+        self.photos.append(1 if message_data.get('photo') else 0)
+        self.reply_to.append(message_data.get('reply_to_message_id') or 0)
+        self.texts.append(flatten_text(message_data.get('text', '')))
+
+        if message_data.get('reactions'):
+            self.reactions[row] = tuple(
+                CompactReaction(self.pool.intern(reaction['emoji']) if reaction.get('emoji') else None, reaction['count'])
+                for reaction in message_data['reactions']
+            )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def row(self, row: int) -> CompactUserMessage | CompactServiceMessage:
+        date = EPOCH + timedelta(seconds=self.dates[row])
+
+        if self.is_service[row]:
+            return CompactServiceMessage(self.ids[row], date, self.texts[row], self.pool.get(self.stickers[row]),
+                                         self.pool.get(self.senders[row]))
+
+        return CompactUserMessage(
+            id=self.ids[row],
+            date=date,
+            text=self.texts[row],
+            from_=self.pool.get(self.senders[row]),
+            sticker_emoji=self.pool.get(self.stickers[row]),
+            photo=bool(self.photos[row]),
+            reply_to_message_id=self.reply_to[row] or None,
+            reactions=self.reactions.get(row),
+        )
+
+    def iter_rows(self, start: int = 0, stop: int | None = None) -> Iterator[CompactUserMessage | CompactServiceMessage]:
+        for row in range(start, len(self) if stop is None else stop):
+            yield self.row(row)
+
+    def __iter__(self) -> Iterator[CompactUserMessage | CompactServiceMessage]:
+        return self.iter_rows()
+
+    def find_row(self, message_id: int) -> int | None:
+        if self.ids_sorted:
+            row = bisect.bisect_left(self.ids, message_id)
+            return row if row < len(self.ids) and self.ids[row] == message_id else None
+
+        if self.rows_by_id is None:
+            self.rows_by_id = {row_id: row for row, row_id in enumerate(self.ids)}
+        return self.rows_by_id.get(message_id)
+
+    def get(self, message_id: int) -> CompactUserMessage | CompactServiceMessage | None:
+        row = self.find_row(message_id)
+        return self.row(row) if row is not None else None
+
+    def rows_after(self, message_id: int) -> int:
+        """
+        Index of the first row with an id greater than message_id
+        """
+
+        if self.ids_sorted:
+            return bisect.bisect_right(self.ids, message_id)
+        return next((row for row, row_id in enumerate(self.ids) if row_id > message_id), len(self))
+
+    def slice_by_date(self, start: datetime | None = None,
+                      end: datetime | None = None) -> Iterator[CompactUserMessage | CompactServiceMessage]:
+        """
+        Messages dated within [start, end)
+        """
+
+        low = int((start - EPOCH).total_seconds()) if start is not None else None
+        high = int((end - EPOCH).total_seconds()) if end is not None else None
+
+        if not self.dates_sorted:
+            return (self.row(row) for row, date in enumerate(self.dates)
+                    if (low is None or date >= low) and (high is None or date < high))
+
+        first = bisect.bisect_left(self.dates, low) if low is not None else 0
+        last = bisect.bisect_left(self.dates, high) if high is not None else len(self)
+        return self.iter_rows(first, last)
+
+    def memory_usage(self) -> int:
+        """
+        Approximate size of the store in bytes, texts and pooled strings included
+        """
+
+        columns = (self.ids, self.dates, self.senders, self.stickers, self.reply_to)
+        size = sum(column.itemsize * len(column) for column in columns)
+        size += len(self.is_service) + len(self.photos)
+        size += sys.getsizeof(self.texts) + sum(sys.getsizeof(text) for text in self.texts)
+        size += sys.getsizeof(self.reactions) + sum(sys.getsizeof(reactions) for reactions in self.reactions.values())
+        size += sum(sys.getsizeof(string) for string in self.pool.strings)
+        return size
@@ -0,0 +1,203 @@
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Iterable, Iterator, TypeVar
+
+try:
+    from tqdm import tqdm
+except ImportError:  # tqdm is optional, progress is only logged without it
+    tqdm = None
+
+from token_counter import estimate_cost
+
+logger = logging.getLogger(__name__)
+
+METRICS_PATH = 'chat_history/cache/metrics.jsonl'
+
+T = TypeVar('T')
+
+# Shared by all the timers of a disabled Metrics, so hot paths pay next to nothing for them
+NO_TIMER = nullcontext()
+
+
+class ModelUsage:
+    __slots__ = ('calls', 'failures', 'retries', 'prompt_tokens', 'completion_tokens', 'cost', 'seconds')
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.seconds = 0.0
+
+    def as_dict(self) -> dict:
+        return {name: round(getattr(self, name), 6) for name in self.__slots__}
+
+
+class Metrics:
+    """
+    Instrumentation of a run, written as JSON lines: an event per model call and per cache lookup of a summary,
+    spans of the stages, and a summary at the end. Time spent in the synchronous work of loading, chunking and
+    rendering, which interleaves in the lazy pipeline, is measured by exclusive timers: while a nested timer runs,
+    the outer one is paused. A Metrics without a path and a progress bar records nothing
+    """
+
+    def __init__(self, path: str | None = None, progress: bool = False):
+        self.path = path
+        self.progress = progress and tqdm is not None
+        self.enabled = path is not None or self.progress
+        self.started = time.perf_counter()
+        self.file = None
+        if path is not None:
+            # Created before the historizer makes its directories
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.file = open(path, 'w', encoding='utf-8')
+
+        self.timers: dict[str, float] = defaultdict(float)
+        self.timer_counts: dict[str, int] = defaultdict(int)
+        self.timer_stack: list[str] = []
+        self.timer_started = 0.0
+
+        self.models: dict[str, ModelUsage] = defaultdict(ModelUsage)
+        self.cache_hits: dict[str, int] = defaultdict(int)
+        self.cache_misses: dict[str, int] = defaultdict(int)
+        self.bars = {}
+
+    def write(self, event: dict):
+        if self.file is not None:
+            self.file.write(json.dumps({'time': round(time.perf_counter() - self.started, 6), **event},
+                                       ensure_ascii=False))
+            self.file.write('\n')
+
+    def switch_timer(self):
+        now = time.perf_counter()
+        if self.timer_stack:
+            self.timers[self.timer_stack[-1]] += now - self.timer_started
+        self.timer_started = now
+
+    @contextmanager
+    def _timer(self, name: str):
+        self.switch_timer()
+        self.timer_stack.append(name)
+        self.timer_counts[name] += 1
+        try:
+            yield
+        finally:
+            self.switch_timer()
+            self.timer_stack.pop()
+
+    def timer(self, name: str):
+        """
+        Exclusive timer of synchronous code, it must not span an await
+        """
+
+        return self._timer(name) if self.enabled else NO_TIMER
+
+    def timed(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        """
+        Times the production of every item of a lazy iterable, not what the consumer does with it
+        """
+
+        if not self.enabled:
+            yield from iterable
+            return
+
+        iterator = iter(iterable)
+        while True:
+            with self._timer(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    @contextmanager
+    def span(self, name: str, **fields):
+        started = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            if self.enabled:
+                self.write({'type': 'span', 'name': name, 'seconds': round(time.perf_counter() - started, 6), **fields})
+
+    def record_call(self, stage: str, model: str, seconds: float, retries: int, prompt_tokens: int | None = None,
+                    completion_tokens: int | None = None, error: str | None = None, cost_scale: float = 1.0):
+        """
+        cost_scale is the share of the list price paid, less than 1 for discounted requests such as batched ones
+        """
+
+        if not self.enabled:
+            return
+
+        usage = self.models[model]
+        usage.calls += 1
+        usage.retries += retries
+        usage.seconds += seconds
+        cost = None
+        if error is not None:
+            usage.failures += 1
+        elif prompt_tokens is not None and completion_tokens is not None:
+            usage.prompt_tokens += prompt_tokens
+            usage.completion_tokens += completion_tokens
+            cost = estimate_cost(model, prompt_tokens, completion_tokens)
+            if cost is not None:
+                cost *= cost_scale
+            usage.cost += cost or 0.0
+
+        self.write({'type': 'call', 'stage': stage, 'model': model, 'seconds': round(seconds, 6), 'retries': retries,
+                    'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'cost': cost,
+                    'error': error})
+
+    def record_summary(self, stage: str, cached: bool, **fields):
+        """
+        A summary of the stage is done, either looked up in the cache or made by the model
+        """
+
+        if not self.enabled:
+            return
+
+        if cached:
+            self.cache_hits[stage] += 1
+        else:
+            self.cache_misses[stage] += 1
+        self.write({'type': 'summary', 'stage': stage, 'cached': cached, **fields})
+
+        if self.progress:
+            if stage not in self.bars:
+                self.bars[stage] = tqdm(desc=f'{stage} summaries', unit=' summaries', leave=False)
+            self.bars[stage].update(1)
+
+    def totals(self) -> dict:
+        stages = sorted(set(self.cache_hits) | set(self.cache_misses))
+        return {
+            'seconds': round(time.perf_counter() - self.started, 6),
+            'timers': {name: {'seconds': round(seconds, 6), 'count': self.timer_counts[name]}
+                       for name, seconds in self.timers.items()},
+            'models': {model: usage.as_dict() for model, usage in self.models.items()},
+            'cache': {stage: {'hits': self.cache_hits[stage], 'misses': self.cache_misses[stage]} for stage in stages},
+            'cost': round(sum(usage.cost for usage in self.models.values()), 6),
+        }
+
+    def close(self):
+        if not self.enabled:
+            return
+
+        totals = self.totals()
+        self.write({'type': 'totals', **totals})
+        for bar in self.bars.values():
+            bar.close()
+        self.bars = {}
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            logger.info(f'Metrics saved to {self.path}')
+
+        timers = ', '.join(f'{name} {values["seconds"]:.1f}s' for name, values in totals['timers'].items())
+        calls = sum(usage['calls'] for usage in totals['models'].values())
+        logger.info(f'Run took {totals["seconds"]:.1f}s ({timers}), {calls} model calls, '
+                    f'estimated cost ${totals["cost"]:.4f}')
@@ -3,6 +3,19 @@ from datetime import datetime
 from pydantic import BaseModel, Field, field_validator
 
 
+def flatten_text(v):
+    # Telegram exports formatted text as a list of plain strings and entity objects
+    if isinstance(v, list):
+        result = ''
+        for item in v:
+            if isinstance(item, str):
+                result += item
+            elif isinstance(item, dict) and 'text' in item:
+                result += item['text']
+        return result
+    return v
+
+
 class TextEntity(BaseModel):
     type: str
     text: str
@@ -66,15 +79,13 @@ class UserMessage(BaseMessage):
     @field_validator('text')
     @classmethod
     def process_text(cls, v):
-        if isinstance(v, list):
-            result = ''
-            for item in v:
-                if isinstance(item, str):
-                    result += item
-                elif isinstance(item, dict) and 'text' in item:
-                    result += item['text']
-            return result
-        return v
+        return flatten_text(v)
+
+
+def parse_message(message_data: dict) -> ServiceMessage | UserMessage:
+    if message_data.get('type') == 'service':
+        return ServiceMessage.model_validate(message_data)
+    return UserMessage.model_validate(message_data)
 
 
 class ChatHistory(BaseModel):
@@ -86,10 +97,4 @@ class ChatHistory(BaseModel):
     @field_validator('messages', mode='before')
     @classmethod
     def parse_messages(cls, messages_data):
-        result = []
-        for msg in messages_data:
-            if msg.get('type') == 'service':
-                result.append(ServiceMessage.model_validate(msg))
-            else:
-                result.append(UserMessage.model_validate(msg))
-        return result
+        return [parse_message(msg) for msg in messages_data]
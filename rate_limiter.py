@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import random
+import re
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, TypeVar
+
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+@dataclass
+class ModelLimits:
+    requests_per_minute: int
+    tokens_per_minute: int
+
+
+# OpenAI usage tier 1 limits, raise them to match the account tier
+MODEL_LIMITS = {
+    'gpt-4.1-nano': ModelLimits(requests_per_minute=500, tokens_per_minute=200_000),
+    'gpt-4.1-mini': ModelLimits(requests_per_minute=500, tokens_per_minute=200_000),
+    'gpt-4.1': ModelLimits(requests_per_minute=500, tokens_per_minute=30_000),
+}
+
+DEFAULT_LIMITS = ModelLimits(requests_per_minute=500, tokens_per_minute=30_000)
+
+# For local stand-ins of the API, which have no quota
+UNLIMITED = ModelLimits(requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12)
+
+RETRY_AFTER_REGEX = r'try again in (\d+(?:\.\d+)?)(ms|s)'
+
+
+def is_too_large_error(error: Exception) -> bool:
+    return isinstance(error, RateLimitError) and 'too large' in str(error).lower()
+
+
+def get_retry_after(error: Exception) -> float | None:
+    """
+    Seconds to wait as suggested by the server, either in headers or in the error message
+    """
+
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+
+    for header, scale in (('retry-after-ms', 0.001), ('retry-after', 1.0)):
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            return float(value) * scale
+        except (TypeError, ValueError):
+            continue
+
+    match = re.search(RETRY_AFTER_REGEX, str(error))
+    if match:
+        value, unit = match.groups()
+        return float(value) / 1000 if unit == 'ms' else float(value)
+
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, RateLimitError):
+        error_message = str(error).lower()
+        return 'too large' not in error_message and 'insufficient_quota' not in error_message
+    # APITimeoutError is a subclass of APIConnectionError
+    return isinstance(error, (APIConnectionError, InternalServerError))
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations: the level may go negative and the caller
+    sleeps for the returned delay, so concurrent callers queue up fairly without locks
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.level = capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self, amount: float) -> float:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+        # A single request bigger than the whole bucket is let through once the bucket is full
+        self.level -= min(amount, self.capacity)
+
+        if self.level >= 0:
+            return 0.0
+        return -self.level / self.refill_per_second
+
+
+class ModelRateLimiter:
+    def __init__(self, limits: ModelLimits):
+        self.limits = limits
+        self.requests = TokenBucket(limits.requests_per_minute, limits.requests_per_minute / 60)
+        self.tokens = TokenBucket(limits.tokens_per_minute, limits.tokens_per_minute / 60)
+        self.blocked_until = 0.0
+
+    def reserve(self, tokens: int) -> float:
+        blocked_for = self.blocked_until - time.monotonic()
+        return max(self.requests.reserve(1), self.tokens.reserve(tokens), blocked_for, 0.0)
+
+    def block_for(self, seconds: float):
+        # A 429 means our budget is off, so every caller of this model waits, not just the one that failed
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """
+    Shared requests/tokens per minute budgets per model with retries on 429s and transient API errors
+    """
+
+    def __init__(self, limits: dict[str, ModelLimits] | None = None, max_retries: int = 6,
+                 base_delay: float = 1.0, max_delay: float = 60.0):
+        self.limits = MODEL_LIMITS if limits is None else limits
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.models: dict[str, ModelRateLimiter] = {}
+
+    def for_model(self, model: str) -> ModelRateLimiter:
+        if model not in self.models:
+            self.models[model] = ModelRateLimiter(self.limits.get(model, DEFAULT_LIMITS))
+        return self.models[model]
+
+    def get_backoff(self, error: Exception, attempt: int) -> float:
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base_delay / 2)
+
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def handle_error(self, model: str, error: Exception, attempt: int) -> float:
+        if attempt >= self.max_retries or not is_retryable(error):
+            raise error
+
+        delay = self.get_backoff(error, attempt)
+        if isinstance(error, RateLimitError):
+            self.for_model(model).block_for(delay)
+
+        logger.warning(f'{model} call failed (attempt {attempt + 1}/{self.max_retries}), retrying in {delay:.1f}s: {error}')
+        return delay
+
+    async def run(self, model: str, call: Callable[[], Awaitable[T]], tokens: int) -> T:
+        limiter = self.for_model(model)
+        attempt = 0
+
+        while True:
+            delay = limiter.reserve(tokens)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            try:
+                return await call()
+            except Exception as e:
+                await asyncio.sleep(self.handle_error(model, e, attempt))
+                attempt += 1
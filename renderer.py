@@ -0,0 +1,138 @@
+from datetime import datetime
+from typing import Callable, Iterable
+
+from message_store import CompactServiceMessage, CompactUserMessage
+from models import ServiceMessage, UserMessage
+
+# Builds exactly the text of the Jinja message templates in historizer.py and summarizer.py, which stay the reference
+# of the format. Template.render has a high per-call overhead, here literal parts go to a list joined once
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Jinja's truncate filter lets strings up to length + leeway through untouched
+TRUNCATE_LENGTH = 100
+TRUNCATE_LEEWAY = 5
+TRUNCATE_END = '...'
+
+MESSAGE_SEPARATOR = '\n\n'
+
+USER_MESSAGE_HEADER = '\nUSER MESSAGE:\n'
+SERVICE_MESSAGE_HEADER = '\nSERVICE MESSAGE:\n'
+# Jinja drops the single trailing newline of a template
+MESSAGE_FOOTER = '\n------------------------'
+
+STICKER_LINE = '\nК этому сообщению прикреплён стикер с эмодзи '
+PHOTO_LINE = '\nК этому сообщению прикреплено фото'
+REPLY_PREFIX = '\n(В ответ на сообщение "'
+REACTIONS_PREFIX = '\nПоставленные реакции: '
+
+
+def format_datetime(date: datetime) -> str:
+    # isoformat is several times faster than strftime and gives the same text for naive whole-second datetimes
+    if date.tzinfo is None and not date.microsecond:
+        return date.isoformat(' ')
+    return date.strftime(DATETIME_FORMAT)
+
+
+def truncate(text):
+    if len(text) <= TRUNCATE_LENGTH + TRUNCATE_LEEWAY:
+        return text
+    return text[:TRUNCATE_LENGTH - len(TRUNCATE_END)] + TRUNCATE_END
+
+
+def append_user_message(parts: list, message: UserMessage, reply_to: UserMessage | ServiceMessage | None = None):
+    parts.append(USER_MESSAGE_HEADER)
+    if message.from_:
+        parts.append(f'{message.from_} ')
+    parts.append('\n')
+    parts.append(format_datetime(message.date))
+
+    if message.text:
+        parts.append('\n')
+        parts.append(str(message.text))
+    if message.sticker_emoji:
+        parts.append(STICKER_LINE)
+        parts.append(message.sticker_emoji)
+    if message.photo:
+        parts.append(PHOTO_LINE)
+
+    reply_text = reply_to.text if reply_to is not None else None
+    if reply_text:
+        parts.append(REPLY_PREFIX)
+        parts.append(str(truncate(reply_text)))
+        parts.append('"')
+        # Replies to service messages have no sender
+        reply_from = getattr(reply_to, 'from_', None)
+        if reply_from:
+            parts.append(f' от {reply_from}')
+        parts.append(')')
+
+    if message.reactions:
+        parts.append(REACTIONS_PREFIX)
+        for reaction in message.reactions:
+            parts.append(f'{reaction.emoji} ({reaction.count}) ')
+
+    parts.append(MESSAGE_FOOTER)
+
+
+def append_service_message(parts: list, message: ServiceMessage):
+    parts.append(SERVICE_MESSAGE_HEADER)
+    parts.append(f'{format_datetime(message.date)} \n')
+    if message.action:
+        parts.append(f'action = {message.action} ')
+    parts.append('\n')
+    if message.actor:
+        parts.append(f'actor = {message.actor} ')
+    parts.append(MESSAGE_FOOTER)
+
+
+def append_message(parts: list, message: UserMessage | ServiceMessage, reply_to: UserMessage | ServiceMessage | None):
+    if isinstance(message, (UserMessage, CompactUserMessage)):
+        append_user_message(parts, message, reply_to)
+    elif isinstance(message, (ServiceMessage, CompactServiceMessage)):
+        append_service_message(parts, message)
+    else:
+        raise ValueError(f'Unknown message type: {type(message)}')
+
+
+def render_message(message: UserMessage | ServiceMessage, reply_to: UserMessage | ServiceMessage | None = None) -> str:
+    parts = []
+    append_message(parts, message, reply_to)
+    return ''.join(parts)
+
+
+def render_messages(messages: Iterable[UserMessage | ServiceMessage],
+                    resolve_reply: Callable[[UserMessage | ServiceMessage], UserMessage | ServiceMessage | None]) -> str:
+    """
+    Renders a whole chunk into one buffer, separated the same way as the rendered messages joined one by one.
+    resolve_reply is called for every message in order and returns the message it replies to
+    """
+
+    parts = []
+    for i, message in enumerate(messages):
+        if i:
+            parts.append(MESSAGE_SEPARATOR)
+        append_message(parts, message, resolve_reply(message))
+    return ''.join(parts)
+
+
+def render_discussion_message(first_name: str | None, last_name: str | None, username: str | None, datetime: str,
+                              text: str, reply_to_text: str | None = None, reply_to_username: str | None = None) -> str:
+    """
+    Text of summarizer.MESSAGE_TEMPLATE
+    """
+
+    parts = ['\n']
+    if first_name:
+        parts.append(f'{first_name} ')
+    if last_name:
+        parts.append(f'{last_name} ')
+    if username:
+        parts.append(f' (@{username})')
+    parts.append(f', {datetime}:\n{text}\n')
+    if reply_to_text:
+        parts.append(f'\n(В ответ на сообщение "{reply_to_text}"')
+        if reply_to_username:
+            parts.append(f' от @{reply_to_username}')
+        parts.append(')\n')
+    return ''.join(parts)
@@ -0,0 +1,120 @@
+import sqlite3
+from collections import OrderedDict
+
+from models import ServiceMessage, UserMessage
+from renderer import truncate
+
+DEFAULT_MAX_ENTRIES = 100_000
+
+# Evicted entries are written to the spill table in batches of this size
+SPILL_BATCH_SIZE = 1000
+
+
+class ReplyContext:
+    """
+    The part of a message shown in the reply line of the messages answering it
+    """
+
+    __slots__ = ('text', 'from_')
+
+    def __init__(self, text, from_: str | None):
+        self.text = text
+        self.from_ = from_
+
+    @classmethod
+    def from_message(cls, message: UserMessage | ServiceMessage) -> 'ReplyContext':
+        text = message.text
+        # The reply line shows at most a truncated prefix, so nothing longer is kept
+        if isinstance(text, str):
+            text = truncate(text)
+        return cls(text, getattr(message, 'from_', None))
+
+    def __eq__(self, other):
+        return isinstance(other, ReplyContext) and (self.text, self.from_) == (other.text, other.from_)
+
+    def __repr__(self):
+        return f'ReplyContext({self.text!r}, {self.from_!r})'
+
+
+class ReplyIndex:
+    """
+    Reply context of the messages seen so far with at most max_entries of them in memory.
+    With an id_window the entries older than the newest id minus the window are evicted first,
+    otherwise the least recently used ones. Evicted entries are spilled to a temporary on-disk table,
+    so a reply to a message far back in the export still gets its context
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, id_window: int | None = None, spill: bool = True):
+        self.max_entries = max_entries
+        self.id_window = id_window
+        self.spill = spill
+        self.entries: OrderedDict[int, ReplyContext] = OrderedDict()
+        self.newest_id = None
+        self.evicted = []
+        self.spill_hits = 0
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            # An empty path is a private temporary database on disk, deleted when the connection is closed
+            self._connection = sqlite3.connect('')
+            self._connection.execute('CREATE TABLE replies (id INTEGER PRIMARY KEY, text TEXT, from_ TEXT)')
+        return self._connection
+
+    def add(self, message: UserMessage | ServiceMessage):
+        # A message rendered again keeps its place in a window index, which stays ordered by id
+        self.entries[message.id] = ReplyContext.from_message(message)
+        if self.id_window is None:
+            self.entries.move_to_end(message.id)
+        self.newest_id = message.id if self.newest_id is None else max(self.newest_id, message.id)
+
+        if self.id_window is not None:
+            # Messages come in id order and a window index does not reorder on reads, so the oldest are in front
+            while self.entries and next(iter(self.entries)) < self.newest_id - self.id_window:
+                self.evict()
+        while len(self.entries) > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        message_id, context = self.entries.popitem(last=False)
+        if not self.spill:
+            return
+
+        # Only plain text is spilled, replies to service messages with formatted text are rare enough to lose
+        if isinstance(context.text, str):
+            self.evicted.append((message_id, context.text, context.from_))
+        if len(self.evicted) >= SPILL_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.evicted:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO replies VALUES (?, ?, ?)', self.evicted)
+            self.evicted = []
+
+    def get(self, message_id: int) -> ReplyContext | None:
+        context = self.entries.get(message_id)
+        if context is not None:
+            if self.id_window is None:
+                self.entries.move_to_end(message_id)
+            return context
+
+        if not self.spill or (self._connection is None and not self.evicted):
+            return None
+
+        self.flush()
+        row = self.connection.execute('SELECT text, from_ FROM replies WHERE id = ?', (message_id,)).fetchone()
+        if row is None:
+            return None
+        self.spill_hits += 1
+        return ReplyContext(*row)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        self.evicted = []
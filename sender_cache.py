@@ -0,0 +1,143 @@
+import logging
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Iterable
+
+from telethon.utils import get_peer_id
+
+from cache_store import LOOKUP_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+SENDER_CACHE_PATH = 'chat_history/cache/telegram_senders.sqlite3'
+
+# Names and usernames do change, but seldom enough that a week old name does not hurt a summary
+SENDER_TTL = 7 * 24 * 3600
+
+# Ids per get_entity call, Telethon turns a list into one GetUsers/GetChannels request per kind of peer
+RESOLVE_BATCH_SIZE = 200
+
+
+@dataclass
+class Sender:
+    id: int
+    first_name: str | None = None
+    last_name: str | None = None
+    username: str | None = None
+    # Of channels and chats posting in a discussion, which have no names
+    title: str | None = None
+
+    @classmethod
+    def from_entity(cls, entity) -> 'Sender':
+        return cls(
+            id=get_peer_id(entity),
+            first_name=getattr(entity, 'first_name', None),
+            last_name=getattr(entity, 'last_name', None),
+            username=getattr(entity, 'username', None),
+            title=getattr(entity, 'title', None),
+        )
+
+    @property
+    def display_name(self) -> str | None:
+        return self.first_name or self.title
+
+
+class SenderCache:
+    """
+    Senders by peer id in a SQLite file, kept for SENDER_TTL. Senders that came with fetched messages are stored
+    as they are, the rest are resolved in bulk, once per id until the entry expires. Ids Telegram can not resolve
+    are stored without names, so they are not asked for on every run either
+    """
+
+    def __init__(self, path: str = SENDER_CACHE_PATH, ttl: float = SENDER_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._connection = None
+        self.resolved = 0
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS senders (
+                    id INTEGER PRIMARY KEY,
+                    first_name TEXT,
+                    last_name TEXT,
+                    username TEXT,
+                    title TEXT,
+                    fetched_at REAL NOT NULL
+                )
+            ''')
+        return self._connection
+
+    def get_many(self, ids: Iterable[int]) -> dict[int, Sender]:
+        """
+        Cached senders that have not expired
+        """
+
+        ids = list(ids)
+        found = {}
+        oldest = time.time() - self.ttl
+        for i in range(0, len(ids), LOOKUP_BATCH_SIZE):
+            batch = ids[i:i + LOOKUP_BATCH_SIZE]
+            placeholders = ', '.join('?' * len(batch))
+            rows = self.connection.execute(
+                f'SELECT id, first_name, last_name, username, title FROM senders '
+                f'WHERE id IN ({placeholders}) AND fetched_at >= ?', [*batch, oldest],
+            ).fetchall()
+            found.update((row[0], Sender(*row)) for row in rows)
+        return found
+
+    def put_many(self, senders: Iterable[Sender]):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO senders (id, first_name, last_name, username, title, fetched_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(sender.id, sender.first_name, sender.last_name, sender.username, sender.title, now)
+                 for sender in senders],
+            )
+
+    async def resolve_batch(self, client, ids: list[int]) -> list[Sender]:
+        try:
+            return [Sender.from_entity(entity) for entity in await client.get_entity(ids)]
+        except ValueError:
+            # A single id missing from the session fails the whole list, the rest are resolved one by one
+            senders = []
+            for sender_id in ids:
+                try:
+                    senders.append(Sender.from_entity(await client.get_entity(sender_id)))
+                except ValueError:
+                    logger.warning(f'Could not resolve sender {sender_id}')
+                    senders.append(Sender(sender_id))
+            return senders
+
+    async def resolve(self, client, ids: Iterable[int]) -> dict[int, Sender]:
+        """
+        Senders of the ids, from the cache or resolved with the client
+        """
+
+        ids = set(ids)
+        senders = self.get_many(ids)
+        missing = sorted(ids - senders.keys())
+        if missing:
+            logger.info(f'Resolving {len(missing)} senders, {len(senders)} are cached')
+
+        for i in range(0, len(missing), RESOLVE_BATCH_SIZE):
+            batch = missing[i:i + RESOLVE_BATCH_SIZE]
+            resolved = await self.resolve_batch(client, batch)
+            self.resolved += len(resolved)
+            self.put_many(resolved)
+            senders.update((sender.id, sender) for sender in resolved)
+
+        return senders
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,297 @@
+import bisect
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from array import array
+from dataclasses import asdict, dataclass
+
+from atomic_file import open_atomic
+from message_store import CompactReaction, MessageStore, StringPool
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = 'chat_history/cache/result.snapshot'
+
+# Bump when the layout changes, a snapshot with another version is rebuilt
+SNAPSHOT_FORMAT = 2
+MAGIC = b'TGSNAP\x00\x01'
+# The trailer is the header length followed by the magic, the header itself is JSON right before it
+TRAILER = struct.Struct('<Q8s')
+# Columns start on 8 byte boundaries so they can be cast to 64-bit items in place
+ALIGNMENT = 8
+
+DIGEST_BLOCK_SIZE = 1024 * 1024
+
+# Column name and array typecode, in file order
+COLUMNS = [
+    ('ids', 'q'),
+    ('dates', 'q'),
+    ('is_service', 'B'),
+    ('senders', 'i'),
+    ('stickers', 'i'),
+    ('photos', 'B'),
+    ('reply_to', 'q'),
+    ('text_offsets', 'q'),
+    ('text_is_json', 'B'),
+    ('text_data', 'B'),
+    ('reaction_rows', 'q'),
+    ('reaction_offsets', 'q'),
+    ('reaction_emojis', 'i'),
+    ('reaction_counts', 'q'),
+]
+
+
+@dataclass
+class SourceInfo:
+    """
+    Identity of the export a snapshot was built from
+    """
+
+    size: int
+    mtime_ns: int
+    digest: str | None = None
+
+    @classmethod
+    def from_file(cls, path: str, with_digest: bool = False) -> 'SourceInfo':
+        stat = os.stat(path)
+        return cls(stat.st_size, stat.st_mtime_ns, file_digest(path) if with_digest else None)
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while block := f.read(DIGEST_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class TextColumn:
+    """
+    Message texts in one UTF-8 buffer with an offsets table, decoded on access.
+    Formatted service texts are not plain strings and are kept as JSON
+    """
+
+    def __init__(self, offsets, data, is_json):
+        self.offsets = offsets
+        self.data = data
+        self.is_json = is_json
+
+    def __len__(self) -> int:
+        return len(self.is_json)
+
+    def __getitem__(self, row: int):
+        text = str(self.data[self.offsets[row]:self.offsets[row + 1]], 'utf-8')
+        return json.loads(text) if self.is_json[row] else text
+
+    def __iter__(self):
+        return (self[row] for row in range(len(self)))
+
+
+class ReactionColumn:
+    """
+    The sparse reactions of a store as mapped columns: the sorted rows that have reactions, the offsets of their
+    reactions, and the pooled emoji and count of every reaction. Read like the dict of MessageStore, decoded on access
+    """
+
+    def __init__(self, rows, offsets, emojis, counts, pool: StringPool):
+        self.rows = rows
+        self.offsets = offsets
+        self.emojis = emojis
+        self.counts = counts
+        self.pool = pool
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def decode(self, i: int) -> tuple[CompactReaction, ...]:
+        return tuple(CompactReaction(self.pool.get(self.emojis[j]), self.counts[j])
+                     for j in range(self.offsets[i], self.offsets[i + 1]))
+
+    def get(self, row: int, default=None) -> tuple[CompactReaction, ...] | None:
+        i = bisect.bisect_left(self.rows, row)
+        return self.decode(i) if i < len(self.rows) and self.rows[i] == row else default
+
+    def items(self):
+        return ((self.rows[i], self.decode(i)) for i in range(len(self)))
+
+    def values(self):
+        return (self.decode(i) for i in range(len(self)))
+
+
+@dataclass
+class Snapshot:
+    store: MessageStore
+    source: SourceInfo
+    # How long the export took to parse when the snapshot was built
+    build_seconds: float
+
+
+def encode_texts(texts) -> tuple[array, bytearray, list[bytes]]:
+    offsets = array('q', [0])
+    is_json = bytearray()
+    data = []
+    position = 0
+    for text in texts:
+        if isinstance(text, str):
+            encoded = text.encode('utf-8')
+            is_json.append(0)
+        else:
+            encoded = json.dumps(text, ensure_ascii=False).encode('utf-8')
+            is_json.append(1)
+        data.append(encoded)
+        position += len(encoded)
+        offsets.append(position)
+    return offsets, is_json, data
+
+
+def encode_reactions(reactions, pool: StringPool) -> tuple[array, array, array, array]:
+    rows = array('q')
+    offsets = array('q', [0])
+    emojis = array('i')
+    counts = array('q')
+    for row, row_reactions in sorted(reactions.items()):
+        rows.append(row)
+        for reaction in row_reactions:
+            emojis.append(pool.add(reaction.emoji))
+            counts.append(reaction.count)
+        offsets.append(len(counts))
+    return rows, offsets, emojis, counts
+
+
+def save_snapshot(store: MessageStore, source: SourceInfo, build_seconds: float, path: str = SNAPSHOT_PATH):
+    text_offsets, text_is_json, text_data = encode_texts(store.texts)
+    # Before the pool goes to the header, the emojis are already interned in it
+    reaction_rows, reaction_offsets, reaction_emojis, reaction_counts = encode_reactions(store.reactions, store.pool)
+    columns = {
+        'ids': store.ids, 'dates': store.dates, 'is_service': store.is_service, 'senders': store.senders,
+        'stickers': store.stickers, 'photos': store.photos, 'reply_to': store.reply_to,
+        'text_offsets': text_offsets, 'text_is_json': text_is_json, 'text_data': text_data,
+        'reaction_rows': reaction_rows, 'reaction_offsets': reaction_offsets, 'reaction_emojis': reaction_emojis,
+        'reaction_counts': reaction_counts,
+    }
+
+    layout = {}
+    with open_atomic(path, 'wb') as f:
+        f.write(MAGIC)
+        for name, _ in COLUMNS:
+            f.write(b'\x00' * (-f.tell() % ALIGNMENT))
+            offset = f.tell()
+            column = columns[name]
+            # Texts are written one by one rather than joined into another copy of them all
+            if isinstance(column, list):
+                f.writelines(column)
+            else:
+                f.write(column)
+            layout[name] = [offset, f.tell() - offset]
+
+        header = {
+            'format': SNAPSHOT_FORMAT,
+            'source': asdict(source),
+            'build_seconds': build_seconds,
+            'count': len(store),
+            'ids_sorted': store.ids_sorted,
+            'dates_sorted': store.dates_sorted,
+            'columns': layout,
+            'pool': store.pool.strings,
+        }
+        encoded_header = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        f.write(encoded_header)
+        f.write(TRAILER.pack(len(encoded_header), MAGIC))
+
+    logger.info(f'Snapshot of {len(store)} messages saved to {path}: {os.path.getsize(path) / 1024 / 1024:.1f} MB')
+
+
+def read_header(view: memoryview) -> dict | None:
+    if len(view) < len(MAGIC) + TRAILER.size or view[:len(MAGIC)] != MAGIC:
+        return None
+    header_size, magic = TRAILER.unpack(view[-TRAILER.size:])
+    if magic != MAGIC:
+        return None
+    header = json.loads(str(view[-TRAILER.size - header_size:-TRAILER.size], 'utf-8'))
+    return header if header.get('format') == SNAPSHOT_FORMAT else None
+
+
+def load_snapshot(path: str = SNAPSHOT_PATH) -> Snapshot | None:
+    """
+    Maps a snapshot into memory. The columns of the returned store are views of the file, read by the OS page cache
+    on access, so loading does not depend on the size of the export. Returns None for a missing or unreadable file
+    """
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        # The mapping outlives the file object, it is released once no column refers to it
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    header = read_header(view)
+    if header is None:
+        logger.warning(f'Ignoring {path}: not a snapshot of this version')
+        return None
+
+    columns = {}
+    for name, typecode in COLUMNS:
+        offset, size = header['columns'][name]
+        columns[name] = view[offset:offset + size].cast(typecode)
+
+    store = MessageStore()
+    store.ids = columns['ids']
+    store.dates = columns['dates']
+    store.is_service = columns['is_service']
+    store.senders = columns['senders']
+    store.stickers = columns['stickers']
+    store.photos = columns['photos']
+    store.reply_to = columns['reply_to']
+    store.texts = TextColumn(columns['text_offsets'], columns['text_data'], columns['text_is_json'])
+    store.ids_sorted = header['ids_sorted']
+    store.dates_sorted = header['dates_sorted']
+    for string in header['pool']:
+        store.pool.add(string)
+    store.reactions = ReactionColumn(columns['reaction_rows'], columns['reaction_offsets'],
+                                     columns['reaction_emojis'], columns['reaction_counts'], store.pool)
+
+    return Snapshot(store, SourceInfo(**header['source']), header['build_seconds'])
+
+
+def is_snapshot_of(snapshot: Snapshot, source_path: str) -> bool:
+    source = SourceInfo.from_file(source_path)
+    if source.size != snapshot.source.size:
+        return False
+    if source.mtime_ns == snapshot.source.mtime_ns:
+        return True
+    # Touched or copied, but not necessarily changed: only the content decides
+    return file_digest(source_path) == snapshot.source.digest
+
+
+def load_or_build_snapshot(source_path: str, path: str = SNAPSHOT_PATH) -> MessageStore:
+    """
+    The export as a MessageStore, mapped from the snapshot when it was built from this very export,
+    parsed and saved as a new snapshot otherwise
+    """
+
+    started = time.perf_counter()
+    snapshot = load_snapshot(path)
+    if snapshot is not None and is_snapshot_of(snapshot, source_path):
+        seconds = time.perf_counter() - started
+        logger.info(f'Loaded {len(snapshot.store)} messages from the snapshot in {seconds:.3f}s, '
+                    f'parsing the export took {snapshot.build_seconds:.2f}s '
+                    f'({snapshot.build_seconds / max(seconds, 1e-6):.0f}x faster)')
+        return snapshot.store
+
+    if snapshot is not None:
+        logger.info(f'{source_path} has changed since the snapshot was built, rebuilding it')
+
+    # Taken before parsing, so an export replaced in the meantime does not match the snapshot next time
+    source = SourceInfo.from_file(source_path, with_digest=True)
+    started = time.perf_counter()
+    store = MessageStore.from_export(source_path)
+    build_seconds = time.perf_counter() - started
+    save_snapshot(store, source, build_seconds, path)
+    logger.info(f'Parsed the export in {build_seconds:.2f}s, the next runs load the snapshot instead')
+    return store
@@ -0,0 +1,270 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+from telethon import TelegramClient
+
+from cache_store import CACHE_DB_PATH, CacheStore, SQLiteCacheStore
+from llm_backend import FakeBackend, LLMBackend, OpenAIBackend
+from message_fetcher import FETCHED_RANGE_TTL, FetchGate, MessageCache
+from sender_cache import SenderCache
+from summarizer import (API_HASH, API_ID, OPENAI_API_KEY, SUMMARY_MODEL, UserParameters, get_user_parameters,
+                        summarize_range)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Jobs run at once, the rest wait queued. The Telegram client and the rate limiter are shared by all of them
+MAX_JOBS = 4
+
+# Finished jobs are kept for their status and summary, the oldest are forgotten past this
+JOB_HISTORY = 1000
+
+MAX_REQUEST_BYTES = 1 << 20
+
+
+@dataclass
+class Job:
+    id: str
+    key: tuple
+    params: UserParameters
+    refetch: bool = False
+    status: str = 'queued'
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    summary: str | None = None
+    error: str | None = None
+    # Identical requests answered by this job, the first one included
+    requests: int = 1
+    task: asyncio.Task | None = field(default=None, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'failed')
+
+    def as_dict(self, with_summary: bool = True) -> dict:
+        result = {
+            'id': self.id,
+            'status': self.status,
+            'channel': self.params.channel_name,
+            'thread_id': self.params.thread_id,
+            'start_message_id': self.params.start_message_id,
+            'end_message_id': self.params.end_message_id,
+            'requests': self.requests,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'seconds': round(self.finished_at - self.started_at, 3) if self.finished_at and self.started_at else None,
+            'error': self.error,
+        }
+        if with_summary:
+            result['summary'] = self.summary
+        return result
+
+
+class SummarizerService:
+    """
+    Summarizes discussions for clients of a local HTTP API, with one started Telegram client and one model backend
+    kept for the life of the process. Jobs run concurrently up to max_jobs. A request identical to a job still
+    queued or running (same range, instructions and refetch) gets that job instead of a new one
+    """
+
+    def __init__(self, client, backend: LLMBackend, max_jobs: int = MAX_JOBS, max_tokens: int | None = None,
+                 message_cache: MessageCache | None = None, sender_cache: SenderCache | None = None,
+                 cache: CacheStore | None = None):
+        self.client = client
+        self.backend = backend
+        self.max_tokens = max_tokens
+        self.message_cache = message_cache or MessageCache()
+        self.sender_cache = sender_cache or SenderCache()
+        self.cache = cache or SQLiteCacheStore(CACHE_DB_PATH)
+        self.semaphore = asyncio.Semaphore(max_jobs)
+        # Every job fetches through the one client, so they share its window limit and FloodWaits
+        self.fetch_gate = FetchGate()
+        self.jobs: dict[str, Job] = {}
+        self.in_flight: dict[tuple, Job] = {}
+
+    @staticmethod
+    def get_job_key(params: UserParameters, refetch: bool) -> tuple:
+        # Usernames in links are case-insensitive
+        return (params.channel_name.lower(), params.thread_id, params.start_message_id, params.end_message_id,
+                params.basic_instructions, refetch)
+
+    def submit(self, start_url: str, end_url: str | None = None, instructions: str | None = None,
+               refetch: bool = False) -> tuple[Job, bool]:
+        """
+        The job of the request and whether it was already in flight. Invalid links raise ValueError
+        """
+
+        params = get_user_parameters(start_url, end_url, instructions)
+        key = self.get_job_key(params, refetch)
+
+        job = self.in_flight.get(key)
+        if job is not None:
+            job.requests += 1
+            logger.info(f'Request for {start_url} joins job {job.id}')
+            return job, True
+
+        job = Job(uuid.uuid4().hex[:12], key, params, refetch)
+        self.jobs[job.id] = job
+        self.in_flight[key] = job
+        job.task = asyncio.create_task(self.run_job(job))
+        self.forget_finished()
+        logger.info(f'Job {job.id} queued for {start_url}')
+        return job, False
+
+    def forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(self.jobs) - JOB_HISTORY)]:
+            del self.jobs[job_id]
+
+    async def run_job(self, job: Job):
+        async with self.semaphore:
+            job.status = 'running'
+            job.started_at = time.time()
+            try:
+                job.summary = await summarize_range(self.client, job.params, self.backend, job.refetch,
+                                                    self.max_tokens, message_cache=self.message_cache,
+                                                    sender_cache=self.sender_cache, cache=self.cache,
+                                                    fetch_gate=self.fetch_gate)
+                if job.summary is None:
+                    job.error = 'No messages found in the specified period'
+                job.status = 'done'
+            except Exception as e:
+                logger.exception(f'Job {job.id} failed')
+                job.error = f'{type(e).__name__}: {e}'
+                job.status = 'failed'
+            finally:
+                job.finished_at = time.time()
+                self.in_flight.pop(job.key, None)
+                logger.info(f'Job {job.id} {job.status} in {job.finished_at - job.started_at:.1f}s')
+
+    async def handle(self, method: str, target: str, body: bytes) -> tuple[int, dict]:
+        url = urlsplit(target)
+        path = url.path.rstrip('/')
+        query = parse_qs(url.query)
+
+        if path == '/health' and method == 'GET':
+            statuses = [job.status for job in self.jobs.values()]
+            return 200, {'status': 'ok', 'jobs': {status: statuses.count(status) for status in set(statuses)}}
+
+        if path == '/jobs' and method == 'POST':
+            try:
+                request = json.loads(body or b'{}')
+                if not isinstance(request, dict) or not request.get('start_url'):
+                    raise ValueError('start_url is required')
+                if not isinstance(request['start_url'], str):
+                    raise ValueError('start_url must be a string')
+                for name in ('end_url', 'instructions'):
+                    if not isinstance(request.get(name), str | None):
+                        raise ValueError(f'{name} must be a string')
+                if not isinstance(request.get('refetch', False), bool):
+                    raise ValueError('refetch must be true or false')
+                job, joined = self.submit(request['start_url'], request.get('end_url'), request.get('instructions'),
+                                          request.get('refetch', False))
+            except ValueError as e:
+                return 400, {'error': str(e)}
+            return (200 if joined else 202), {**job.as_dict(), 'deduplicated': joined}
+
+        if path == '/jobs' and method == 'GET':
+            return 200, {'jobs': [job.as_dict(with_summary=False) for job in self.jobs.values()]}
+
+        if path.startswith('/jobs/') and method == 'GET':
+            job = self.jobs.get(path.removeprefix('/jobs/'))
+            if job is None:
+                return 404, {'error': 'No such job'}
+            # ?wait=1 answers once the job is finished, shielded so a client going away does not cancel it
+            if query.get('wait', ['0'])[0] not in ('0', 'false') and not job.finished:
+                await asyncio.shield(job.task)
+            return 200, job.as_dict()
+
+        return 404, {'error': f'No route for {method} {url.path}'}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get('content-length', 0))
+            if length > MAX_REQUEST_BYTES:
+                status, payload = 413, {'error': 'Request too large'}
+            else:
+                body = await reader.readexactly(length) if length else b''
+                status, payload = await self.handle(method, target, body)
+        except (ValueError, asyncio.IncompleteReadError):
+            status, payload = 400, {'error': 'Malformed request'}
+        except Exception as e:
+            logger.exception('Request failed')
+            status, payload = 500, {'error': f'{type(e).__name__}: {e}'}
+
+        try:
+            data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            writer.write(
+                f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n'
+                f'Content-Type: application/json; charset=utf-8\r\n'
+                f'Content-Length: {len(data)}\r\n'
+                f'Connection: close\r\n\r\n'.encode('latin-1') + data
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                    socket_path: str | None = None) -> asyncio.Server:
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle_connection, socket_path)
+            logger.info(f'Listening on {socket_path}')
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            logger.info(f'Listening on http://{host}:{server.sockets[0].getsockname()[1]}')
+        return server
+
+
+async def serve(args: argparse.Namespace):
+    backend = FakeBackend(SUMMARY_MODEL) if args.fake_llm else OpenAIBackend(SUMMARY_MODEL, api_key=OPENAI_API_KEY)
+    client = TelegramClient('session', API_ID, API_HASH)
+
+    await asyncio.gather(client.start(), backend.warm_up())
+    logger.info('Authorized successfully.')
+
+    os.makedirs(os.path.dirname(CACHE_DB_PATH), exist_ok=True)
+
+    service = SummarizerService(client, backend, args.max_jobs, args.max_tokens,
+                                message_cache=MessageCache(ttl=args.fetch_ttl * 60))
+    server = await service.start(args.host, args.port, args.socket)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Telegram discussion summarizer as a local service')
+    parser.add_argument('--host', type=str, default=DEFAULT_HOST, help=f'Address to listen on (default is {DEFAULT_HOST})')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'Port to listen on (default is {DEFAULT_PORT})')
+    parser.add_argument('--socket', type=str, help='Listen on a Unix socket at this path instead of a TCP port')
+    parser.add_argument('-j', '--max-jobs', type=int, default=MAX_JOBS,
+                        help=f'Jobs summarized at once, the rest wait queued (default is {MAX_JOBS})')
+    parser.add_argument('-t', '--max-tokens', type=int,
+                        help='Token budget of a single request, longer discussions are summarized in parts '
+                             '(default is what fits the model)')
+    parser.add_argument('--fetch-ttl', type=float, default=FETCHED_RANGE_TTL / 60, metavar='MINUTES',
+                        help='Minutes fetched messages are reused before their range is fetched again for edits '
+                             f'(default is {FETCHED_RANGE_TTL // 60:g}, inf never fetches them again)')
+    parser.add_argument('--fake-llm', action='store_true', help='Answer with a local stand-in instead of the OpenAI API')
+
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    asyncio.run(serve(args))
@@ -0,0 +1,135 @@
+import email.parser
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+
+class FakeBatchAPI:
+    """
+    Local HTTP stand-in for the files and batches endpoints of the OpenAI API.
+    A batch completes on its polls_to_complete-th status check, complete answers every request
+    with the text of the completion, or None to fail it
+    """
+
+    def __init__(self, complete: Callable[[dict], str | None], polls_to_complete: int = 2):
+        self.complete = complete
+        self.polls_to_complete = polls_to_complete
+        self.files: dict[str, bytes] = {}
+        self.batches: dict[str, dict] = {}
+        self.polls: dict[str, int] = {}
+        self.ids = itertools.count(1)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address
+        return f'http://{host}:{port}/v1'
+
+    @property
+    def submitted_requests(self) -> int:
+        return sum(batch['request_counts']['total'] for batch in self.batches.values())
+
+    def __enter__(self) -> 'FakeBatchAPI':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def create_file(self, content_type: str, body: bytes) -> dict:
+        message = email.parser.BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        part = next(part for part in message.get_payload() if part.get_filename())
+        file_id = f'file-{next(self.ids)}'
+        self.files[file_id] = part.get_payload(decode=True)
+        return {'id': file_id, 'object': 'file', 'bytes': len(self.files[file_id]), 'created_at': int(time.time()),
+                'filename': part.get_filename(), 'purpose': 'batch', 'status': 'processed'}
+
+    def create_batch(self, params: dict) -> dict:
+        batch_id = f'batch-{next(self.ids)}'
+        requests = self.files[params['input_file_id']].decode('utf-8').splitlines()
+        self.batches[batch_id] = {
+            'id': batch_id, 'object': 'batch', 'endpoint': params['endpoint'], 'input_file_id': params['input_file_id'],
+            'completion_window': params['completion_window'], 'status': 'validating', 'created_at': int(time.time()),
+            'output_file_id': None, 'error_file_id': None,
+            'request_counts': {'total': len(requests), 'completed': 0, 'failed': 0},
+        }
+        self.polls[batch_id] = 0
+        return self.batches[batch_id]
+
+    def retrieve_batch(self, batch_id: str) -> dict:
+        batch = self.batches[batch_id]
+        self.polls[batch_id] += 1
+        if batch['status'] == 'validating':
+            batch['status'] = 'in_progress'
+        if batch['status'] == 'in_progress' and self.polls[batch_id] >= self.polls_to_complete:
+            self.run_batch(batch)
+        return batch
+
+    def run_batch(self, batch: dict):
+        output, errors = [], []
+        for line in self.files[batch['input_file_id']].decode('utf-8').splitlines():
+            request = json.loads(line)
+            content = self.complete(request['body'])
+            if content is None:
+                errors.append({'id': f'req-{next(self.ids)}', 'custom_id': request['custom_id'], 'response': None,
+                               'error': {'code': 'context_length_exceeded', 'message': 'Request too large'}})
+                continue
+            prompt = request['body']['messages'][0]['content']
+            body = {
+                'id': f'chatcmpl-{next(self.ids)}', 'object': 'chat.completion', 'model': request['body']['model'],
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4,
+                          'total_tokens': (len(prompt) + len(content)) // 4},
+            }
+            output.append({'id': f'req-{next(self.ids)}', 'custom_id': request['custom_id'],
+                           'response': {'status_code': 200, 'request_id': body['id'], 'body': body}, 'error': None})
+
+        for key, lines in (('output_file_id', output), ('error_file_id', errors)):
+            if lines:
+                file_id = f'file-{next(self.ids)}'
+                self.files[file_id] = ''.join(json.dumps(line) + '\n' for line in lines).encode('utf-8')
+                batch[key] = file_id
+        batch['status'] = 'completed'
+        batch['request_counts'].update(completed=len(output), failed=len(errors))
+
+    def make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, data: dict):
+                self.send_bytes(json.dumps(data).encode('utf-8'), 'application/json')
+
+            def send_bytes(self, body: bytes, content_type: str):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if self.path == '/v1/files':
+                    self.send_json(api.create_file(self.headers['Content-Type'], body))
+                elif self.path == '/v1/batches':
+                    self.send_json(api.create_batch(json.loads(body)))
+                else:
+                    self.send_error(404)
+
+            def do_GET(self):
+                if match := re.fullmatch(r'/v1/batches/([\w-]+)', self.path):
+                    self.send_json(api.retrieve_batch(match[1]))
+                elif match := re.fullmatch(r'/v1/files/([\w-]+)/content', self.path):
+                    self.send_bytes(api.files[match[1]], 'application/octet-stream')
+                else:
+                    self.send_error(404)
+
+        return Handler
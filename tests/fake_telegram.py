@@ -0,0 +1,56 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from telethon.errors import FloodWaitError
+from telethon.helpers import TotalList
+from telethon.tl.types import User
+
+START = datetime(2025, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def make_message(message_id: int, reply_to: int | None = None, with_sender: bool = True):
+    sender_id = message_id % 3 + 1
+    return SimpleNamespace(
+        id=message_id,
+        date=START + timedelta(minutes=message_id),
+        text=f'message {message_id}',
+        reply_to=SimpleNamespace(reply_to_msg_id=reply_to) if reply_to else None,
+        sender_id=sender_id,
+        sender=User(id=sender_id, first_name='Имя', username=f'user{sender_id}') if with_sender else None,
+    )
+
+
+class StubClient:
+    """
+    Serves iter_messages and get_messages from a dict of messages, with the exclusive min_id and max_id
+    of Telethon, counting the messages served and raising the FloodWaits it is given
+    """
+
+    def __init__(self, messages: list, flood_waits: list[int] = (), latency: float = 0.0):
+        self.messages = {message.id: message for message in messages}
+        self.flood_waits = list(flood_waits)
+        self.latency = latency
+        self.served = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def iter_messages(self, entity, reply_to=None, min_id=0, max_id=0, reverse=False):
+        assert reverse
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            for message_id in sorted(self.messages):
+                if min_id < message_id < (max_id or float('inf')):
+                    await asyncio.sleep(self.latency)
+                    if self.flood_waits:
+                        raise FloodWaitError(None, capture=self.flood_waits.pop())
+                    self.served.append(message_id)
+                    yield self.messages[message_id]
+        finally:
+            self.in_flight -= 1
+
+    async def get_messages(self, entity, limit=None, reply_to=None):
+        latest = TotalList([self.messages[max(self.messages)]] if self.messages else [])
+        latest.total = len(self.messages)
+        return latest
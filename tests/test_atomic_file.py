@@ -0,0 +1,28 @@
+import pytest
+
+from atomic_file import open_atomic
+
+
+def test_file_is_replaced_once_written(tmp_path):
+    path = str(tmp_path / 'state.json')
+    with open_atomic(path) as f:
+        f.write('{"version": 1}')
+    with open_atomic(path, 'wb') as f:
+        f.write(b'{"version": 2}')
+
+    assert open(path, encoding='utf-8').read() == '{"version": 2}'
+    assert [file.name for file in tmp_path.iterdir()] == ['state.json']
+
+
+def test_failed_write_keeps_the_old_file(tmp_path):
+    path = str(tmp_path / 'state.json')
+    with open_atomic(path) as f:
+        f.write('old')
+
+    with pytest.raises(RuntimeError):
+        with open_atomic(path) as f:
+            f.write('new')
+            raise RuntimeError('Interrupted')
+
+    assert open(path, encoding='utf-8').read() == 'old'
+    assert [file.name for file in tmp_path.iterdir()] == ['state.json']
@@ -0,0 +1,169 @@
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+from openai import AsyncOpenAI
+
+import batch_api
+from batch_api import BatchRequest, BatchRunner, load_batch_state, parse_result_line, write_batch_inputs
+from benchmarks.synthetic_export import write_export
+from cache_store import MemoryCacheStore
+from llm_backend import FakeBackend
+from metrics import Metrics
+from fake_batch_api import FakeBatchAPI
+from historizer import Historizer
+from test_historizer import IdRangeBackend
+
+
+def complete(body: dict) -> str | None:
+    content = body['messages'][0]['content']
+    if 'fail' in content:
+        return None
+    return f'summary of {content}'
+
+
+def make_request(i: int, prompt: str | None = None) -> BatchRequest:
+    return BatchRequest(custom_id=f'key-{i}', model='gpt-4.1-nano', temperature=0.3, prompt=prompt or f'prompt {i}',
+                        inputs={'first_id': i})
+
+
+@pytest.fixture
+def api():
+    with FakeBatchAPI(complete) as api:
+        yield api
+
+
+@pytest.fixture
+def runner(api, tmp_path):
+    client = AsyncOpenAI(api_key='test', base_url=api.base_url, max_retries=0)
+    return BatchRunner(client, MemoryCacheStore(), state_path=str(tmp_path / 'batch.json'),
+                       input_dir=str(tmp_path / 'batches'), poll_interval=0)
+
+
+def test_inputs_are_split_by_batch_limits(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_api, 'BATCH_MAX_REQUESTS', 3)
+
+    files = write_batch_inputs([make_request(i) for i in range(7)] + [make_request(0)], str(tmp_path))
+
+    assert [len(requests) for _, requests in files] == [3, 3, 1]
+    with open(files[0][0], 'rb') as f:
+        line = json.loads(f.readline())
+    assert line['custom_id'] == 'key-0'
+    assert line['url'] == '/v1/chat/completions'
+    assert line['body']['messages'] == [{'role': 'user', 'content': 'prompt 0'}]
+
+
+def test_failed_result_line():
+    line = json.dumps({'custom_id': 'key-1', 'response': None, 'error': {'code': 'context_length_exceeded'}})
+    assert parse_result_line(line) == ('key-1', None)
+
+
+@pytest.mark.asyncio
+async def test_results_are_cached_with_batch_pricing(runner, api):
+    collected = await runner.run([make_request(1), make_request(2, 'fail please')])
+
+    assert collected == 1
+    assert runner.cache.get('key-1') == 'summary of prompt 1'
+    assert runner.cache.get('key-2') is None
+
+    entry = runner.cache.entries['key-1']
+    assert entry.inputs == {'first_id': 1, 'batch_id': 'batch-2'}
+    full_price = (entry.prompt_tokens * 0.10 + entry.completion_tokens * 0.40) / 1_000_000
+    assert entry.cost == pytest.approx(full_price / 2)
+    assert not os.path.exists(runner.state_path)
+
+
+@pytest.mark.asyncio
+async def test_batch_results_are_recorded_in_the_metrics(runner, api, tmp_path):
+    runner.metrics = Metrics(str(tmp_path / 'metrics.jsonl'))
+
+    await runner.run([make_request(1), make_request(2, 'fail please')])
+
+    usage = runner.metrics.models['gpt-4.1-nano']
+    entry = runner.cache.entries['key-1']
+    assert (usage.calls, usage.failures) == (1, 0)
+    assert (usage.prompt_tokens, usage.completion_tokens) == (entry.prompt_tokens, entry.completion_tokens)
+    assert usage.cost == pytest.approx(entry.cost)
+
+
+@pytest.mark.asyncio
+async def test_interrupted_run_resumes_submitted_batches(runner, api):
+    await runner.submit([make_request(i) for i in range(3)])
+    assert load_batch_state(runner.state_path).batch_ids == ['batch-2']
+
+    # A new process only has the state file to go on
+    resumed = await BatchRunner(runner.client, runner.cache, runner.state_path, runner.input_dir, 0).resume()
+
+    assert resumed == {'key-0', 'key-1', 'key-2'}
+    assert runner.cache.get('key-2') == 'summary of prompt 2'
+    assert len(api.batches) == 1
+    assert await runner.resume() == set()
+
+
+class BatchChatModel(IdRangeBackend):
+    def __init__(self, client: AsyncOpenAI, **kwargs):
+        super().__init__(**kwargs)
+        self.client = client
+
+    @property
+    def batch_client(self) -> AsyncOpenAI:
+        return self.client
+
+
+class TestBatchRun:
+    @pytest.fixture
+    def chat_models(self, monkeypatch, api):
+        models = []
+        client = AsyncOpenAI(api_key='test', base_url=api.base_url, max_retries=0)
+
+        def make_chat_model(model: str, **kwargs):
+            models.append(BatchChatModel(client, latency=0, model_name=model))
+            return models[-1]
+
+        monkeypatch.setattr('historizer.OpenAIBackend', make_chat_model)
+        return models
+
+    async def run(self, tmp_path, **kwargs):
+        path = str(tmp_path / 'result.json')
+        write_export(path, 600)
+        with patch('historizer.CHAT_HISTORY_PATH', path):
+            return await Historizer(chunk_tokens=3000, group_size=3, batch_poll_interval=0, **kwargs).run()
+
+    @pytest.mark.asyncio
+    async def test_batch_run_leaves_nothing_to_the_live_pass(self, tmp_path, monkeypatch, api, chat_models):
+        monkeypatch.chdir(tmp_path)
+
+        await self.run(tmp_path, batch=True)
+
+        assert api.submitted_requests > 1
+        assert chat_models[0].calls == 0
+        # A rerun finds every chunk in the cache and submits nothing
+        await self.run(tmp_path, batch=True)
+        assert len(api.batches) == 1
+
+    @pytest.mark.asyncio
+    async def test_failed_requests_go_to_the_live_pass(self, tmp_path, monkeypatch, api, chat_models):
+        monkeypatch.chdir(tmp_path)
+        api.complete = lambda body: None if 'Участник 1 ' in body['messages'][0]['content'] else complete(body)
+
+        await self.run(tmp_path, batch=True)
+
+        failed = api.batches['batch-2']['request_counts']['failed']
+        assert 0 < failed < api.submitted_requests
+        assert chat_models[0].calls == failed
+
+    @pytest.mark.asyncio
+    async def test_backend_without_batches_is_rejected_before_any_request(self, tmp_path, monkeypatch, api):
+        monkeypatch.chdir(tmp_path)
+
+        def no_client(*args, **kwargs):
+            raise AssertionError('An OpenAI client was built')
+
+        monkeypatch.setattr('openai.AsyncOpenAI', no_client)
+        monkeypatch.setattr('llm_backend.AsyncOpenAI', no_client)
+
+        with pytest.raises(ValueError, match='Batch API'):
+            await self.run(tmp_path, batch=True, backend_factory=lambda model: FakeBackend(model))
+
+        assert api.batches == {}
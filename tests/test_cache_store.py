@@ -0,0 +1,70 @@
+import sqlite3
+
+import pytest
+
+from cache_store import CacheEntry, CacheStore, MemoryCacheStore, SQLiteCacheStore
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        yield MemoryCacheStore()
+    else:
+        store = SQLiteCacheStore(str(tmp_path / 'summaries.sqlite3'))
+        yield store
+        store.close()
+
+
+def test_get_many_returns_only_cached_keys(store):
+    store.put('a', CacheEntry('summary a'))
+    store.put('b', CacheEntry('summary b'))
+
+    assert store.get_many(['a', 'b', 'c']) == {'a': 'summary a', 'b': 'summary b'}
+    assert store.get('c') is None
+    assert store.stats() == {'hits': 2, 'misses': 2, 'entries': 2, 'bytes': 18}
+
+
+def test_put_replaces_entry(store):
+    store.put('a', CacheEntry('old'))
+    store.put('a', CacheEntry('new'))
+
+    assert store.get('a') == 'new'
+    assert store.size() == (1, 3)
+
+
+def test_evict_keeps_most_recently_used(store):
+    for key in 'abcd':
+        store.put(key, CacheEntry(key * 10))
+    store.get('a')
+
+    assert store.evict(25) == 2
+    assert store.get_many('abcd').keys() == {'a', 'd'}
+
+
+def test_lookup_over_parameter_limit(tmp_path):
+    store = SQLiteCacheStore(str(tmp_path / 'summaries.sqlite3'))
+    for i in range(1200):
+        store.put(str(i), CacheEntry(f'summary {i}'))
+
+    assert len(store.get_many(str(i) for i in range(2000))) == 1200
+
+
+def test_sqlite_entry_keeps_metadata(tmp_path):
+    path = str(tmp_path / 'summaries.sqlite3')
+    SQLiteCacheStore(path).put('a', CacheEntry('summary', model='gpt-4.1-nano', prompt_tokens=100,
+                                               completion_tokens=10, cost=0.5, inputs={'first_id': 1}))
+
+    # A new connection sees the committed entry
+    assert SQLiteCacheStore(path).get_entry('a') == CacheEntry('summary', 'chunk', 'gpt-4.1-nano', 100, 10, 0.5,
+                                                               {'first_id': 1})
+    created_at, = sqlite3.connect(path).execute('SELECT created_at FROM summaries').fetchone()
+    assert created_at
+
+
+def test_incomplete_store_can_not_be_instantiated():
+    class LookupOnlyStore(CacheStore):
+        def lookup(self, keys: list[str]) -> dict[str, str]:
+            return {}
+
+    with pytest.raises(TypeError):
+        LookupOnlyStore()
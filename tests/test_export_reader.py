@@ -0,0 +1,56 @@
+import io
+import json
+
+import pytest
+
+from benchmarks.synthetic_export import write_export
+from export_reader import ExportReader, iter_raw_messages
+
+
+def read_messages(text: str, buffer_size: int) -> list:
+    return list(ExportReader(io.StringIO(text), buffer_size).iter_messages())
+
+
+@pytest.mark.parametrize('buffer_size', [1, 7, 64, 1 << 20])
+def test_reads_messages_across_buffer_boundaries(buffer_size):
+    export = {
+        'name': 'Чат',
+        'type': 'public_supergroup',
+        'id': 1234567890,
+        'messages': [
+            {'id': 1, 'type': 'message', 'text': ['привет ', {'type': 'bold', 'text': 'мир'}]},
+            {'id': 22, 'type': 'service', 'action': 'pin_message', 'text': 'a, "b" ] }'},
+        ],
+    }
+    text = json.dumps(export, ensure_ascii=False, indent=1)
+
+    assert read_messages(text, buffer_size) == export['messages']
+
+
+@pytest.mark.parametrize('text', [
+    '{"messages": []}',
+    '{}',
+    '{"name": "a", "id": 1}',
+])
+def test_exports_without_messages(text):
+    assert read_messages(text, 3) == []
+
+
+def test_messages_after_trailing_keys():
+    text = '{"messages": [{"id": 1}], "id": 12345}'
+    assert read_messages(text, 4) == [{'id': 1}]
+
+
+def test_truncated_export_raises():
+    with pytest.raises(ValueError):
+        read_messages('{"messages": [{"id": 1}, {"id": 2', 4)
+
+
+def test_synthetic_export_matches_json_load(tmp_path):
+    path = tmp_path / 'result.json'
+    write_export(str(path), 500)
+
+    with open(path, encoding='utf-8') as file:
+        expected = json.load(file)['messages']
+
+    assert list(iter_raw_messages(str(path), buffer_size=4096)) == expected
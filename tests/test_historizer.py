@@ -1,9 +1,43 @@
-import hashlib
+import asyncio
+import os
+import time
+from datetime import datetime
 from unittest.mock import patch, MagicMock
 
 import pytest
 
-from historizer import split_chat_history, ensure_dirs_exist, CACHE_DIR, SUMMARY_DIR, Historizer
+from benchmarks.synthetic_export import write_export
+from checkpoint import load_checkpoint
+from historizer import (split_chat_history, split_chat_history_by_tokens, ensure_dirs_exist, iter_chat_history,
+                        load_chat_history, get_prompt_version, CACHE_DIR, CHUNK_PROMPT_VERSION, SUMMARY_DIR, TODAY,
+                        Historizer)
+from llm_backend import Completion, FakeBackend
+from models import UserMessage
+from token_counter import count_tokens
+
+
+class IdRangeBackend(FakeBackend):
+    """The backend's fake, answering with the range of message ids in the prompt, so a summary tells its chunk"""
+
+    def __init__(self, model_name: str = 'fake-model', latency: float = 0.05, **options):
+        super().__init__(model_name, latency=latency, **options)
+
+    def answer(self, prompt: str) -> str:
+        ids = [line.split(': ', 1)[1] for line in prompt.splitlines() if line.startswith('msg: ')]
+        if not ids:
+            return f'summary of {len(prompt)} characters'
+        return f'summary {ids[0]}-{ids[-1]}'
+
+
+def make_message(message_id: int, text: str | None = None, date: datetime | None = None) -> UserMessage:
+    return UserMessage.model_validate({
+        'id': message_id,
+        'type': 'message',
+        'date': (date or datetime(2022, 5, 12, 10, 0, message_id % 60)).isoformat(),
+        'date_unixtime': '1652349600',
+        'from': 'Alice',
+        'text': text if text is not None else f'msg: {message_id}',
+    })
 
 
 @pytest.fixture
@@ -11,6 +45,12 @@ def historizer():
     return Historizer()
 
 
+@pytest.fixture
+def isolated_historizer(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return Historizer(concurrency=4)
+
+
 class TestSplitChatHistory:
     @pytest.mark.asyncio
     async def test_split_chat_history_empty_list(self):
@@ -74,6 +114,59 @@ class TestSplitChatHistory:
         assert len(result[1]) == len(test_list) - default_chunk_size
 
 
+class TestSplitChatHistoryByTokens:
+    @pytest.mark.asyncio
+    async def test_packs_messages_up_to_budget(self):
+        # Each rendered message is 40 ascii characters: 11 tokens plus 1 for the separator
+        messages = ['x' * 40] * 10
+        result = await split_chat_history_by_tokens(messages, lambda m: m, max_tokens=36)
+
+        assert [len(chunk) for chunk in result] == [3, 3, 3, 1]
+
+    @pytest.mark.asyncio
+    async def test_oversized_message_gets_own_chunk(self):
+        messages = ['short', 'x' * 4000, 'short']
+        result = await split_chat_history_by_tokens(messages, lambda m: m, max_tokens=100)
+
+        assert result == [['short'], ['x' * 4000], ['short']]
+
+    @pytest.mark.asyncio
+    async def test_max_messages_caps_chunk(self):
+        messages = list(range(10))
+        result = await split_chat_history_by_tokens(messages, str, max_tokens=10_000, max_messages=4)
+
+        assert result == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+    @pytest.mark.asyncio
+    async def test_period_starts_new_chunk(self):
+        dates = [datetime(2022, 5, 30), datetime(2022, 5, 31), datetime(2022, 6, 1), datetime(2022, 6, 2),
+                 datetime(2022, 7, 1)]
+        messages = [make_message(i, date=date) for i, date in enumerate(dates)]
+
+        result = await split_chat_history_by_tokens(messages, lambda m: m.text, max_tokens=10_000, period='month')
+
+        assert [[m.id for m in chunk] for chunk in result] == [[0, 1], [2, 3], [4]]
+
+    @pytest.mark.asyncio
+    async def test_boundaries_are_stable_when_messages_are_appended(self, historizer):
+        messages = [make_message(i, text='сообщение ' * (i % 7 + 1)) for i in range(200)]
+
+        before = await split_chat_history_by_tokens(messages, historizer.render_message, max_tokens=500)
+        after = await split_chat_history_by_tokens(messages + [make_message(200)], historizer.render_message, max_tokens=500)
+
+        assert after[:-1] == before[:-1]
+
+
+@pytest.mark.asyncio
+async def test_iter_chat_history_matches_load_chat_history(tmp_path):
+    path = str(tmp_path / 'result.json')
+    write_export(path, 300)
+
+    chat_history = await load_chat_history(path)
+
+    assert list(iter_chat_history(path)) == chat_history.messages
+
+
 def test_ensure_dirs_exist():
     mock_cache_path = MagicMock()
     mock_summary_path = MagicMock()
@@ -90,14 +183,371 @@ def test_ensure_dirs_exist():
         mock_summary_path.mkdir.assert_called_once_with(parents=True, exist_ok=True)
 
 
-def test_get_chunk_hash_single_message(historizer):
-    msg = MagicMock()
-    msg.id = 123
+class TestChunkCache:
+    def test_get_chunk_hash_depends_on_every_input(self, historizer):
+        documents = historizer.render_chunk([make_message(1), make_message(2)])
+        inputs = historizer.get_cache_inputs(documents, IdRangeBackend())
+        chunk_hash = historizer.get_chunk_hash(inputs)
+
+        assert chunk_hash == historizer.get_chunk_hash(dict(inputs))
+        for key, value in [('content_digest', 'edited'), ('prompt_version', 'v2'), ('model', 'gpt-4.1'), ('temperature', 0.7)]:
+            assert historizer.get_chunk_hash({**inputs, key: value}) != chunk_hash
+
+    def test_edited_message_changes_chunk_hash(self, historizer):
+        chat_model = IdRangeBackend()
+        before = historizer.render_chunk([make_message(1), make_message(2)])
+        after = historizer.render_chunk([make_message(1), make_message(2, text='edited')])
+
+        assert (historizer.get_chunk_hash(historizer.get_cache_inputs(before, chat_model))
+                != historizer.get_chunk_hash(historizer.get_cache_inputs(after, chat_model)))
+
+    @pytest.mark.asyncio
+    async def test_packed_chunks_are_not_rendered_again(self, historizer):
+        messages = [make_message(i) for i in range(10)]
+        expected = historizer.render_chunk(messages)
+        chunks = await split_chat_history_by_tokens(messages, historizer.render_message, max_tokens=100)
+
+        with patch('renderer.render_messages') as render_messages, \
+                patch.object(historizer, 'resolve_reply') as resolve_reply:
+            documents = [historizer.prepare_chunk(chunk, IdRangeBackend()).documents for chunk in chunks]
+
+        assert len(chunks) > 1
+        assert '\n\n'.join(documents) == expected
+        render_messages.assert_not_called()
+        resolve_reply.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_only_changed_chunks_are_resummarized(self, isolated_historizer):
+        chunks = [[make_message(i * 10 + j) for j in range(10)] for i in range(3)]
+        await isolated_historizer.summarize_chunks(chunks, IdRangeBackend())
+
+        chunks[1][5] = make_message(15, text='msg: 15 edited')
+        chat_model = IdRangeBackend()
+        await isolated_historizer.summarize_chunks(chunks, chat_model)
+
+        assert chat_model.calls == 1
+
+    @pytest.mark.asyncio
+    async def test_cache_entry_records_inputs(self, isolated_historizer):
+        chunk = [make_message(i) for i in range(5)]
+        await isolated_historizer.summarize_chunk(chunk, IdRangeBackend(model_name='gpt-4.1-nano'))
+
+        prepared = isolated_historizer.prepare_chunk(chunk, IdRangeBackend(model_name='gpt-4.1-nano'))
+        entry = isolated_historizer.cache.get_entry(prepared.chunk_hash)
+
+        assert entry.summary == 'summary 0-4'
+        assert entry.model == 'gpt-4.1-nano'
+        assert entry.prompt_tokens > entry.completion_tokens > 0
+        assert entry.cost > 0
+        assert entry.inputs['prompt_version'] == CHUNK_PROMPT_VERSION
+        assert (entry.inputs['first_id'], entry.inputs['last_id'], entry.inputs['messages']) == (0, 4, 5)
+
+    @pytest.mark.asyncio
+    async def test_cached_chunks_are_looked_up_in_batches(self, isolated_historizer):
+        chunks = [[make_message(i)] for i in range(20)]
+        await isolated_historizer.summarize_chunks(chunks, IdRangeBackend(latency=0))
+
+        with patch.object(isolated_historizer.cache, 'lookup', wraps=isolated_historizer.cache.lookup) as lookup:
+            result = await isolated_historizer.summarize_chunks(chunks, IdRangeBackend())
+
+        assert result == [f'summary {i}-{i}' for i in range(20)]
+        # Nothing is pending when every chunk is cached, so each lookup takes a full window of 8 chunks
+        assert [len(call.args[0]) for call in lookup.call_args_list] == [8, 8, 4]
+        assert isolated_historizer.cache.stats()['hits'] == 20
+
+
+class TestReduceCache:
+    @pytest.fixture
+    def summaries(self):
+        return [f'chunk summary {i}' for i in range(10)]
+
+    async def reduce(self, historizer, summaries):
+        group_model, final_model = IdRangeBackend(latency=0), IdRangeBackend(latency=0)
+        result = await historizer.summarize_final_in_groups(summaries, group_model, final_model, group_size=3)
+        return result, group_model.calls, final_model.calls
+
+    @pytest.mark.asyncio
+    async def test_rerun_is_served_from_cache(self, isolated_historizer, summaries):
+        first = await self.reduce(isolated_historizer, summaries)
+        second = await self.reduce(isolated_historizer, summaries)
+
+        assert first[1:] == (4, 1)
+        assert second == (first[0], 0, 0)
+
+    @pytest.mark.asyncio
+    async def test_changed_final_prompt_reuses_groups(self, isolated_historizer, summaries):
+        await self.reduce(isolated_historizer, summaries)
+
+        with patch('historizer.FINAL_PROMPT_VERSION', 'edited'):
+            _, group_calls, final_calls = await self.reduce(isolated_historizer, summaries)
+
+        assert (group_calls, final_calls) == (0, 1)
+
+    @pytest.mark.asyncio
+    async def test_changed_chunk_resummarizes_its_group_only(self, isolated_historizer, summaries):
+        await self.reduce(isolated_historizer, summaries)
+
+        summaries[4] = 'edited chunk summary'
+        _, group_calls, final_calls = await self.reduce(isolated_historizer, summaries)
+
+        assert (group_calls, final_calls) == (1, 1)
+
+    def test_prompt_version_ignores_date_of_run(self):
+        assert get_prompt_version(f'prompt, today is {TODAY}') == get_prompt_version('prompt, today is ')
+
+
+class TestParallelGroups:
+    @pytest.fixture
+    def groups(self):
+        return [[f'msg: {i * 2}', f'msg: {i * 2 + 1}'] for i in range(6)]
+
+    @pytest.mark.asyncio
+    async def test_group_concurrency_limit(self, tmp_path, monkeypatch, groups):
+        monkeypatch.chdir(tmp_path)
+        historizer = Historizer(concurrency=8, group_concurrency=2)
+        group_model = IdRangeBackend(latency=0.02)
+
+        await historizer.summarize_groups(groups, group_model)
+
+        assert group_model.calls == 6
+        assert group_model.max_in_flight == 2
+
+    @pytest.mark.asyncio
+    async def test_groups_are_collected_in_order(self, isolated_historizer, groups):
+        class SlowFirstModel(IdRangeBackend):
+            async def complete(self, prompt: str, system_prompt: str | None = None) -> Completion:
+                # Earlier groups take longer, so they complete last
+                self.latency = 0.1 - int(prompt.split('msg: ')[1].split()[0]) * 0.008
+                return await super().complete(prompt, system_prompt)
+
+        result = await isolated_historizer.summarize_groups(groups, SlowFirstModel())
 
-    chunk = [msg]
-    chunk_id = f"{msg.id}_{msg.id}_{len(chunk)}"
-    expected_hash = hashlib.md5(chunk_id.encode()).hexdigest()
+        assert result == [f'summary {i * 2}-{i * 2 + 1}' for i in range(6)]
 
-    result = historizer.get_chunk_hash(chunk)
+    @pytest.mark.asyncio
+    async def test_progress_is_reported_per_group(self, isolated_historizer, groups):
+        with patch('historizer.logger') as mock_logger:
+            await isolated_historizer.summarize_groups(groups, IdRangeBackend(latency=0))
+
+        progress = [call.args[0] for call in mock_logger.info.call_args_list if 'groups summarized' in call.args[0]]
+        assert [message.split()[2] for message in progress] == [f'{i}/6' for i in range(1, 7)]
+
+
+class TestReduceTree:
+    @pytest.fixture
+    def summaries(self):
+        # About 100 tokens each
+        return [f'chunk summary {i} ' + 'x' * 400 for i in range(40)]
+
+    @pytest.mark.asyncio
+    async def test_short_history_skips_group_level(self, isolated_historizer, summaries):
+        group_model, final_model = IdRangeBackend(latency=0), IdRangeBackend(latency=0)
+
+        await isolated_historizer.summarize_tree(summaries[:3], group_model, final_model, 500, 1000)
+
+        assert (group_model.calls, final_model.calls) == (0, 1)
+
+    @pytest.mark.asyncio
+    async def test_recurses_until_summaries_fit_final_budget(self, isolated_historizer, summaries):
+        group_model, final_model = IdRangeBackend(), IdRangeBackend(latency=0)
+
+        with patch.object(isolated_historizer, 'summarize_groups', wraps=isolated_historizer.summarize_groups) as groups:
+            await isolated_historizer.summarize_tree(summaries, group_model, final_model, 500, 50)
+
+        # 40 summaries of ~100 tokens fit 4 per group, then the 10 short group summaries fit a single group
+        assert [len(call.args[0]) for call in groups.call_args_list] == [10, 1]
+        assert all(len(group) == 4 for group in groups.call_args_list[0].args[0])
+        assert (group_model.calls, final_model.calls) == (11, 1)
+        assert group_model.max_in_flight == 4
+
+    @pytest.mark.asyncio
+    async def test_fan_in_is_capped_by_group_size(self, isolated_historizer, summaries):
+        isolated_historizer.group_size = 3
+        group_model = IdRangeBackend(latency=0)
+
+        with patch.object(isolated_historizer, 'summarize_groups', wraps=isolated_historizer.summarize_groups) as groups:
+            await isolated_historizer.summarize_tree(summaries, group_model, IdRangeBackend(latency=0), 10_000, 50)
+
+        assert max(len(group) for group in groups.call_args_list[0].args[0]) == 3
+
+    @pytest.mark.asyncio
+    async def test_appended_summaries_reuse_leading_groups(self, isolated_historizer, summaries):
+        await isolated_historizer.summarize_tree(summaries, IdRangeBackend(latency=0), IdRangeBackend(latency=0), 500, 50)
+
+        group_model = IdRangeBackend(latency=0)
+        await isolated_historizer.summarize_tree(summaries + ['new chunk summary'], group_model,
+                                                 IdRangeBackend(latency=0), 500, 50)
+
+        # The last group of level 1 and the single group of level 2
+        assert group_model.calls == 2
+
+    @pytest.mark.asyncio
+    async def test_summaries_too_long_to_pair_are_truncated(self, isolated_historizer, summaries):
+        group_model = IdRangeBackend(latency=0)
+
+        with patch.object(isolated_historizer, 'summarize_groups', wraps=isolated_historizer.summarize_groups) as groups:
+            await isolated_historizer.summarize_tree(summaries[:8], group_model, IdRangeBackend(latency=0), 150, 50)
+
+        first_level = groups.call_args_list[0].args[0]
+        assert [len(group) for group in first_level] == [2] * 4
+        assert all(sum(count_tokens(summary) + 1 for summary in group) <= 150 for group in first_level)
+
+
+class TestConcurrentSummarization:
+    @pytest.mark.asyncio
+    async def test_summarize_chunks_keeps_chronological_order(self, isolated_historizer):
+        chunks = [[make_message(i * 10 + j) for j in range(10)] for i in range(12)]
+        chat_model = IdRangeBackend()
+
+        result = await isolated_historizer.summarize_chunks(chunks, chat_model)
+
+        assert result == [f'summary {i * 10}-{i * 10 + 9}' for i in range(12)]
+
+    @pytest.mark.asyncio
+    async def test_summarize_chunks_respects_concurrency_limit(self, isolated_historizer):
+        chunks = [[make_message(i)] for i in range(20)]
+        chat_model = IdRangeBackend(latency=0.05)
+
+        started = time.perf_counter()
+        await isolated_historizer.summarize_chunks(chunks, chat_model)
+        elapsed = time.perf_counter() - started
+
+        assert chat_model.max_in_flight == 4
+        # 20 calls at 4 in flight is 5 rounds of latency, well under the 1s a sequential run would take
+        assert elapsed < 0.6
+
+    @pytest.mark.asyncio
+    async def test_summarize_chunk_splits_too_large_chunk_concurrently(self, isolated_historizer):
+        chunk = [make_message(i) for i in range(8)]
+        chat_model = IdRangeBackend(too_large_tokens=650)
+
+        summary = await isolated_historizer.summarize_chunk(chunk, chat_model)
+
+        assert summary == 'summary 0-3\n\nsummary 4-7'
+        assert chat_model.max_in_flight == 2
+
+    @pytest.mark.asyncio
+    async def test_summarize_chunks_pulls_lazy_chunks_in_a_bounded_window(self, isolated_historizer):
+        pulled = []
+
+        def chunks():
+            for i in range(30):
+                pulled.append(i)
+                yield [make_message(i)]
+
+        chat_model = IdRangeBackend(latency=0.02)
+        summarizing = isolated_historizer.summarize_chunks(chunks(), chat_model)
+        task = asyncio.ensure_future(summarizing)
+        await asyncio.sleep(0.01)
+
+        # Nothing has been summarized yet, so only the window of 2 * concurrency chunks has been pulled
+        assert len(pulled) == 8
+        assert await task == [f'summary {i}-{i}' for i in range(30)]
+
+    @pytest.mark.asyncio
+    async def test_summarize_chunks_yields_to_the_loop_between_chunks(self, isolated_historizer):
+        pulled = []
+        seen = set()
+
+        def chunks():
+            for i in range(8):
+                pulled.append(i)
+                yield [make_message(i)]
+
+        async def watch():
+            while True:
+                seen.add(len(pulled))
+                await asyncio.sleep(0)
+
+        watcher = asyncio.create_task(watch())
+        await isolated_historizer.summarize_chunks(chunks(), IdRangeBackend(latency=0))
+        watcher.cancel()
+
+        # Other tasks ran while the chunks were produced, not only once the whole window was
+        assert set(range(1, 8)) <= seen
+
+
+class TestIncrementalRun:
+    @pytest.fixture
+    def chat_models(self, monkeypatch):
+        models = []
+
+        def make_chat_model(model: str, **kwargs):
+            models.append(IdRangeBackend(latency=0, model_name=model))
+            return models[-1]
+
+        monkeypatch.setattr('historizer.OpenAIBackend', make_chat_model)
+        return models
+
+    async def run(self, tmp_path, messages: int, **kwargs):
+        path = str(tmp_path / 'result.json')
+        write_export(path, messages)
+        with patch('historizer.CHAT_HISTORY_PATH', path):
+            return await Historizer(**{'chunk_tokens': 3000, 'group_size': 3, **kwargs}).run()
+
+    @pytest.mark.asyncio
+    async def test_only_new_tail_is_summarized(self, tmp_path, monkeypatch, chat_models):
+        monkeypatch.chdir(tmp_path)
+        await self.run(tmp_path, 600)
+        full_calls = chat_models[0].calls
+        first_checkpoint = load_checkpoint()
+
+        await self.run(tmp_path, 650, incremental=True)
+        resumed = load_checkpoint()
+
+        assert 0 < chat_models[3].calls < full_calls / 2
+        assert resumed.chunks[:len(first_checkpoint.chunks)] == first_checkpoint.chunks
+
+    @pytest.mark.asyncio
+    async def test_incremental_run_matches_full_run(self, tmp_path, monkeypatch, chat_models):
+        (tmp_path / 'incremental').mkdir()
+        (tmp_path / 'full').mkdir()
+
+        monkeypatch.chdir(tmp_path / 'incremental')
+        await self.run(tmp_path, 600)
+        incremental = await self.run(tmp_path, 650, incremental=True)
+        incremental_checkpoint = load_checkpoint()
+
+        monkeypatch.chdir(tmp_path / 'full')
+        full = await self.run(tmp_path, 650)
+
+        assert incremental == full
+        assert incremental_checkpoint == load_checkpoint()
+
+    @pytest.mark.asyncio
+    async def test_compact_run_matches_pydantic_run(self, tmp_path, monkeypatch, chat_models):
+        (tmp_path / 'pydantic').mkdir()
+        (tmp_path / 'compact').mkdir()
+
+        monkeypatch.chdir(tmp_path / 'pydantic')
+        expected = await self.run(tmp_path, 600)
+        expected_checkpoint = load_checkpoint()
+
+        monkeypatch.chdir(tmp_path / 'compact')
+        await self.run(tmp_path, 500, compact=True)
+        # Resumes from the store by id, with replies across the checkpoint looked up in the store
+        assert await self.run(tmp_path, 600, compact=True, incremental=True) == expected
+        assert load_checkpoint() == expected_checkpoint
+
+    @pytest.mark.asyncio
+    async def test_snapshot_run_matches_pydantic_run(self, tmp_path, monkeypatch, chat_models):
+        (tmp_path / 'pydantic').mkdir()
+        (tmp_path / 'snapshot').mkdir()
+
+        monkeypatch.chdir(tmp_path / 'pydantic')
+        expected = await self.run(tmp_path, 600)
+
+        monkeypatch.chdir(tmp_path / 'snapshot')
+        # The first run builds the snapshot, the second one maps it
+        assert await self.run(tmp_path, 600, snapshot=True) == expected
+        assert os.path.exists('chat_history/cache/result.snapshot')
+        assert await self.run(tmp_path, 600, snapshot=True) == expected
+
+    @pytest.mark.asyncio
+    async def test_changed_settings_discard_checkpoint(self, tmp_path, monkeypatch, chat_models):
+        monkeypatch.chdir(tmp_path)
+        await self.run(tmp_path, 300)
+        await self.run(tmp_path, 300, incremental=True, chunk_tokens=2000)
 
-    assert result == expected_hash
\ No newline at end of file
+        # Different boundaries, so every chunk is summarized again instead of being taken from the checkpoint
+        assert chat_models[3].calls == len(load_checkpoint().chunks) + 1
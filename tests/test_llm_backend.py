@@ -0,0 +1,135 @@
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+from benchmarks.synthetic_export import write_export
+from cache_store import MemoryCacheStore
+from historizer import Historizer
+from llm_backend import Completion, FakeBackend, LLMBackend, OpenAIBackend
+from rate_limiter import UNLIMITED, RateLimiter, get_retry_after, is_retryable, is_too_large_error
+from summarizer import summarize_text
+
+
+@pytest.mark.asyncio
+async def test_fake_answers_are_deterministic():
+    backend = FakeBackend(summary_words=3)
+
+    completion = await backend.complete('some prompt')
+
+    assert completion == await FakeBackend(summary_words=3, latency=0.01).complete('some prompt')
+    assert completion.text != (await backend.complete('another prompt')).text
+    assert completion.text.endswith('event event event')
+    assert completion.prompt_tokens == backend.count_tokens('some prompt')
+    assert backend.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_fake_injects_errors():
+    with pytest.raises(Exception) as too_large:
+        await FakeBackend(too_large_tokens=5).complete('a prompt well over five tokens long')
+    with pytest.raises(Exception) as rate_limited:
+        await FakeBackend(rate_limit_share=1, retry_after=0.25).complete('prompt')
+
+    assert is_too_large_error(too_large.value)
+    assert is_retryable(rate_limited.value) and not is_too_large_error(rate_limited.value)
+    assert get_retry_after(rate_limited.value) == 0.25
+
+
+def test_backend_without_complete_can_not_be_instantiated():
+    class StreamOnlyBackend(LLMBackend):
+        async def stream(self, prompt: str, system_prompt: str | None = None):
+            yield prompt
+
+    with pytest.raises(TypeError):
+        StreamOnlyBackend('fake-model')
+
+
+def test_fake_keeps_its_summaries_apart():
+    assert FakeBackend('gpt-4.1-nano').cache_model != OpenAIBackend('gpt-4.1-nano', api_key='test').cache_model
+    assert FakeBackend('gpt-4.1-nano', context_tokens=1000).context_tokens == 1000
+    assert FakeBackend('gpt-4.1-nano').context_tokens == 1_047_576
+
+
+@pytest.mark.asyncio
+async def test_openai_backend_sends_chat_messages():
+    response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='ok'))],
+                               usage=SimpleNamespace(prompt_tokens=12, completion_tokens=1))
+    create = AsyncMock(return_value=response)
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    assert await OpenAIBackend('gpt-4.1-mini', client=client).complete('question', 'be brief') == Completion('ok', 12, 1)
+    create.assert_awaited_once_with(
+        model='gpt-4.1-mini',
+        messages=[{'role': 'system', 'content': 'be brief'}, {'role': 'user', 'content': 'question'}],
+        temperature=0.3,
+    )
+
+
+@pytest.mark.asyncio
+async def test_openai_backend_streams_deltas():
+    async def chunks():
+        for content in ['Сво', None, 'дка']:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+        # The usage chunk comes without choices
+        yield SimpleNamespace(choices=[])
+
+    create = AsyncMock(return_value=chunks())
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    assert [delta async for delta in OpenAIBackend('gpt-4.1-mini', client=client).stream('question')] == ['Сво', 'дка']
+    assert create.await_args.kwargs['stream'] is True
+
+
+@pytest.mark.asyncio
+async def test_failed_warm_up_is_ignored():
+    retrieve = AsyncMock(side_effect=ConnectionError('offline'))
+    client = SimpleNamespace(models=SimpleNamespace(retrieve=retrieve))
+
+    await OpenAIBackend('gpt-4.1-mini', client=client).warm_up()
+
+    retrieve.assert_awaited_once_with('gpt-4.1-mini')
+
+
+@pytest.mark.asyncio
+async def test_fake_streams_its_answer():
+    backend = FakeBackend(summary_words=3)
+
+    assert ''.join([delta async for delta in backend.stream('prompt')]) == backend.answer('prompt')
+
+
+@pytest.mark.asyncio
+async def test_summarizer_goes_through_the_backend():
+    backend = FakeBackend('gpt-4.1-mini')
+
+    assert await summarize_text('discussion', backend) == backend.answer('discussion')
+
+
+@pytest.mark.asyncio
+async def test_historizer_runs_offline_through_injected_errors(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / 'result.json')
+    write_export(path, 600)
+    backends = []
+
+    async def run(**fake_options) -> str:
+        def make_backend(model: str) -> FakeBackend:
+            backends.append(FakeBackend(model, **fake_options))
+            return backends[-1]
+
+        limiter = RateLimiter({model: UNLIMITED for model in ('gpt-4.1-nano', 'gpt-4.1-mini', 'gpt-4.1')}, base_delay=0)
+        historizer = Historizer(chunk_tokens=3000, group_size=3, backend_factory=make_backend, cache=MemoryCacheStore(),
+                                rate_limiter=limiter)
+        with patch('historizer.CHAT_HISTORY_PATH', path):
+            return await historizer.run()
+
+    expected = await run()
+    # Retried 429s leave no trace in the result
+    flaky = await run(rate_limit_share=0.2, retry_after=0, seed=1)
+    chunks_backend = backends[3]
+
+    assert flaky == expected
+    assert chunks_backend.rate_limited > 0
+    # Too large chunks are summarized in halves
+    assert await run(too_large_tokens=2000) != expected
+    assert backends[6].too_large > 0
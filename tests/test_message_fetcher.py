@@ -0,0 +1,227 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from telethon.errors import FloodWaitError
+
+from fake_telegram import START, StubClient, make_message
+from message_fetcher import FetchGate, MessageCache, MessageFetcher, split_into_windows, subtract_ranges
+from sender_cache import SenderCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = MessageCache(str(tmp_path / 'cache' / 'messages.sqlite3'))
+    yield cache
+    cache.close()
+
+
+def test_subtract_ranges():
+    assert subtract_ranges(1, 100, []) == [(1, 100)]
+    assert subtract_ranges(1, 100, [(10, 20), (30, 40)]) == [(1, 9), (21, 29), (41, 100)]
+    assert subtract_ranges(15, 35, [(10, 20), (30, 40)]) == [(21, 29)]
+    assert subtract_ranges(12, 18, [(10, 20)]) == []
+
+
+def test_split_into_windows():
+    assert split_into_windows([(1, 25), (40, 44)], 10) == [(1, 10), (11, 20), (21, 25), (40, 44)]
+
+
+def test_fetched_ranges_are_merged(cache):
+    cache.save_window('Chat', None, 1, 10, [])
+    cache.save_window('chat', None, 21, 30, [])
+    cache.save_window('chat', None, 11, 20, [])
+    cache.save_window('chat', 5, 100, 200, [])
+
+    assert cache.fetched_ranges('chat', None) == [(1, 30)]
+    assert cache.missing_ranges('chat', 5, 1, 300) == [(1, 99), (201, 300)]
+
+
+def test_fetched_ranges_expire(cache, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('time.time', lambda: clock[0])
+    cache.save_window('chat', None, 1, 100, [])
+    clock[0] += cache.ttl + 1
+    cache.save_window('chat', None, 41, 60, [])
+
+    # The expired range keeps its ids around the window, and is not merged with it
+    assert cache.fetched_ranges('chat', None) == [(41, 60)]
+    assert cache.missing_ranges('chat', None, 1, 100) == [(1, 40), (61, 100)]
+
+    cache.save_window('chat', None, 61, 100, [])
+    clock[0] += cache.ttl / 2
+    cache.save_window('chat', None, 1, 40, [])
+    assert cache.fetched_ranges('chat', None) == [(1, 100)]
+    # Merged ranges expire with their oldest part
+    clock[0] += cache.ttl / 2 + 1
+    assert cache.fetched_ranges('chat', None) == []
+
+
+def test_fetched_ranges_can_be_kept_for_good(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('time.time', lambda: clock[0])
+    cache = MessageCache(str(tmp_path / 'messages.sqlite3'), ttl=float('inf'))
+    cache.save_window('chat', None, 1, 100, [])
+    clock[0] += 365 * 24 * 3600
+    cache.save_window('chat', None, 101, 200, [])
+
+    assert cache.fetched_ranges('chat', None) == [(1, 200)]
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_windows_are_fetched_concurrently_and_merged_in_order(cache):
+    client = StubClient([make_message(i, reply_to=i - 1 if i % 7 == 0 else None) for i in range(1, 501)], latency=0.001)
+    fetcher = MessageFetcher(client, cache, 'chat', window_messages=50, concurrency=4)
+
+    messages = await fetcher.fetch(0)
+
+    assert [message.id for message in messages] == list(range(1, 501))
+    assert messages[6].reply_to_id == 6 and messages[6].sender_id == 2
+    assert messages[0].date == START + timedelta(minutes=1)
+    assert fetcher.requests == 10
+    assert client.max_in_flight == 4
+
+
+@pytest.mark.asyncio
+async def test_overlapping_range_fetches_only_missing_ids(cache):
+    client = StubClient([make_message(i) for i in range(1, 301) if i % 10])
+
+    first = await MessageFetcher(client, cache, 'chat', window_messages=40).fetch(100, 201)
+    client.served.clear()
+    second = await MessageFetcher(client, cache, 'chat', window_messages=40).fetch(50, 251)
+
+    assert [message.id for message in first] == [i for i in range(101, 201) if i % 10]
+    assert [message.id for message in second] == [i for i in range(51, 251) if i % 10]
+    # Ids without a message inside the fetched range are not asked for again
+    assert sorted(client.served) == [i for i in [*range(51, 101), *range(201, 251)] if i % 10]
+
+    client.served.clear()
+    await MessageFetcher(client, cache, 'chat').fetch(100, 201)
+    assert client.served == []
+
+
+@pytest.mark.asyncio
+async def test_refresh_fetches_the_range_again(cache):
+    client = StubClient([make_message(i) for i in range(1, 21)])
+    await MessageFetcher(client, cache, 'chat').fetch(0, 21)
+    client.messages[5].text = 'edited'
+
+    assert (await MessageFetcher(client, cache, 'chat').fetch(0, 21))[4].text == 'message 5'
+    assert (await MessageFetcher(client, cache, 'chat').fetch(0, 21, refresh=True))[4].text == 'edited'
+
+
+@pytest.mark.asyncio
+async def test_refresh_drops_messages_deleted_upstream(cache):
+    client = StubClient([make_message(i) for i in range(1, 21)])
+    await MessageFetcher(client, cache, 'chat').fetch(0, 21)
+    del client.messages[5]
+
+    messages = await MessageFetcher(client, cache, 'chat').fetch(0, 21, refresh=True)
+
+    assert 5 not in [message.id for message in messages]
+    assert 5 not in [message.id for message in cache.get_messages('chat', None, 1, 20)]
+
+
+@pytest.mark.asyncio
+async def test_sparse_thread_is_fetched_in_few_windows(cache):
+    # 30 replies spread over 30000 ids of the group, as a thread's are
+    client = StubClient([make_message(1001 + i * 1000) for i in range(30)])
+    fetcher = MessageFetcher(client, cache, 'chat', thread_id=1000, window_messages=10)
+
+    messages = await fetcher.fetch(1000)
+
+    assert len(messages) == 30
+    assert fetcher.requests == 3
+
+
+@pytest.mark.asyncio
+async def test_flood_wait_resumes_the_window(cache):
+    client = StubClient([make_message(i) for i in range(1, 101)], flood_waits=[0, 0])
+    fetcher = MessageFetcher(client, cache, 'chat', window_messages=30)
+
+    messages = await fetcher.fetch(0)
+
+    assert [message.id for message in messages] == list(range(1, 101))
+    # Every message is served once, retried windows start after their last message
+    assert sorted(client.served) == list(range(1, 101))
+
+
+@pytest.mark.asyncio
+async def test_fetchers_of_one_client_share_the_gate(cache):
+    client = StubClient([make_message(i) for i in range(1, 101)], latency=0.001)
+    gate = FetchGate(concurrency=2)
+    fetchers = [MessageFetcher(client, cache, channel, window_messages=10, gate=gate) for channel in ('first', 'second')]
+    loop = asyncio.get_running_loop()
+
+    # A FloodWait got by one of them holds the other too
+    gate.hold(0.1)
+    started = loop.time()
+    await asyncio.gather(*(fetcher.fetch(0) for fetcher in fetchers))
+
+    assert loop.time() - started >= 0.1
+    assert client.max_in_flight == 2
+
+
+@pytest.mark.asyncio
+async def test_long_flood_wait_keeps_fetched_windows(cache):
+    client = StubClient([make_message(i) for i in range(1, 101)])
+    fetcher = MessageFetcher(client, cache, 'chat', window_messages=50, concurrency=1, max_flood_wait=10)
+    await fetcher.fetch(0, 51)
+
+    client.flood_waits = [3600]
+    with pytest.raises(FloodWaitError):
+        await fetcher.fetch(0)
+
+    assert cache.missing_ranges('chat', None, 1, 100) == [(51, 100)]
+
+
+@pytest.mark.asyncio
+async def test_senders_of_fetched_messages_are_cached(cache, tmp_path):
+    sender_cache = SenderCache(str(tmp_path / 'senders.sqlite3'))
+    client = StubClient([make_message(1), make_message(2), make_message(3, with_sender=False)])
+
+    await MessageFetcher(client, cache, 'chat', sender_cache=sender_cache).fetch(0)
+
+    assert {sender_id: sender.username for sender_id, sender in sender_cache.get_many([1, 2, 3]).items()} == {
+        2: 'user2', 3: 'user3',
+    }
+    sender_cache.close()
+
+
+@pytest.mark.asyncio
+async def test_empty_chat(cache):
+    assert await MessageFetcher(StubClient([]), cache, 'chat').fetch(0) == []
+
+
+@pytest.mark.asyncio
+async def test_batches_come_in_order_as_soon_as_they_can(cache):
+    client = StubClient([make_message(i) for i in range(1, 401)], latency=0.001)
+    # Ids 101-200 are cached, the windows around them are fetched
+    await MessageFetcher(client, cache, 'chat').fetch(100, 201)
+    client.served.clear()
+    fetcher = MessageFetcher(client, cache, 'chat', window_messages=50, concurrency=2)
+
+    batches = []
+    served_before = []
+    async for batch in fetcher.iter_batches(0, 401):
+        batches.append([message.id for message in batch])
+        served_before.append(len(client.served))
+
+    assert [batch[0] for batch in batches] == [1, 51, 101, 201, 251, 301, 351]
+    assert [message_id for batch in batches for message_id in batch] == list(range(1, 401))
+    # The first window is given out long before the last one is fetched
+    assert served_before[0] < 300
+
+
+@pytest.mark.asyncio
+async def test_stopping_early_cancels_the_windows(cache):
+    client = StubClient([make_message(i) for i in range(1, 401)], latency=0.001)
+    fetcher = MessageFetcher(client, cache, 'chat', window_messages=50)
+
+    async for _ in fetcher.iter_batches(0):
+        break
+    await asyncio.sleep(0.05)
+
+    assert len(client.served) < 400
+    assert client.in_flight == 0
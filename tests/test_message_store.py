@@ -0,0 +1,88 @@
+from datetime import datetime
+
+import pytest
+
+from benchmarks.synthetic_export import write_export
+from export_reader import iter_raw_messages
+from historizer import iter_chat_history
+from message_store import CompactServiceMessage, CompactUserMessage, MessageStore
+from renderer import render_message
+
+
+@pytest.fixture(scope='module')
+def export_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('export') / 'result.json')
+    write_export(path, 2000)
+    return path
+
+
+@pytest.fixture(scope='module')
+def store(export_path):
+    return MessageStore.from_export(export_path)
+
+
+def make_raw_message(message_id: int, date: str) -> dict:
+    return {'id': message_id, 'type': 'message', 'date': date, 'from': 'Alice', 'text': f'msg {message_id}'}
+
+
+def test_rows_render_like_pydantic_messages(export_path, store):
+    messages = list(iter_chat_history(export_path))
+    by_id = {message.id: message for message in messages}
+
+    assert len(store) == len(messages)
+    for message, row in zip(messages, store):
+        reply_id = getattr(message, 'reply_to_message_id', None)
+        assert row.date == message.date
+        assert render_message(row, store.get(reply_id) if reply_id else None) == render_message(message, by_id.get(reply_id))
+
+
+def test_rows_have_matching_types(store):
+    service = [row for row in store if row.type == 'service']
+
+    assert service and all(isinstance(row, CompactServiceMessage) for row in service)
+    assert all(isinstance(row, CompactUserMessage) for row in store if row.type == 'message')
+
+
+def test_senders_are_interned(store):
+    # 300 synthetic senders, a few actions and emojis
+    assert len(store.pool.strings) < 350
+    assert store.memory_usage() > 0
+
+
+def test_get_by_id(store):
+    assert store.get(1234).id == 1234
+    assert store.get(0) is None
+    assert store.get(10_000) is None
+    assert store.rows_after(1234) == 1234
+
+
+def test_unsorted_ids_fall_back_to_dict():
+    store = MessageStore()
+    for message_id in [5, 3, 9]:
+        store.append(make_raw_message(message_id, '2022-05-12T10:00:00'))
+
+    assert not store.ids_sorted
+    assert store.get(3).text == 'msg 3'
+    assert store.get(4) is None
+    assert store.rows_after(5) == 2
+
+
+@pytest.mark.parametrize('dates_sorted', [True, False])
+def test_slice_by_date(dates_sorted):
+    dates = ['2022-05-30T23:59:59', '2022-06-01T00:00:00', '2022-06-15T12:00:00', '2022-07-01T00:00:00']
+    if not dates_sorted:
+        dates.reverse()
+
+    store = MessageStore()
+    for message_id, date in enumerate(dates, start=1):
+        store.append(make_raw_message(message_id, date))
+
+    june = store.slice_by_date(datetime(2022, 6, 1), datetime(2022, 7, 1))
+
+    assert sorted(row.date.day for row in june) == [1, 15]
+    assert len(list(store.slice_by_date(start=datetime(2022, 6, 1)))) == 3
+    assert store.dates_sorted == dates_sorted
+
+
+def test_matches_raw_messages(export_path, store):
+    assert [row.id for row in store] == [message['id'] for message in iter_raw_messages(export_path)]
@@ -0,0 +1,142 @@
+import json
+import time
+from unittest.mock import patch
+
+import pytest
+from openai import RateLimitError
+
+from benchmarks.synthetic_export import write_export
+from cache_store import MemoryCacheStore
+from historizer import Historizer
+from llm_backend import FakeBackend
+from metrics import NO_TIMER, Metrics
+from rate_limiter import UNLIMITED, RateLimiter
+
+
+def read_events(path) -> list[dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_nested_timers_are_exclusive(tmp_path):
+    metrics = Metrics(str(tmp_path / 'metrics.jsonl'))
+
+    with metrics.timer('outer'):
+        time.sleep(0.02)
+        with metrics.timer('inner'):
+            time.sleep(0.05)
+
+    assert 0.02 <= metrics.timers['outer'] < 0.045
+    assert metrics.timers['inner'] >= 0.05
+
+
+def test_timed_iterable_excludes_the_consumer(tmp_path):
+    metrics = Metrics(str(tmp_path / 'metrics.jsonl'))
+
+    def produce():
+        for i in range(3):
+            time.sleep(0.01)
+            yield i
+
+    for _ in metrics.timed('produce', produce()):
+        time.sleep(0.02)
+
+    assert 0.03 <= metrics.timers['produce'] < 0.05
+    assert metrics.timer_counts['produce'] == 4
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics()
+
+    assert metrics.timer('render') is NO_TIMER
+    metrics.record_call('chunk', 'gpt-4.1-nano', 1.0, 0, 100, 10)
+    metrics.record_summary('chunk', cached=True)
+    metrics.close()
+
+    assert not metrics.models and not metrics.cache_hits
+
+
+def test_calls_are_aggregated_per_model(tmp_path):
+    path = str(tmp_path / 'metrics.jsonl')
+    metrics = Metrics(path)
+
+    metrics.record_call('chunk', 'gpt-4.1-nano', 0.5, 0, 1_000_000, 0)
+    metrics.record_call('chunk', 'gpt-4.1-nano', 0.5, 2, 0, 1_000_000)
+    metrics.record_call('group', 'gpt-4.1-mini', 0.1, 1, error='RateLimitError')
+    metrics.close()
+
+    events = read_events(path)
+    totals = events[-1]
+    assert [event['type'] for event in events] == ['call', 'call', 'call', 'totals']
+    assert totals['models']['gpt-4.1-nano']['cost'] == pytest.approx(0.5)
+    assert totals['models']['gpt-4.1-nano']['retries'] == 2
+    assert totals['models']['gpt-4.1-mini']['failures'] == 1
+    assert totals['cost'] == pytest.approx(0.5)
+
+
+@pytest.mark.asyncio
+async def test_historizer_run_is_instrumented(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    export_path = str(tmp_path / 'result.json')
+    write_export(export_path, 600)
+    cache = MemoryCacheStore()
+
+    async def run(metrics_path: str, **fake_options):
+        historizer = Historizer(
+            chunk_tokens=3000, group_size=3, cache=cache, metrics=Metrics(metrics_path),
+            rate_limiter=RateLimiter({model: UNLIMITED for model in ('gpt-4.1-nano', 'gpt-4.1-mini', 'gpt-4.1')},
+                                     base_delay=0),
+            # A small context and long summaries, so the reduction needs a group level
+            backend_factory=lambda model: FakeBackend(model, summary_words=200, context_tokens=6000, **fake_options),
+        )
+        with patch('historizer.CHAT_HISTORY_PATH', export_path):
+            await historizer.run()
+        return read_events(metrics_path)
+
+    events = await run(str(tmp_path / 'first.jsonl'), rate_limit_share=0.2, retry_after=0, seed=1)
+    totals = events[-1]
+    calls = [event for event in events if event['type'] == 'call']
+
+    assert {event['stage'] for event in calls} == {'chunk', 'group', 'final'}
+    assert all(event['prompt_tokens'] > 0 and event['cost'] > 0 for event in calls)
+    assert totals['models']['gpt-4.1-nano']['retries'] > 0
+    assert set(totals['timers']) == {'load', 'split', 'render'}
+    assert totals['cache']['chunk'] == {'hits': 0, 'misses': totals['models']['gpt-4.1-nano']['calls']}
+    assert {event['name'] for event in events if event['type'] == 'span'} == {'chunks', 'level', 'reduce'}
+
+    rerun = (await run(str(tmp_path / 'second.jsonl')))[-1]
+    assert rerun['models'] == {}
+    assert rerun['cache']['chunk']['misses'] == 0
+    assert rerun['cache']['final'] == {'hits': 1, 'misses': 0}
+
+
+def test_metrics_file_directory_is_created(tmp_path):
+    path = str(tmp_path / 'chat_history' / 'cache' / 'metrics.jsonl')
+    metrics = Metrics(path)
+    metrics.close()
+
+    assert read_events(path)[-1]['type'] == 'totals'
+
+
+@pytest.mark.asyncio
+async def test_failed_run_still_writes_totals(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    export_path = str(tmp_path / 'result.json')
+    write_export(export_path, 100)
+    metrics_path = str(tmp_path / 'metrics.jsonl')
+    metrics = Metrics(metrics_path)
+    historizer = Historizer(
+        chunk_tokens=3000, cache=MemoryCacheStore(), metrics=metrics,
+        # Every call is rate limited and never retried, which fails the run
+        rate_limiter=RateLimiter({model: UNLIMITED for model in ('gpt-4.1-nano', 'gpt-4.1-mini', 'gpt-4.1')},
+                                 max_retries=0),
+        backend_factory=lambda model: FakeBackend(model, rate_limit_share=1.0),
+    )
+
+    with patch('historizer.CHAT_HISTORY_PATH', export_path), pytest.raises(RateLimitError):
+        await historizer.run()
+
+    totals = read_events(metrics_path)[-1]
+    assert totals['type'] == 'totals'
+    assert totals['models']['gpt-4.1-nano']['failures'] > 0
+    assert metrics.file is None
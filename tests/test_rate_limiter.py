@@ -0,0 +1,87 @@
+from unittest.mock import MagicMock
+
+import pytest
+from openai import RateLimitError
+
+from rate_limiter import ModelLimits, RateLimiter, TokenBucket, get_retry_after, is_retryable
+
+
+def make_rate_limit_error(message: str, headers: dict | None = None) -> RateLimitError:
+    response = MagicMock(status_code=429, headers=headers or {})
+    return RateLimitError(message, response=response, body=None)
+
+
+@pytest.fixture
+def rate_limiter():
+    return RateLimiter(limits={'fake-model': ModelLimits(requests_per_minute=60_000, tokens_per_minute=6_000_000)},
+                       base_delay=0.01, max_delay=0.05)
+
+
+class TestTokenBucket:
+    def test_reserve_within_capacity(self):
+        bucket = TokenBucket(capacity=100, refill_per_second=10)
+        assert bucket.reserve(60) == 0
+        assert bucket.reserve(40) == 0
+
+    def test_reserve_over_capacity_returns_delay(self):
+        bucket = TokenBucket(capacity=100, refill_per_second=10)
+        bucket.reserve(100)
+        assert bucket.reserve(50) == pytest.approx(5, abs=0.01)
+
+    def test_request_bigger_than_bucket_is_clamped(self):
+        bucket = TokenBucket(capacity=100, refill_per_second=10)
+        assert bucket.reserve(1000) == 0
+
+
+class TestRetryAfter:
+    @pytest.mark.parametrize('headers, message, expected', [
+        ({'retry-after-ms': '1500'}, 'Rate limit reached', 1.5),
+        ({'retry-after': '3'}, 'Rate limit reached', 3.0),
+        ({}, 'Rate limit reached. Please try again in 820ms.', 0.82),
+        ({}, 'Rate limit reached. Please try again in 2.5s.', 2.5),
+        ({}, 'Rate limit reached', None),
+    ])
+    def test_get_retry_after(self, headers, message, expected):
+        assert get_retry_after(make_rate_limit_error(message, headers)) == expected
+
+    def test_too_large_is_not_retryable(self):
+        assert not is_retryable(make_rate_limit_error('Request too large for gpt-4.1-nano'))
+        assert is_retryable(make_rate_limit_error('Rate limit reached'))
+
+
+class TestRateLimiter:
+    @pytest.mark.asyncio
+    async def test_run_retries_rate_limit_errors(self, rate_limiter):
+        outcomes = [make_rate_limit_error('Rate limit reached'), make_rate_limit_error('Rate limit reached'), 'done']
+
+        async def call():
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        assert await rate_limiter.run('fake-model', call, 100) == 'done'
+        assert outcomes == []
+
+    @pytest.mark.asyncio
+    async def test_run_does_not_retry_too_large(self, rate_limiter):
+        call = MagicMock(side_effect=make_rate_limit_error('Request too large for gpt-4.1-nano'))
+
+        async def acall():
+            return call()
+
+        with pytest.raises(RateLimitError):
+            await rate_limiter.run('fake-model', acall, 100)
+        assert call.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_run_gives_up_after_max_retries(self, rate_limiter):
+        rate_limiter.max_retries = 2
+        call = MagicMock(side_effect=make_rate_limit_error('Rate limit reached'))
+
+        async def acall():
+            return call()
+
+        with pytest.raises(RateLimitError):
+            await rate_limiter.run('fake-model', acall, 100)
+        assert call.call_count == 3
@@ -0,0 +1,88 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from benchmarks.synthetic_export import write_export
+from historizer import iter_chat_history, render_message_with_templates
+from models import ServiceMessage, UserMessage
+from renderer import format_datetime, render_discussion_message, render_message, render_messages
+from summarizer import MESSAGE_TEMPLATE
+
+
+def make_user_message(**fields) -> UserMessage:
+    return UserMessage.model_validate({
+        'id': 2,
+        'type': 'message',
+        'date': '2022-05-12T10:00:05',
+        'date_unixtime': '1652349605',
+        **fields,
+    })
+
+
+REPLY_TARGETS = [
+    None,
+    make_user_message(id=1, text='short', **{'from': 'Bob'}),
+    make_user_message(id=1, text='x' * 105),
+    make_user_message(id=1, text='y' * 106, **{'from': 'Bob'}),
+    make_user_message(id=1, text=''),
+    ServiceMessage.model_validate({'id': 1, 'type': 'service', 'date': '2022-05-12T10:00:00',
+                                   'date_unixtime': '1652349600', 'action': 'pin_message', 'text': 'pinned'}),
+]
+
+
+@pytest.mark.parametrize('reply_to', REPLY_TARGETS)
+@pytest.mark.parametrize('fields', [
+    {'text': 'привет', 'from': 'Alice'},
+    {'text': '', 'from': None, 'sticker_emoji': '🐒'},
+    {'text': ['a ', {'type': 'bold', 'text': 'b'}], 'photo': 'photo.jpg', 'from': 'Alice'},
+    {'text': 'ok', 'reactions': [{'type': 'emoji', 'count': 2, 'emoji': '👍'}, {'type': 'custom_emoji', 'count': 1}]},
+])
+def test_user_message_matches_template(fields, reply_to):
+    message = make_user_message(**fields)
+    assert render_message(message, reply_to) == render_message_with_templates(message, reply_to)
+
+
+@pytest.mark.parametrize('fields', [
+    {'action': 'invite_members', 'actor': 'Alice'},
+    {'action': '', 'actor': None},
+])
+def test_service_message_matches_template(fields):
+    message = ServiceMessage.model_validate({'id': 1, 'type': 'service', 'date': '2022-05-12T10:00:00',
+                                             'date_unixtime': '1652349600', **fields})
+    assert render_message(message) == render_message_with_templates(message)
+
+
+def test_synthetic_export_matches_templates(tmp_path):
+    path = str(tmp_path / 'result.json')
+    write_export(path, 2000)
+
+    messages = list(iter_chat_history(path))
+    by_id = {message.id: message for message in messages}
+
+    def resolve_reply(message):
+        return by_id.get(getattr(message, 'reply_to_message_id', None))
+
+    expected = '\n\n'.join(render_message_with_templates(message, resolve_reply(message)) for message in messages)
+    assert render_messages(messages, resolve_reply) == expected
+
+
+@pytest.mark.parametrize('date', [
+    datetime(2022, 5, 12, 10, 0, 5),
+    datetime(2022, 5, 12, 10, 0, 5, 123456),
+    datetime(2022, 5, 12, 10, 0, 5, tzinfo=timezone.utc),
+])
+def test_format_datetime(date):
+    assert format_datetime(date) == date.strftime('%Y-%m-%d %H:%M:%S')
+
+
+@pytest.mark.parametrize('fields', [
+    {'first_name': 'Иван', 'last_name': 'Петров', 'username': 'ivan', 'text': 'текст'},
+    {'first_name': None, 'last_name': None, 'username': None, 'text': 'текст',
+     'reply_to_text': 'исходное', 'reply_to_username': 'bob'},
+    {'first_name': 'Иван', 'last_name': None, 'username': 'ivan', 'text': 'a\nb', 'reply_to_text': ''},
+    {'first_name': 'Канал', 'last_name': None, 'username': None, 'text': 'пост', 'reply_to_text': 'вопрос'},
+])
+def test_discussion_message_matches_template(fields):
+    fields = {'datetime': '2022-05-12 10:00:05', 'reply_to_text': None, 'reply_to_username': None, **fields}
+    assert render_discussion_message(**fields) == MESSAGE_TEMPLATE.render(**fields)
+    assert '@None' not in render_discussion_message(**fields)
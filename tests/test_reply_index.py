@@ -0,0 +1,77 @@
+from datetime import datetime
+
+import pytest
+
+from benchmarks.synthetic_export import write_export
+from historizer import Historizer, iter_chat_history
+from models import UserMessage
+from reply_index import ReplyContext, ReplyIndex
+
+
+def make_message(message_id: int, text: str = 'text', sender: str | None = 'Alice') -> UserMessage:
+    return UserMessage.model_validate({
+        'id': message_id,
+        'type': 'message',
+        'date': datetime(2022, 5, 12, 10, 0, message_id % 60).isoformat(),
+        'date_unixtime': '1652349600',
+        'from': sender,
+        'text': text,
+    })
+
+
+def test_context_keeps_only_truncated_text():
+    context = ReplyContext.from_message(make_message(1, text='x' * 1000))
+
+    assert context == ReplyContext('x' * 97 + '...', 'Alice')
+
+
+def test_lru_keeps_recently_used_entries_in_memory():
+    index = ReplyIndex(max_entries=3)
+    for i in range(1, 4):
+        index.add(make_message(i))
+    index.get(1)
+    index.add(make_message(4))
+
+    assert list(index.entries) == [3, 1, 4]
+
+
+def test_id_window_evicts_old_ids():
+    index = ReplyIndex(id_window=10)
+    for i in range(1, 31):
+        index.add(make_message(i))
+
+    assert list(index.entries) == list(range(20, 31))
+
+
+@pytest.mark.parametrize('spill', [True, False])
+def test_evicted_entries_are_served_from_spill(spill):
+    index = ReplyIndex(max_entries=10, spill=spill)
+    for i in range(1, 2501):
+        index.add(make_message(i, text=f'text {i}', sender=None if i % 2 else 'Bob'))
+
+    assert len(index) == 10
+    assert index.get(2500) == ReplyContext('text 2500', 'Bob')
+    assert index.get(1234) == (ReplyContext('text 1234', 'Bob') if spill else None)
+    assert index.get(5000) is None
+    index.close()
+
+
+def test_instances_do_not_share_reply_context(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    Historizer().render_message(make_message(1, text='first'))
+
+    assert Historizer().replies.get(1) is None
+
+
+def test_bounded_index_renders_same_text(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / 'result.json')
+    write_export(path, 3000)
+    messages = list(iter_chat_history(path))
+
+    bounded = Historizer(reply_index_size=20)
+    unbounded = Historizer(reply_index_size=10_000)
+
+    assert bounded.render_chunk(messages) == unbounded.render_chunk(messages)
+    assert len(bounded.replies) == 20
+    assert bounded.replies.spill_hits > 0
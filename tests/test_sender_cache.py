@@ -0,0 +1,84 @@
+import pytest
+from telethon.tl.types import Channel, User
+from telethon.utils import get_peer_id
+
+from sender_cache import Sender, SenderCache
+
+
+class StubClient:
+    """
+    Resolves peer ids from a dict of entities like get_entity does: a list fails as a whole if any id is unknown
+    """
+
+    def __init__(self, entities: list):
+        self.entities = {get_peer_id(entity): entity for entity in entities}
+        self.requests = []
+
+    async def get_entity(self, ids):
+        self.requests.append(ids)
+        if isinstance(ids, list):
+            if any(sender_id not in self.entities for sender_id in ids):
+                raise ValueError('Could not find the input entity')
+            return [self.entities[sender_id] for sender_id in ids]
+        if ids not in self.entities:
+            raise ValueError('Could not find the input entity')
+        return self.entities[ids]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = SenderCache(str(tmp_path / 'senders.sqlite3'))
+    yield cache
+    cache.close()
+
+
+def make_users(count: int) -> list[User]:
+    return [User(id=i, first_name=f'Имя {i}', last_name='Фамилия', username=f'user{i}') for i in range(1, count + 1)]
+
+
+@pytest.mark.asyncio
+async def test_each_sender_is_resolved_once(cache, tmp_path):
+    client = StubClient(make_users(500))
+
+    senders = await cache.resolve(client, range(1, 501))
+    again = await SenderCache(str(tmp_path / 'senders.sqlite3')).resolve(client, range(1, 501))
+
+    assert senders == again
+    assert senders[7] == Sender(7, 'Имя 7', 'Фамилия', 'user7')
+    # In bulk, and nothing for the second run
+    assert [len(request) for request in client.requests] == [200, 200, 100]
+
+
+@pytest.mark.asyncio
+async def test_expired_senders_are_resolved_again(tmp_path):
+    client = StubClient(make_users(3))
+    cache = SenderCache(str(tmp_path / 'senders.sqlite3'), ttl=-1)
+
+    await cache.resolve(client, [1, 2, 3])
+    await cache.resolve(client, [1, 2, 3])
+
+    assert client.requests == [[1, 2, 3], [1, 2, 3]]
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_unknown_senders_are_cached_without_names(cache):
+    client = StubClient(make_users(2))
+
+    senders = await cache.resolve(client, [1, 2, 99])
+    client.requests.clear()
+    await cache.resolve(client, [1, 2, 99])
+
+    assert senders[99] == Sender(99)
+    assert senders[2].username == 'user2'
+    assert client.requests == []
+
+
+@pytest.mark.asyncio
+async def test_channels_are_named_by_title(cache):
+    channel = Channel(id=1234, title='Новости', photo=None, date=None, username='news')
+    client = StubClient([channel])
+
+    sender, = (await cache.resolve(client, [get_peer_id(channel)])).values()
+
+    assert sender.id == get_peer_id(channel) < 0 and sender.display_name == 'Новости' and sender.username == 'news'
@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+from benchmarks.synthetic_export import write_export
+from message_store import MessageStore
+from renderer import render_message
+from snapshot import ReactionColumn, TextColumn, load_or_build_snapshot, load_snapshot
+
+
+@pytest.fixture
+def export_path(tmp_path):
+    path = str(tmp_path / 'result.json')
+    write_export(path, 2000)
+    return path
+
+
+@pytest.fixture
+def snapshot_path(tmp_path):
+    return str(tmp_path / 'result.snapshot')
+
+
+def render_all(store: MessageStore) -> list[str]:
+    return [render_message(row, store.get(getattr(row, 'reply_to_message_id', None) or 0)) for row in store]
+
+
+def test_snapshot_matches_parsed_store(export_path, snapshot_path):
+    built = load_or_build_snapshot(export_path, snapshot_path)
+    snapshot = load_snapshot(snapshot_path)
+
+    assert isinstance(snapshot.store.texts, TextColumn)
+    assert len(snapshot.store) == len(built) == 2000
+    assert render_all(snapshot.store) == render_all(built)
+    assert isinstance(snapshot.store.reactions, ReactionColumn)
+    assert built.reactions and dict(snapshot.store.reactions.items()) == built.reactions
+    assert snapshot.store.reactions.get(-1) is None
+    assert snapshot.store.get(1234).id == 1234
+    assert snapshot.store.rows_after(1234) == built.rows_after(1234)
+
+
+def test_formatted_service_text_round_trips(tmp_path, snapshot_path):
+    path = str(tmp_path / 'result.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"messages": [{"id": 1, "type": "service", "date": "2024-01-01T10:00:00", "action": "pin_message", '
+                '"actor": "Alice", "text": ["Pinned ", {"type": "bold", "text": "this"}]}]}')
+
+    load_or_build_snapshot(path, snapshot_path)
+
+    assert load_snapshot(snapshot_path).store.texts[0] == ['Pinned ', {'type': 'bold', 'text': 'this'}]
+
+
+def test_unchanged_export_is_not_parsed_again(export_path, snapshot_path, monkeypatch):
+    load_or_build_snapshot(export_path, snapshot_path)
+
+    def fail(*args):
+        raise AssertionError('The export was parsed again')
+
+    monkeypatch.setattr(MessageStore, 'from_export', fail)
+    assert len(load_or_build_snapshot(export_path, snapshot_path)) == 2000
+
+    # A touched export with the same content still matches by digest
+    os.utime(export_path, ns=(0, 0))
+    assert len(load_or_build_snapshot(export_path, snapshot_path)) == 2000
+
+
+def test_changed_export_rebuilds_snapshot(export_path, snapshot_path):
+    load_or_build_snapshot(export_path, snapshot_path)
+    write_export(export_path, 2100)
+
+    assert len(load_or_build_snapshot(export_path, snapshot_path)) == 2100
+    assert len(load_snapshot(snapshot_path).store) == 2100
+
+
+def test_same_size_edit_is_detected(export_path, snapshot_path):
+    load_or_build_snapshot(export_path, snapshot_path)
+    stat = os.stat(export_path)
+    with open(export_path, 'rb') as f:
+        content = f.read()
+    with open(export_path, 'wb') as f:
+        f.write(content.replace(b'"lol', b'"LOL', 1))
+    # Coarse filesystem timestamps could leave the mtime as it was
+    os.utime(export_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    # Same size, so only the mtime and the digest tell the edit apart
+    rebuilt = load_or_build_snapshot(export_path, snapshot_path)
+    assert any(isinstance(text, str) and text.startswith('LOL') for text in rebuilt.texts)
+
+
+def test_invalid_snapshot_is_ignored(snapshot_path):
+    with open(snapshot_path, 'wb') as f:
+        f.write(b'not a snapshot at all')
+
+    assert load_snapshot(snapshot_path) is None
+    assert load_snapshot(snapshot_path + '.missing') is None
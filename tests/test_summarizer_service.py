@@ -0,0 +1,145 @@
+import asyncio
+
+import httpx
+import pytest
+import pytest_asyncio
+
+from cache_store import MemoryCacheStore
+from fake_telegram import StubClient, make_message
+from llm_backend import FakeBackend
+from message_fetcher import FETCH_CONCURRENCY, MessageCache
+from sender_cache import SenderCache
+from summarizer_service import SummarizerService
+
+
+@pytest.fixture
+def service(tmp_path):
+    client = StubClient([make_message(i) for i in range(1, 301)])
+    return SummarizerService(
+        client, FakeBackend('gpt-4.1-mini', latency=0.05), max_jobs=2,
+        message_cache=MessageCache(str(tmp_path / 'messages.sqlite3')),
+        sender_cache=SenderCache(str(tmp_path / 'senders.sqlite3')),
+        cache=MemoryCacheStore(),
+    )
+
+
+@pytest_asyncio.fixture
+async def http(service):
+    server = await service.start('127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}', timeout=10) as http:
+        yield http
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_job_is_summarized(service, http):
+    response = await http.post('/jobs', json={'start_url': 'https://t.me/chat/10', 'end_url': 'https://t.me/chat/50',
+                                              'instructions': 'Кто прав?'})
+    assert response.status_code == 202
+    job_id = response.json()['id']
+    assert response.json()['status'] == 'queued'
+
+    job = (await http.get(f'/jobs/{job_id}', params={'wait': 1})).json()
+
+    assert job['status'] == 'done' and job['error'] is None
+    assert job['summary'].startswith('Summary ')
+    assert (job['channel'], job['start_message_id'], job['end_message_id']) == ('chat', 10, 50)
+    assert service.client.served == list(range(11, 50))
+
+
+@pytest.mark.asyncio
+async def test_identical_requests_share_a_job(service, http):
+    request = {'start_url': 'https://t.me/chat/10', 'instructions': 'Кто прав?'}
+
+    first, second, other = await asyncio.gather(
+        http.post('/jobs', json=request),
+        http.post('/jobs', json={**request, 'start_url': 'https://t.me/CHAT/10'}),
+        http.post('/jobs', json={**request, 'instructions': 'О чём спор?'}),
+    )
+
+    assert second.json()['id'] == first.json()['id'] != other.json()['id']
+    assert (first.status_code, second.status_code) in ((202, 200), (200, 202))
+    await asyncio.gather(*(job.task for job in service.jobs.values()))
+    assert service.backend.calls == 2
+    assert service.jobs[first.json()['id']].requests == 2
+
+    # Once finished, the same request starts a new job
+    again = await http.post('/jobs', json=request)
+    assert again.status_code == 202 and again.json()['id'] != first.json()['id']
+
+
+@pytest.mark.asyncio
+async def test_jobs_run_concurrently_up_to_the_limit(service):
+    jobs = [service.submit(f'https://t.me/chat/{start}', instructions='Кто прав?')[0] for start in (10, 20, 30)]
+    await asyncio.sleep(0.01)
+
+    assert [job.status for job in jobs] == ['running', 'running', 'queued']
+    await asyncio.gather(*(job.task for job in jobs))
+    assert service.backend.max_in_flight == 2
+    assert all(job.status == 'done' for job in jobs)
+
+
+@pytest.mark.asyncio
+async def test_errors_are_reported(service, http):
+    service.client.flood_waits = [10 ** 6]
+
+    invalid = await http.post('/jobs', json={'start_url': 'https://example.com/chat/1'})
+    missing = await http.get('/jobs/unknown')
+    failed = await http.post('/jobs', json={'start_url': 'https://t.me/chat/1'})
+    job = (await http.get(f'/jobs/{failed.json()["id"]}?wait=true')).json()
+    listed = (await http.get('/jobs')).json()['jobs']
+
+    assert invalid.status_code == 400 and 'Invalid URL format' in invalid.json()['error']
+    assert missing.status_code == 404
+    assert job['status'] == 'failed' and job['error'].startswith('FloodWaitError')
+    assert [entry['id'] for entry in listed] == [job['id']] and 'summary' not in listed[0]
+    assert (await http.get('/health')).json() == {'status': 'ok', 'jobs': {'failed': 1}}
+
+
+@pytest.mark.asyncio
+async def test_unix_socket(service, tmp_path):
+    socket_path = str(tmp_path / 'summarizer.sock')
+    server = await service.start(socket_path=socket_path)
+
+    async with httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(uds=socket_path), base_url='http://service') as http:
+        assert (await http.get('/health')).json()['status'] == 'ok'
+
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_requests_with_wrong_types_are_rejected(service, http):
+    for request in ({'start_url': 123}, {'start_url': 'https://t.me/chat/1', 'end_url': ['https://t.me/chat/2']},
+                    {'start_url': 'https://t.me/chat/1', 'instructions': ['Кто прав?']},
+                    {'start_url': 'https://t.me/chat/1', 'refetch': 'yes'}):
+        response = await http.post('/jobs', json=request)
+        assert response.status_code == 400 and response.json()['error'].endswith(('string', 'false'))
+
+    assert service.jobs == {}
+
+
+@pytest.mark.asyncio
+async def test_unexpected_errors_are_answered(service, http, monkeypatch):
+    async def broken(method, target, body):
+        raise RuntimeError('broken')
+
+    monkeypatch.setattr(service, 'handle', broken)
+    response = await http.get('/health')
+
+    assert response.status_code == 500 and response.json() == {'error': 'RuntimeError: broken'}
+
+
+@pytest.mark.asyncio
+async def test_jobs_share_the_fetch_limit_of_the_client(service):
+    service.client.latency = 0.001
+    service.semaphore = asyncio.Semaphore(2 * FETCH_CONCURRENCY)
+    # Chats of their own, so that every job fetches its range
+    jobs = [service.submit(f'https://t.me/chat{i}/1')[0] for i in range(2 * FETCH_CONCURRENCY)]
+
+    await asyncio.gather(*(job.task for job in jobs))
+
+    assert all(job.status == 'done' for job in jobs)
+    assert service.client.max_in_flight == FETCH_CONCURRENCY
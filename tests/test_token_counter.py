@@ -0,0 +1,55 @@
+from unittest.mock import patch
+
+import pytest
+
+from token_counter import (OUTPUT_RESERVE_TOKENS, count_tokens, estimate_cost, estimate_tokens, get_token_budget,
+                           split_by_tokens, truncate_by_tokens)
+
+
+class TestEstimateTokens:
+    def test_empty_text(self):
+        assert estimate_tokens('') == 1
+
+    def test_latin_text(self):
+        assert estimate_tokens('a' * 400) == 101
+
+    def test_cyrillic_costs_more_than_latin(self):
+        assert estimate_tokens('я' * 400) > estimate_tokens('a' * 400)
+
+
+def test_count_tokens_falls_back_to_estimate():
+    with patch('token_counter.get_encoding', return_value=None):
+        assert count_tokens('привет, мир') == estimate_tokens('привет, мир')
+
+
+@pytest.mark.parametrize('model, tokens_per_minute', [
+    ('gpt-4.1-nano', 200_000),
+    ('gpt-4.1', 30_000),
+])
+def test_token_budget_is_bounded_by_rate_limit(model, tokens_per_minute):
+    budget = get_token_budget(model)
+    assert 0 < budget < tokens_per_minute - OUTPUT_RESERVE_TOKENS
+
+
+def test_estimate_cost():
+    assert estimate_cost('gpt-4.1', 1_000_000, 500_000) == pytest.approx(6.0)
+    assert estimate_cost('unknown-model', 1000, 1000) is None
+
+
+def test_split_by_tokens():
+    text = 'слово ' * 1000
+
+    pieces = split_by_tokens(text, 100)
+
+    assert ''.join(pieces) == text
+    assert len(pieces) > 1
+    assert all(count_tokens(piece) <= 100 for piece in pieces)
+    assert split_by_tokens('short', 100) == ['short']
+
+
+def test_truncate_by_tokens():
+    text = 'слово ' * 1000
+
+    assert text.startswith(truncate_by_tokens(text, 100))
+    assert 0 < count_tokens(truncate_by_tokens(text, 100)) <= 100
+    assert truncate_by_tokens('short', 100) == 'short'
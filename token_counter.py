@@ -0,0 +1,102 @@
+import functools
+import logging
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken is optional, the calibrated estimate is used without it
+    tiktoken = None
+
+from rate_limiter import DEFAULT_LIMITS, MODEL_LIMITS
+
+logger = logging.getLogger(__name__)
+
+
+MODEL_CONTEXT_TOKENS = {
+    'gpt-4.1-nano': 1_047_576,
+    'gpt-4.1-mini': 1_047_576,
+    'gpt-4.1': 1_047_576,
+}
+
+DEFAULT_CONTEXT_TOKENS = 128_000
+
+# USD per million prompt and completion tokens
+MODEL_PRICES = {
+    'gpt-4.1-nano': (0.10, 0.40),
+    'gpt-4.1-mini': (0.40, 1.60),
+    'gpt-4.1': (2.00, 8.00),
+}
+
+# Room left for the completion in every request
+OUTPUT_RESERVE_TOKENS = 4096
+
+# Headroom for the error of the estimate when tiktoken is not installed
+BUDGET_SAFETY_FACTOR = 0.9
+
+# gpt-4.1 models use o200k_base: about 4 latin or 2.5-3 cyrillic characters per token
+ASCII_CHARS_PER_TOKEN = 4
+NON_ASCII_CHARS_PER_TOKEN = 2.5
+
+
+@functools.cache
+def get_encoding():
+    if tiktoken is None:
+        logger.info('tiktoken is not installed, token counts are estimated')
+        return None
+    return tiktoken.get_encoding('o200k_base')
+
+
+def estimate_tokens(text: str) -> int:
+    # Every non-ASCII character takes at least one extra byte in UTF-8
+    non_ascii = min(len(text.encode('utf-8')) - len(text), len(text))
+    ascii_ = len(text) - non_ascii
+    return int(ascii_ / ASCII_CHARS_PER_TOKEN + non_ascii / NON_ASCII_CHARS_PER_TOKEN) + 1
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def split_by_tokens(text: str, max_tokens: int) -> list[str]:
+    """
+    Consecutive pieces of the text of at most max_tokens tokens each, joined they are the text again.
+    Halved until they fit, at whitespace near the middle where there is some
+    """
+
+    if len(text) <= 1 or count_tokens(text) <= max_tokens:
+        return [text]
+
+    middle = len(text) // 2
+    space = max(text.rfind(' ', middle // 2, middle), text.rfind('\n', middle // 2, middle))
+    cut = space + 1 if space > 0 else middle
+    return split_by_tokens(text[:cut], max_tokens) + split_by_tokens(text[cut:], max_tokens)
+
+
+def truncate_by_tokens(text: str, max_tokens: int) -> str:
+    """
+    The start of the text, at most max_tokens tokens, the whole text when it fits
+    """
+
+    return split_by_tokens(text, max_tokens)[0]
+
+
+def get_token_budget(model: str, prompt_template: str = '', context_tokens: int | None = None) -> int:
+    """
+    Tokens that fit into a single request to the model besides the prompt template.
+    Bounded by the context window and by the tokens per minute limit, since OpenAI rejects
+    a request bigger than the per minute budget as "too large"
+    """
+
+    limits = MODEL_LIMITS.get(model, DEFAULT_LIMITS)
+    context_tokens = context_tokens or MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+    window = min(context_tokens, limits.tokens_per_minute)
+    return int((window - count_tokens(prompt_template) - OUTPUT_RESERVE_TOKENS) * BUDGET_SAFETY_FACTOR)
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float | None:
+    if model not in MODEL_PRICES:
+        return None
+    prompt_price, completion_price = MODEL_PRICES[model]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000